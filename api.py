@@ -0,0 +1,582 @@
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Seconds a threshold request waits for others to share its calculation,
+# and the most requests calculated together
+BATCH_WINDOW = 0.002
+MAX_BATCH = 256
+
+# Requests with a larger body are refused
+MAX_BODY_BYTES = 16 * 2**20
+
+# Latencies kept per route for the percentiles, and the window (seconds)
+# of the recent throughput
+LATENCY_SAMPLES = 2048
+THROUGHPUT_WINDOW = 60
+
+# Renders a worker process handles before it is replaced
+MAX_TASKS_PER_WORKER = 64
+
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+RENDER_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+}
+
+
+class RequestError(Exception):
+    # An error answered with ``status`` and the message as JSON
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_stages(body, content_type):
+    """
+    Stage columns of a request body as float64 arrays.
+
+    The body is CSV (``text/csv``) with Lactate, Heart Rate and Power
+    columns, or JSON: either ``{"lactate": [...], "power": [...],
+    "heart_rate": [...]}`` or ``{"stages": [{"lactate": ..., "power": ...},
+    ...]}``. Heart rate is optional. Returns the columns and the options of a
+    JSON body (e.g. ``method``); raises ValueError on invalid input.
+    """
+
+    if content_type.split(";")[0].strip().lower() in ("text/csv", "application/csv"):
+        import pandas as pd
+
+        from store import validate_dataframe
+
+        try:
+            df = pd.read_csv(io.BytesIO(body))
+        except (ValueError, pd.errors.ParserError) as e:
+            raise ValueError(f"Invalid CSV: {e}") from None
+        columns = validate_dataframe(df)
+        return {
+            name: columns[name].astype(np.float64)
+            for name in ("lactate", "heart_rate", "power")
+        }, {}
+
+    try:
+        document = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}") from None
+    if not isinstance(document, dict):
+        raise ValueError("The JSON body must be an object.")
+    if "stages" in document:
+        stages = document.pop("stages")
+        if not isinstance(stages, list) or not all(
+            isinstance(stage, dict) for stage in stages
+        ):
+            raise ValueError("'stages' must be a list of objects.")
+        names = ("lactate", "heart_rate", "power")
+        present = [name for name in names if stages and name in stages[0]]
+        document.update(
+            {name: [stage.get(name) for stage in stages] for name in present}
+        )
+
+    columns = {}
+    for name in ("lactate", "heart_rate", "power"):
+        if name not in document:
+            if name == "heart_rate":
+                continue
+            raise ValueError(f"Missing '{name}'.")
+        try:
+            values = np.array(document.pop(name), dtype=np.float64)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be a list of numbers.") from None
+        if values.ndim != 1 or not np.isfinite(values).all():
+            raise ValueError(f"'{name}' must be a list of numbers.")
+        columns[name] = values
+    if len({len(values) for values in columns.values()}) > 1:
+        raise ValueError("All columns must have the same length.")
+    return columns, document
+
+
+def render_stages(columns, method, format):
+    """
+    Render a test to PNG, SVG or a PDF report; runs in a worker process.
+
+    Images come from the process's render.Renderer, whose disk cache is
+    shared with the app and batch runs.
+    """
+
+    from render import default_renderer
+    from store import TestStore
+    from thresholds import calculate_thresholds
+
+    data = TestStore()
+    data.extend(columns["lactate"], columns["heart_rate"], columns["power"])
+    results = calculate_thresholds(data["lactate"], data["power"], method)
+    if format != "pdf":
+        return default_renderer().render_test(data, results, format=format)
+
+    from report import build_report
+
+    image = default_renderer().render_test(data, results)
+    destination = io.BytesIO()
+    build_report(destination, results, image, method=method)
+    return destination.getvalue()
+
+
+class ThresholdBatcher:
+    """
+    Collects concurrent threshold requests and calculates them together.
+
+    A request waits at most ``window`` seconds for others to arrive; then
+    all waiting tests of a method are stacked and scored with one
+    thresholds.calculate_thresholds_batch() call on a worker thread, so a
+    burst of requests costs a few array operations instead of one
+    calculation each. A batch is started early once ``max_batch`` requests
+    wait.
+    """
+
+    def __init__(self, window=BATCH_WINDOW, max_batch=MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self.largest = 0
+        self._pending = []
+        self._timer = None
+        # Running calculations, referenced until they finish
+        self._tasks = set()
+
+    async def calculate(self, lactate, power, method):
+        # (FTP, LT1, LT2, FATmax) of one test, None where not calculated
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((lactate, power, method, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_size": self.requests / self.batches if self.batches else 0.0,
+            "largest": self.largest,
+        }
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        groups = {}
+        for request in pending:
+            groups.setdefault(request[2], []).append(request)
+        for method, requests in groups.items():
+            self.batches += 1
+            self.requests += len(requests)
+            self.largest = max(self.largest, len(requests))
+            task = asyncio.ensure_future(self._score(method, requests))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _score(self, method, requests):
+        from thresholds import calculate_thresholds_batch, stack_tests
+
+        def score():
+            lactate, power = stack_tests(
+                [(lactate, power) for lactate, power, _, _ in requests]
+            )
+            return calculate_thresholds_batch(lactate, power, method)
+
+        try:
+            results = await asyncio.to_thread(score)
+        except Exception as e:
+            for *_, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for row, (*_, future) in zip(results, requests):
+            if not future.done():
+                future.set_result(
+                    tuple(None if np.isnan(value) else float(value) for value in row)
+                )
+
+
+class Metrics:
+    # Request counts, errors, latency percentiles and throughput per route
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.routes = {}
+        self._recent = deque()
+
+    def record(self, route, seconds, status):
+        stats = self.routes.setdefault(
+            route,
+            {"requests": 0, "errors": 0, "latencies": deque(maxlen=LATENCY_SAMPLES)},
+        )
+        stats["requests"] += 1
+        if status >= 400:
+            stats["errors"] += 1
+        stats["latencies"].append(seconds)
+        now = time.monotonic()
+        self._recent.append(now)
+        while self._recent and self._recent[0] < now - THROUGHPUT_WINDOW:
+            self._recent.popleft()
+
+    def snapshot(self):
+        now = time.monotonic()
+        uptime = now - self.started
+        while self._recent and self._recent[0] < now - THROUGHPUT_WINDOW:
+            self._recent.popleft()
+        routes = {}
+        total = 0
+        for route, stats in self.routes.items():
+            latencies = np.array(stats["latencies"]) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            routes[route] = {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "latency_ms": {
+                    "mean": float(latencies.mean()),
+                    "p50": float(p50),
+                    "p95": float(p95),
+                    "p99": float(p99),
+                    "max": float(latencies.max()),
+                },
+            }
+            total += stats["requests"]
+        return {
+            "uptime_s": uptime,
+            "requests": total,
+            "throughput_rps": {
+                "overall": total / uptime if uptime > 0 else 0.0,
+                "recent": len(self._recent) / min(THROUGHPUT_WINDOW, uptime or 1),
+            },
+            "routes": routes,
+        }
+
+
+class ApiServer:
+    """
+    Local HTTP/1.1 service for threshold calculation and rendering.
+
+    Routes:
+        POST /thresholds  stage data (JSON or CSV) -> FTP, LT1, LT2, FATmax
+        POST /render      stage data -> PNG, SVG or PDF report (?format=)
+        GET  /metrics     latency, throughput and batching statistics
+        GET  /health      liveness check
+
+    Threshold requests are micro-batched by a ThresholdBatcher; renders run
+    in a pool of ``workers`` processes so they never block the event loop.
+    The method is chosen with ``?method=`` or a ``method`` field of a JSON
+    body and defaults to thresholds.DEFAULT_METHOD, which gives the results
+    of calculate_ftp_lt1_lt2_fatmax().
+    """
+
+    def __init__(
+        self,
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        workers=None,
+        batch_window=BATCH_WINDOW,
+        max_batch=MAX_BATCH,
+    ):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.batcher = ThresholdBatcher(batch_window, max_batch)
+        self.metrics = Metrics()
+        self.in_flight = 0
+        self._server = None
+        self._pool = None
+        self._routes = {
+            ("POST", "/thresholds"): self.thresholds,
+            ("POST", "/render"): self.render,
+            ("GET", "/metrics"): self.show_metrics,
+            ("GET", "/health"): self.health,
+        }
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        # The actual port when started with port 0
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def thresholds(self, query, headers, body):
+        columns, options = self._stages(headers, body)
+        method = self._method(query, options)
+        results = await self.batcher.calculate(
+            columns["lactate"], columns["power"], method
+        )
+        document = dict(zip(THRESHOLDS, results))
+        document["method"] = method
+        return _json(document)
+
+    async def render(self, query, headers, body):
+        columns, options = self._stages(headers, body)
+        method = self._method(query, options)
+        format = query.get("format", [options.get("format", "png")])[0]
+        if format not in RENDER_TYPES:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST,
+                f"Unknown format '{format}' (use {', '.join(RENDER_TYPES)}).",
+            )
+        if "heart_rate" not in columns:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST, "Rendering needs 'heart_rate' as well."
+            )
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(
+            self._render_pool(), render_stages, columns, method, format
+        )
+        return HTTPStatus.OK, RENDER_TYPES[format], content
+
+    async def show_metrics(self, query, headers, body):
+        document = self.metrics.snapshot()
+        document["in_flight"] = self.in_flight
+        document["batching"] = self.batcher.stats()
+        return _json(document)
+
+    async def health(self, query, headers, body):
+        return _json({"status": "ok"})
+
+    def _stages(self, headers, body):
+        try:
+            return parse_stages(body, headers.get("content-type", "application/json"))
+        except ValueError as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, str(e)) from None
+
+    def _method(self, query, options):
+        from thresholds import DEFAULT_METHOD, METHODS
+
+        method = query.get("method", [options.get("method", DEFAULT_METHOD)])[0]
+        if not isinstance(method, str):
+            raise RequestError(HTTPStatus.BAD_REQUEST, "'method' must be a string.")
+        if method not in METHODS:
+            raise RequestError(
+                HTTPStatus.BAD_REQUEST,
+                f"Unknown method '{method}' (use {', '.join(METHODS)}).",
+            )
+        return method
+
+    def _render_pool(self):
+        # Started on the first render, so a thresholds-only service does not
+        # spawn processes
+        if self._pool is None:
+            if sys.version_info >= (3, 11):
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, max_tasks_per_child=MAX_TASKS_PER_WORKER
+                )
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                started = time.perf_counter()
+                route = "invalid"
+                keep_alive = False
+                try:
+                    parts = request_line.decode("latin-1").split()
+                    if len(parts) != 3:
+                        raise RequestError(
+                            HTTPStatus.BAD_REQUEST, "Malformed request line."
+                        )
+                    method, target, version = parts
+                    headers = await _read_headers(reader)
+                    keep_alive = _keep_alive(version, headers)
+                    url = urlsplit(target)
+                    route = url.path
+                    body = await _read_body(reader, headers)
+                    handler = self._routes.get((method, url.path))
+                    if handler is None:
+                        known = any(path == url.path for _, path in self._routes)
+                        raise RequestError(
+                            (
+                                HTTPStatus.METHOD_NOT_ALLOWED
+                                if known
+                                else HTTPStatus.NOT_FOUND
+                            ),
+                            f"No route for {method} {url.path}.",
+                        )
+                    self.in_flight += 1
+                    try:
+                        status, content_type, content = await handler(
+                            parse_qs(url.query), headers, body
+                        )
+                    finally:
+                        self.in_flight -= 1
+                except RequestError as e:
+                    status, content_type, content = _json({"error": str(e)}, e.status)
+                    # The body of a refused request may not have been read
+                    if e.status in (
+                        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        HTTPStatus.LENGTH_REQUIRED,
+                    ):
+                        keep_alive = False
+                except Exception as e:
+                    status, content_type, content = _json(
+                        {"error": f"{type(e).__name__}: {e}"},
+                        HTTPStatus.INTERNAL_SERVER_ERROR,
+                    )
+
+                writer.write(_response(status, content_type, content, keep_alive))
+                await writer.drain()
+                if route in {path for _, path in self._routes}:
+                    self.metrics.record(
+                        route, time.perf_counter() - started, int(status)
+                    )
+                if not keep_alive:
+                    break
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, separator, value = line.decode("latin-1").partition(":")
+        if not separator:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Malformed header line.")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _read_body(reader, headers):
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise RequestError(HTTPStatus.LENGTH_REQUIRED, "Send a Content-Length.")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length.") from None
+    if length > MAX_BODY_BYTES:
+        raise RequestError(
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+            f"Request bodies are limited to {MAX_BODY_BYTES} bytes.",
+        )
+    return await reader.readexactly(length) if length else b""
+
+
+def _keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
+def _json(document, status=HTTPStatus.OK):
+    content = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    return status, "application/json", content
+
+
+def _response(status, content_type, content, keep_alive):
+    status = HTTPStatus(status)
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(content)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode("latin-1") + content
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, **options):
+    server = await ApiServer(host, port, **options).start()
+    print(f"Serving on http://{server.host}:{server.port}", flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local HTTP service for FTP, LT1, LT2, and FATmax."
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="Port to listen on"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of render worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=BATCH_WINDOW * 1000,
+        help="Milliseconds a threshold request waits to be batched with others",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=MAX_BATCH,
+        help="Most threshold requests calculated together",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(
+            serve(
+                args.host,
+                args.port,
+                workers=args.workers,
+                batch_window=args.batch_window / 1000,
+                max_batch=args.max_batch,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
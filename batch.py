@@ -0,0 +1,578 @@
+import argparse
+import datetime
+import glob
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+TEST_FILE_EXTENSIONS = (".xls", ".xlsx")
+
+# Files a worker process handles before it is replaced, which bounds the
+# memory a long report run can accumulate in one process
+MAX_TASKS_PER_WORKER = 64
+
+# Threshold columns of the results table
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+# A test read from the history store instead of a file
+HistoryTest = namedtuple("HistoryTest", "db_path test_id name")
+
+# History store connections opened by this worker process, by path
+_histories = {}
+
+
+def collect_files(inputs):
+    # Expand directories and glob patterns into a sorted, de-duplicated list
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for dirpath, _, filenames in os.walk(pattern):
+                for filename in filenames:
+                    files.append(os.path.join(dirpath, filename))
+        else:
+            files.extend(glob.glob(pattern, recursive=True))
+
+    seen = set()
+    test_files = []
+    for path in sorted(files):
+        name = os.path.basename(path)
+        # Skip lock files Excel leaves next to open workbooks
+        if name.startswith("~$") or not name.lower().endswith(TEST_FILE_EXTENSIONS):
+            continue
+        path = os.path.abspath(path)
+        if path not in seen and os.path.isfile(path):
+            seen.add(path)
+            test_files.append(path)
+    return test_files
+
+
+def process_file(
+    path, report_path=None, keep_data=False, method="bands", intervals=False
+):
+    from thresholds import bootstrap_intervals, calculate_thresholds
+
+    # Compute the thresholds of a single test file (or HistoryTest) and
+    # optionally write its PDF report to ``report_path``. Errors are
+    # returned instead of raised so one bad workbook only fails its own row.
+    # With ``intervals`` the bootstrap confidence intervals are added as
+    # <name>_low/<name>_high.
+    name = path.name if isinstance(path, HistoryTest) else path
+    try:
+        data = load_test(path)
+        if len(data) < 4:
+            raise ValueError(f"at least 4 stages are required, found {len(data)}")
+        results = calculate_thresholds(data["lactate"], data["power"], method)
+        bounds = None
+        if intervals:
+            bounds = bootstrap_intervals(
+                data["lactate"], data["power"], method, stage=data["stage"]
+            )
+        if report_path is not None:
+            write_report(data, results, report_path, method, bounds)
+    except Exception as e:
+        return {"file": name, "error": f"{type(e).__name__}: {e}", "rss": peak_rss()}
+
+    ftp, lt1, lt2, fatmax = results
+    row = {
+        "file": name,
+        "stages": len(data),
+        "FTP": _to_float(ftp),
+        "LT1": _to_float(lt1),
+        "LT2": _to_float(lt2),
+        "FATmax": _to_float(fatmax),
+        "rss": peak_rss(),
+    }
+    if bounds is not None:
+        for threshold, (low, high) in zip(THRESHOLDS, bounds.tolist()):
+            row[f"{threshold}_low"] = _to_float(None if low != low else low)
+            row[f"{threshold}_high"] = _to_float(None if high != high else high)
+    if keep_data:
+        row["data"] = data
+    return row
+
+
+def process_chunk(
+    paths, report_paths=None, keep_data=False, method="bands", intervals=False
+):
+    report_paths = report_paths or [None] * len(paths)
+    return [
+        process_file(path, report_path, keep_data, method, intervals)
+        for path, report_path in zip(paths, report_paths)
+    ]
+
+
+def load_test(path):
+    import pandas as pd
+    from store import TestStore
+
+    if isinstance(path, HistoryTest):
+        from history import HistoryStore
+
+        if path.db_path not in _histories:
+            _histories[path.db_path] = HistoryStore(path.db_path)
+        return _histories[path.db_path].load_test(path.test_id)
+
+    data = TestStore()
+    data.extend_dataframe(pd.read_excel(path))
+    return data
+
+
+def history_tests(db_path, athlete=None, since=None):
+    # The tests of a history store as HistoryTest items for run_batch()
+    from history import HistoryStore
+
+    history = HistoryStore(db_path)
+    try:
+        return [
+            HistoryTest(
+                db_path,
+                test["id"],
+                f"{test['athlete']} {test['test_date']} #{test['id']}",
+            )
+            for test in history.tests(athlete=athlete, start=since)
+        ]
+    finally:
+        history.close()
+
+
+def save_to_history(history, rows, athlete=None, method=None):
+    # Store successfully processed files in one transaction. The athlete
+    # defaults to the name of the file's directory and the test date to the
+    # file's modification date.
+    tests = []
+    for row in rows:
+        path = row["file"]
+        tests.append(
+            {
+                "athlete": athlete or os.path.basename(os.path.dirname(path)),
+                "test_date": datetime.date.fromtimestamp(os.path.getmtime(path)),
+                "data": row.pop("data"),
+                "results": (row["FTP"], row["LT1"], row["LT2"], row["FATmax"]),
+                "source": path,
+                "method": method,
+            }
+        )
+    history.add_tests(tests)
+
+
+def report_paths(paths, report_dir):
+    """
+    The PDF report of every test in ``paths``, all different.
+
+    Test files keep their directory layout below the deepest directory they
+    share, e.g. one folder per athlete, so alice/test.xlsx and bob/test.xlsx
+    get reports/alice/test.pdf and reports/bob/test.pdf. Tests from the
+    history are named by athlete, date and id.
+    """
+
+    files = [path for path in paths if not isinstance(path, HistoryTest)]
+    try:
+        root = os.path.commonpath([os.path.dirname(path) for path in files])
+    except ValueError:
+        # No files, or files on different drives
+        root = None
+
+    reports = []
+    used = set()
+    for path in paths:
+        if isinstance(path, HistoryTest):
+            relative = path.name
+        elif root is not None:
+            relative = os.path.relpath(os.path.splitext(path)[0], root)
+        else:
+            relative = os.path.splitdrive(os.path.splitext(path)[0])[1]
+        parts = [
+            re.sub(r"[^\w.-]+", "_", part)
+            for part in re.split(r"[\\/]", relative)
+            if part
+        ]
+        report = os.path.join(report_dir, *parts)
+        # Sanitizing can map different names to the same one
+        candidate = report
+        number = 2
+        while candidate.lower() in used:
+            candidate = f"{report}_{number}"
+            number += 1
+        used.add(candidate.lower())
+        reports.append(candidate + ".pdf")
+    return reports
+
+
+def write_report(data, results, destination, method=None, intervals=None):
+    from report import build_report, render_report_image
+
+    # Workers share the on-disk render cache, so unchanged tests are not
+    # drawn again on the next run
+    image = render_report_image(data, results)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    build_report(destination, results, image, method=method, intervals=intervals)
+
+
+def rescore_history(db_path, method, athlete=None, since=None):
+    """
+    Recalculate the stored thresholds of history tests with ``method``.
+
+    All matching tests are loaded as stacked arrays and scored with one
+    batched calculation, then written back in a single transaction.
+    Returns one results row per test, like run_batch().
+    """
+
+    import numpy as np
+    from history import HistoryStore
+    from thresholds import calculate_thresholds_batch
+
+    history = HistoryStore(db_path)
+    try:
+        test_ids, lactate, power = history.stacked_stages(athlete, since)
+        scores = calculate_thresholds_batch(lactate, power, method)
+        results = [
+            [None if value != value else value for value in row]
+            for row in scores.tolist()
+        ]
+        history.update_results(zip(test_ids, results), method)
+        tests = {test["id"]: test for test in history.tests(athlete, since)}
+    finally:
+        history.close()
+
+    stages = (~np.isnan(lactate)).sum(axis=1).tolist()
+    rows = []
+    for test_id, count, (ftp, lt1, lt2, fatmax) in zip(test_ids, stages, results):
+        test = tests[test_id]
+        rows.append(
+            {
+                "file": f"{test['athlete']} {test['test_date']} #{test_id}",
+                "stages": count,
+                "FTP": ftp,
+                "LT1": lt1,
+                "LT2": lt2,
+                "FATmax": fatmax,
+            }
+        )
+    return rows
+
+
+def peak_rss():
+    # Peak resident set size of this process in bytes, or None where the
+    # resource module is unavailable (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _to_float(value):
+    return float(value) if value is not None else None
+
+
+def run_batch(
+    paths,
+    workers=None,
+    chunksize=16,
+    progress=None,
+    report_dir=None,
+    on_results=None,
+    method="bands",
+    intervals=False,
+):
+    """
+    Compute thresholds for every file in ``paths`` on a process pool.
+
+    Files are scheduled in chunks of ``chunksize``, with at most two chunks
+    per worker in flight so memory stays bounded however many files there
+    are. If a worker process dies (e.g. a crash inside the Excel parser) the
+    files of the affected chunks are retried one by one in isolated pools, so
+    only the culprit is reported as failed. With ``report_dir`` a PDF report
+    is also written for every file (see report_paths()). Thresholds are calculated with
+    ``method`` (see thresholds.METHODS), and with ``intervals`` their
+    bootstrap confidence intervals are computed in the workers as well.
+
+    ``on_results`` is called with the successful rows of every finished
+    chunk; those rows also carry the parsed TestStore under "data", which
+    the callback is expected to pop.
+
+    Returns:
+        results (list): One dict per successfully processed file.
+        errors (list): One dict with "file" and "error" per failed file.
+    """
+
+    results = []
+    errors = []
+    done = 0
+
+    def collect(rows):
+        nonlocal done
+        succeeded = []
+        for row in rows:
+            if "error" in row:
+                errors.append(row)
+            else:
+                succeeded.append(row)
+        if on_results and succeeded:
+            on_results(succeeded)
+        results.extend(succeeded)
+        done += len(rows)
+        if progress:
+            progress(done, len(paths))
+
+    chunks = [paths[i : i + chunksize] for i in range(0, len(paths), chunksize)]
+    chunks.reverse()
+    quarantined = []
+    workers = workers or os.cpu_count() or 1
+    keep_data = on_results is not None
+    reports = {}
+    if report_dir is not None:
+        reports = dict(zip(paths, report_paths(paths, report_dir)))
+
+    with _executor(workers) as executor:
+        futures = {}
+        while chunks or futures:
+            while chunks and len(futures) < 2 * workers:
+                chunk = chunks.pop()
+                future = executor.submit(
+                    process_chunk,
+                    chunk,
+                    [reports.get(path) for path in chunk],
+                    keep_data,
+                    method,
+                    intervals,
+                )
+                futures[future] = chunk
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk = futures.pop(future)
+                try:
+                    collect(future.result())
+                except BrokenProcessPool:
+                    quarantined.extend(chunk)
+            if quarantined and chunks:
+                # The pool is unusable once a worker died; finish the
+                # remaining chunks in isolation as well
+                quarantined.extend(path for chunk in chunks for path in chunk)
+                chunks = []
+
+    for path in quarantined:
+        try:
+            with _executor(1) as executor:
+                future = executor.submit(
+                    process_file,
+                    path,
+                    reports.get(path),
+                    keep_data,
+                    method,
+                    intervals,
+                )
+                collect([future.result()])
+        except BrokenProcessPool:
+            name = path.name if isinstance(path, HistoryTest) else path
+            collect([{"file": name, "error": "worker process crashed", "rss": None}])
+
+    results.sort(key=lambda row: row["file"])
+    errors.sort(key=lambda row: row["file"])
+    return results, errors
+
+
+def _executor(workers):
+    if sys.version_info >= (3, 11):
+        return ProcessPoolExecutor(
+            max_workers=workers, max_tasks_per_child=MAX_TASKS_PER_WORKER
+        )
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def _format_bytes(size):
+    return f"{size / 2**20:.0f} MB" if size is not None else "n/a"
+
+
+def write_table(rows, file_path, columns):
+    import pandas as pd
+
+    df = pd.DataFrame(rows, columns=columns)
+    if file_path.lower().endswith((".xls", ".xlsx")):
+        df.to_excel(file_path, index=False)
+    else:
+        df.to_csv(file_path, index=False)
+
+
+def main(argv=None):
+    from thresholds import METHODS
+
+    parser = argparse.ArgumentParser(
+        description="Calculate FTP, LT1, LT2, and FATmax for many test files."
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="Directories or glob patterns of Excel test files"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="results.csv",
+        help="Consolidated results table (.csv or .xlsx)",
+    )
+    parser.add_argument(
+        "-e", "--errors", help="Write the per-file error report to this CSV file"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        type=int,
+        default=16,
+        help="Number of files handed to a worker at a time",
+    )
+    parser.add_argument(
+        "-r", "--reports", help="Also write one PDF report per test to this directory"
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        default="bands",
+        choices=METHODS,
+        help="Threshold method (default: bands)",
+    )
+    parser.add_argument(
+        "-i",
+        "--intervals",
+        action="store_true",
+        help="Also calculate bootstrap confidence intervals of the thresholds",
+    )
+    parser.add_argument(
+        "--history",
+        metavar="DB",
+        help="Also store every processed test in this history database",
+    )
+    parser.add_argument(
+        "--from-history",
+        metavar="DB",
+        help="Process the tests of this history database instead of files",
+    )
+    parser.add_argument(
+        "--rescore",
+        metavar="DB",
+        help="Recalculate the stored thresholds of the tests in this history "
+        "database with --method",
+    )
+    parser.add_argument(
+        "--athlete",
+        help="Athlete of the stored tests (default: the name of each file's "
+        "directory); with --from-history, only process this athlete's tests",
+    )
+    parser.add_argument(
+        "--since",
+        help="With --from-history or --rescore, only process tests from this "
+        "date (YYYY-MM-DD)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.chunksize < 1:
+        parser.error("--chunksize must be at least 1")
+
+    if args.rescore:
+        if args.inputs or args.history or args.from_history or args.reports:
+            parser.error("--rescore cannot be combined with input files or reports")
+        start = time.perf_counter()
+        results = rescore_history(args.rescore, args.method, args.athlete, args.since)
+        elapsed = time.perf_counter() - start
+        write_table(
+            results, args.output, ["file", "stages", "FTP", "LT1", "LT2", "FATmax"]
+        )
+        print(
+            f"Rescored {len(results)} tests with {args.method} in {elapsed:.2f} s. "
+            f"Results written to {args.output}",
+            file=sys.stderr,
+        )
+        return 0
+
+    if args.from_history:
+        if args.inputs or args.history:
+            parser.error("--from-history cannot be combined with input files")
+        paths = history_tests(args.from_history, args.athlete, args.since)
+    elif args.inputs:
+        paths = collect_files(args.inputs)
+    else:
+        parser.error("no input files given")
+    if not paths:
+        print("No test files found.", file=sys.stderr)
+        return 1
+
+    on_results = None
+    if args.history:
+        from history import HistoryStore
+
+        history = HistoryStore(args.history)
+
+        def on_results(rows):
+            save_to_history(history, rows, args.athlete, args.method)
+
+    def progress(done, total):
+        print(f"\rProcessed {done}/{total} files", end="", file=sys.stderr)
+
+    if args.reports:
+        os.makedirs(args.reports, exist_ok=True)
+
+    start = time.perf_counter()
+    results, errors = run_batch(
+        paths,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        progress=progress,
+        report_dir=args.reports,
+        on_results=on_results,
+        method=args.method,
+        intervals=args.intervals,
+    )
+    elapsed = time.perf_counter() - start
+    print(file=sys.stderr)
+
+    columns = ["file", "stages", *THRESHOLDS]
+    if args.intervals:
+        columns += [
+            f"{threshold}_{bound}"
+            for threshold in THRESHOLDS
+            for bound in ("low", "high")
+        ]
+    write_table(results, args.output, columns)
+    if args.errors:
+        write_table(errors, args.errors, ["file", "error"])
+
+    print(
+        f"{len(results)} succeeded, {len(errors)} failed in {elapsed:.1f} s. "
+        f"Results written to {args.output}",
+        file=sys.stderr,
+    )
+    if args.history:
+        history.close()
+        print(f"Stored {len(results)} tests in {args.history}", file=sys.stderr)
+    if args.reports:
+        worker_rss = [row["rss"] for row in results + errors if row.get("rss")]
+        print(
+            f"Wrote {len(results)} reports to {args.reports} "
+            f"({len(results) / elapsed:.1f} reports/s). Peak RSS: "
+            f"main process {_format_bytes(peak_rss())}, "
+            f"worker {_format_bytes(max(worker_rss, default=None))}",
+            file=sys.stderr,
+        )
+    for row in errors[:10]:
+        print(f"  {row['file']}: {row['error']}", file=sys.stderr)
+    if len(errors) > 10:
+        print(f"  ... and {len(errors) - 10} more", file=sys.stderr)
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Rows per synthetic test. 10 is a regular step test; the larger sizes are
+# 1 Hz continuous recordings.
+DEFAULT_SIZES = (10, 1_000, 10_000, 100_000)
+QUICK_SIZES = (10, 1_000)
+
+# Each benchmark is repeated until it has run this long and at least
+# MIN_REPEATS times, or MAX_REPEATS times. A call slower than LONG_SECONDS is
+# measured only once.
+MIN_SECONDS = 0.5
+MIN_REPEATS = 3
+MAX_REPEATS = 50
+LONG_SECONDS = 5.0
+
+# A benchmark counts as a regression when its median time grows by more
+# than this fraction compared to the baseline run
+DEFAULT_THRESHOLD = 0.10
+
+
+def synthetic_frame(size, seed=0):
+    from synthetic import generate_continuous, generate_test
+
+    if size <= 50:
+        return generate_test(stages=size, seed=seed)
+    return generate_continuous(samples=size, seed=seed)
+
+
+def load_store(df):
+    from store import TestStore
+
+    data = TestStore(capacity=max(len(df), 1))
+    data.extend_dataframe(df)
+    return data
+
+
+def benchmarks(size, directory):
+    """
+    The benchmarks for one test size as (name, setup) pairs.
+
+    ``setup()`` prepares the inputs and returns the function to time, so
+    file writing and parsing of inputs are not part of the measurement.
+    """
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import pandas as pd
+
+    df = synthetic_frame(size)
+    data = load_store(df)
+    excel_path = os.path.join(directory, f"test_{size}.xlsx")
+    csv_path = os.path.join(directory, f"test_{size}.csv")
+
+    def read_excel():
+        if not os.path.exists(excel_path):
+            df.to_excel(excel_path, index=False)
+        return lambda: load_store(pd.read_excel(excel_path))
+
+    def read_csv():
+        from store import TestStore
+
+        if not os.path.exists(csv_path):
+            df.to_csv(csv_path, index=False)
+        return lambda: TestStore().extend_csv(csv_path)
+
+    def thresholds():
+        from thresholds import calculate_ftp_lt1_lt2_fatmax
+
+        return lambda: calculate_ftp_lt1_lt2_fatmax(data["lactate"], data["power"])
+
+    def old_thresholds():
+        from thresholds import calculate_old_ftp_lt1_lt2_fatmax
+
+        return lambda: calculate_old_ftp_lt1_lt2_fatmax(data["lactate"], data["power"])
+
+    def render_figure():
+        from render import Renderer
+        from report import render_report_image
+        from thresholds import calculate_ftp_lt1_lt2_fatmax
+
+        # Without a cache, so every call draws the figure
+        renderer = Renderer(directory=None, memory_items=0)
+        results = calculate_ftp_lt1_lt2_fatmax(data["lactate"], data["power"])
+        return lambda: render_report_image(data, results, renderer)
+
+    def export_pdf():
+        from render import Renderer
+        from report import build_report, render_report_image
+        from thresholds import calculate_ftp_lt1_lt2_fatmax
+
+        results = calculate_ftp_lt1_lt2_fatmax(data["lactate"], data["power"])
+        image = render_report_image(data, results, Renderer(directory=None))
+        path = os.path.join(directory, f"report_{size}.pdf")
+        return lambda: build_report(path, results, image)
+
+    def export_csv():
+        path = os.path.join(directory, f"export_{size}.csv")
+        return lambda: data.to_dataframe().to_csv(path, index=False)
+
+    def export_excel():
+        path = os.path.join(directory, f"export_{size}.xlsx")
+        return lambda: data.to_dataframe().to_excel(path, index=False)
+
+    return [
+        ("read_excel", read_excel),
+        ("read_csv", read_csv),
+        ("thresholds", thresholds),
+        ("old_thresholds", old_thresholds),
+        ("render_figure", render_figure),
+        ("export_pdf", export_pdf),
+        ("export_csv", export_csv),
+        ("export_excel", export_excel),
+    ]
+
+
+def measure(function, min_seconds=MIN_SECONDS, max_repeats=MAX_REPEATS):
+    # Wall-clock times of repeated calls, in seconds. An untimed first call
+    # takes lazy imports, font loading and file caches out of the numbers.
+    start = time.perf_counter()
+    function()
+    if time.perf_counter() - start > LONG_SECONDS:
+        return [time.perf_counter() - start]
+
+    times = []
+    while len(times) < max_repeats and (
+        sum(times) < min_seconds or len(times) < MIN_REPEATS
+    ):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(sizes=DEFAULT_SIZES, only=None, progress=None, min_seconds=MIN_SECONDS):
+    """
+    Run the benchmark suite and return the results as a JSON-ready dict.
+
+    ``only`` restricts the run to the named benchmarks. ``progress`` is
+    called with every finished result.
+    """
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for name, setup in benchmarks(size, directory):
+                if only and name not in only:
+                    continue
+                times = measure(setup(), min_seconds)
+                result = {
+                    "name": name,
+                    "size": size,
+                    "repeats": len(times),
+                    "min": min(times),
+                    "median": statistics.median(times),
+                    "mean": statistics.fmean(times),
+                }
+                results.append(result)
+                if progress:
+                    progress(result)
+    return {"meta": environment(), "results": results}
+
+
+def environment():
+    import matplotlib
+    import numpy
+    import pandas
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            timeout=10,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "matplotlib": matplotlib.__version__,
+    }
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two runs benchmark by benchmark.
+
+    Returns one dict per benchmark present in both runs with the baseline
+    and current medians, their ratio, and whether it is a regression.
+    """
+
+    previous = {
+        (result["name"], result["size"]): result for result in baseline["results"]
+    }
+    rows = []
+    for result in current["results"]:
+        old = previous.get((result["name"], result["size"]))
+        if old is None:
+            continue
+        ratio = result["median"] / old["median"] if old["median"] else float("inf")
+        rows.append(
+            {
+                "name": result["name"],
+                "size": result["size"],
+                "baseline": old["median"],
+                "current": result["median"],
+                "ratio": ratio,
+                "regression": ratio > 1 + threshold,
+            }
+        )
+    return rows
+
+
+def _format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f} ms"
+    return f"{seconds:.2f} s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark LactateLab on synthetic lactate tests."
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="benchmark.json",
+        help="Write the results to this JSON file",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help=f"Rows per test (default: {' '.join(map(str, DEFAULT_SIZES))})",
+    )
+    parser.add_argument(
+        "-q",
+        "--quick",
+        action="store_true",
+        help=f"Only run the small sizes ({' '.join(map(str, QUICK_SIZES))})",
+    )
+    parser.add_argument(
+        "-b", "--only", nargs="+", help="Only run these benchmarks (e.g. read_excel)"
+    )
+    parser.add_argument(
+        "-c", "--compare", help="Compare the results with an earlier JSON file"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Slowdown counted as a regression (default: 0.10 for 10%%)",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=MIN_SECONDS,
+        help="Seconds to repeat each benchmark for",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+
+    def progress(result):
+        print(
+            f"{result['name']:<16}{result['size']:>9,} rows  "
+            f"{_format_seconds(result['median']):>10}  "
+            f"(min {_format_seconds(result['min'])}, {result['repeats']} runs)",
+            file=sys.stderr,
+        )
+
+    current = run(sizes, args.only, progress, args.min_time)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare, encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = compare(current, baseline, args.threshold)
+    print(f"\nCompared with {args.compare} ({baseline['meta'].get('commit')}):")
+    for row in rows:
+        marker = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['name']:<16}{row['size']:>9,} rows  "
+            f"{_format_seconds(row['baseline']):>10} -> "
+            f"{_format_seconds(row['current']):>10}  x{row['ratio']:.2f}{marker}"
+        )
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import time
+
+from store import COLUMNS
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", ".cache"
+)
+DEFAULT_MAX_BYTES = 256 * 2**20
+INDEX_FILE = "index.json"
+
+
+class SpreadsheetCache:
+    """
+    Content-addressed cache of parsed test spreadsheets.
+
+    Parsed columns are stored as uncompressed .npz files named after the
+    hash of the spreadsheet's content, so identical files share one entry.
+    The index remembers the size and mtime each path had when it was hashed;
+    while they are unchanged the file is not even re-read. Entries are
+    evicted least recently used first once the cache grows beyond
+    ``max_bytes``.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def read_excel(self, path):
+        import pandas as pd
+
+        path = os.path.abspath(path)
+        digest = self._digest(path)
+        entry = self._index["entries"].get(digest)
+        entry_path = self._entry_path(digest)
+
+        if entry is not None and os.path.exists(entry_path):
+            import numpy as np
+
+            with np.load(entry_path) as arrays:
+                df = pd.DataFrame({name: arrays[name] for name in entry["columns"]})
+            self.hits += 1
+            entry["last_used"] = time.time()
+            self._save_index()
+            return df
+
+        self.misses += 1
+        df = pd.read_excel(path)
+        self._store(digest, df)
+        return df
+
+    def stats(self):
+        entries = self._index["entries"]
+        return {
+            "directory": self.directory,
+            "entries": len(entries),
+            "bytes": sum(entry["bytes"] for entry in entries.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        for digest in list(self._index["entries"]):
+            self._remove(digest)
+        self._index["files"].clear()
+        self._save_index()
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        known = self._index["files"].get(path)
+        if (
+            known is not None
+            and known["size"] == stat.st_size
+            and known["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return known["digest"]
+
+        content_hash = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                content_hash.update(block)
+        digest = content_hash.hexdigest()
+        self._index["files"][path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "digest": digest,
+        }
+        return digest
+
+    def _store(self, digest, df):
+        import numpy as np
+        from pandas.api.types import is_numeric_dtype
+
+        # Only the test columns are kept; sheets with text in them are not
+        # cached so that loading reports the same errors as a fresh parse
+        headers = [header for _, header in COLUMNS.values() if header in df.columns]
+        if not headers or not all(is_numeric_dtype(df[header]) for header in headers):
+            self._save_index()
+            return
+
+        entry_path = self._entry_path(digest)
+        temporary_path = entry_path + ".tmp.npz"
+        np.savez(
+            temporary_path, **{header: df[header].to_numpy() for header in headers}
+        )
+        os.replace(temporary_path, entry_path)
+        self._index["entries"][digest] = {
+            "columns": headers,
+            "bytes": os.path.getsize(entry_path),
+            "last_used": time.time(),
+        }
+        self._evict()
+        self._save_index()
+
+    def _evict(self):
+        entries = self._index["entries"]
+        total = sum(entry["bytes"] for entry in entries.values())
+        for digest in sorted(entries, key=lambda digest: entries[digest]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entries[digest]["bytes"]
+            self._remove(digest)
+            self.evictions += 1
+
+    def _remove(self, digest):
+        del self._index["entries"][digest]
+        files = self._index["files"]
+        for path in [
+            path for path, known in files.items() if known["digest"] == digest
+        ]:
+            del files[path]
+        try:
+            os.remove(self._entry_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _entry_path(self, digest):
+        return os.path.join(self.directory, digest + ".npz")
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault("files", {})
+        index.setdefault("entries", {})
+        return index
+
+    def _save_index(self):
+        # Write atomically so a crash never leaves a truncated index
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(index_path + ".tmp", index_path)
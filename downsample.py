@@ -0,0 +1,104 @@
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """
+    Indices of ``threshold`` points of (x, y) chosen by
+    Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The points in between are
+    split into ``threshold - 2`` buckets, and from each bucket the point
+    forming the largest triangle with the previously chosen point and the
+    average of the next bucket is kept, which preserves peaks and the shape
+    of the line. Returns all indices when there are not more points than
+    ``threshold``.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # Bucket averages from prefix sums, so only the triangle areas are
+    # computed per bucket. Missing values do not count as large areas.
+    y = np.nan_to_num(y, nan=np.nanmean(y) if not np.isnan(y).all() else 0.0)
+    sum_x = np.concatenate(([0.0], np.cumsum(x)))
+    sum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = np.diff(edges)
+    average_x = np.append((sum_x[edges[1:]] - sum_x[edges[:-1]]) / counts, x[-1])
+    average_y = np.append((sum_y[edges[1:]] - sum_y[edges[:-1]]) / counts, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_x, next_y = average_x[bucket + 1], average_y[bucket + 1]
+        area = np.abs(
+            (x[a] - next_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (next_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+
+def downsample(x, y, threshold, keep=None, limits=None):
+    """
+    Indices of the points of (x, y) to draw at ``threshold`` points.
+
+    ``keep`` are indices that are always included exactly, e.g. the
+    measured stage points of a continuous recording. With ``limits`` (the
+    visible x range) only the points in that range, and one on either side
+    so lines run off the edges, are downsampled.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    start, stop = 0, len(x)
+    if limits is not None and len(x):
+        # x is increasing (stage or sample number)
+        low, high = sorted(limits)
+        start = max(int(np.searchsorted(x, low, side="left")) - 1, 0)
+        stop = min(int(np.searchsorted(x, high, side="right")) + 1, len(x))
+
+    selected = start + lttb(x[start:stop], np.asarray(y)[start:stop], threshold)
+    if keep is not None and len(keep):
+        keep = np.asarray(keep, dtype=np.int64)
+        selected = np.union1d(selected, keep[(keep >= start) & (keep < stop)])
+    return selected
+
+
+def stage_ends(stage):
+    # Index of the last sample of every stage
+    stage = np.asarray(stage)
+    if len(stage) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.append(stage[1:] != stage[:-1], True))
+
+
+def sample_points(stage, lactate):
+    """
+    Indices of the measured points of a test, which are drawn exactly and
+    carry the markers.
+
+    When stages span many rows (a continuous recording), the last row of
+    each stage is its measured point. When every row is its own stage, as in
+    files without a Stage column, the rows where lactate changes are the
+    samples, since lactate is only measured now and then. A test whose
+    lactate changes on most rows, e.g. a step test that happens to repeat a
+    value, has a sample on every row.
+    """
+
+    ends = stage_ends(stage)
+    if len(ends) < len(stage):
+        return ends
+    lactate = np.asarray(lactate, dtype=np.float64)
+    if len(lactate) == 0:
+        return ends
+    previous, current = lactate[:-1], lactate[1:]
+    changed = (current != previous) & ~(np.isnan(current) & np.isnan(previous))
+    samples = np.flatnonzero(np.concatenate(([True], changed)))
+    return ends if 2 * len(samples) > len(lactate) else samples
@@ -0,0 +1,289 @@
+import datetime
+import os
+import sqlite3
+
+DEFAULT_HISTORY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "history.sqlite3"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS athletes (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    athlete_id INTEGER NOT NULL REFERENCES athletes (id),
+    test_date TEXT NOT NULL,
+    protocol TEXT,
+    source TEXT,
+    method TEXT,
+    ftp REAL,
+    lt1 REAL,
+    lt2 REAL,
+    fatmax REAL
+);
+CREATE INDEX IF NOT EXISTS tests_athlete_date ON tests (athlete_id, test_date);
+CREATE INDEX IF NOT EXISTS tests_date ON tests (test_date);
+CREATE TABLE IF NOT EXISTS stages (
+    test_id INTEGER NOT NULL REFERENCES tests (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    stage INTEGER NOT NULL,
+    lactate REAL NOT NULL,
+    heart_rate INTEGER NOT NULL,
+    power INTEGER NOT NULL,
+    time REAL,
+    PRIMARY KEY (test_id, position)
+) WITHOUT ROWID;
+"""
+
+TEST_COLUMNS = (
+    "tests.id",
+    "athletes.name",
+    "tests.test_date",
+    "tests.protocol",
+    "tests.source",
+    "tests.method",
+    "tests.ftp",
+    "tests.lt1",
+    "tests.lt2",
+    "tests.fatmax",
+)
+
+
+class HistoryStore:
+    """
+    Embedded SQLite history of athletes, tests, their stages and thresholds.
+
+    Tests are indexed on (athlete, date), so looking up the previous test of
+    an athlete or all tests in a date range does not scan the table. Every
+    write runs in a single transaction, including bulk inserts.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(tests)")
+        ]
+        if "method" not in columns:
+            # Databases created before thresholds recorded their method
+            with self.connection:
+                self.connection.execute("ALTER TABLE tests ADD COLUMN method TEXT")
+
+    def close(self):
+        self.connection.close()
+
+    def add_test(
+        self,
+        athlete,
+        test_date,
+        data,
+        results,
+        protocol=None,
+        source=None,
+        method=None,
+    ):
+        # Store one test; returns its id
+        return self.add_tests(
+            [
+                {
+                    "athlete": athlete,
+                    "test_date": test_date,
+                    "data": data,
+                    "results": results,
+                    "protocol": protocol,
+                    "source": source,
+                    "method": method,
+                }
+            ]
+        )[0]
+
+    def add_tests(self, tests):
+        """
+        Store many tests in one transaction and return their ids.
+
+        Each test is a dict with "athlete", "test_date", "data" (a TestStore)
+        and "results" ((FTP, LT1, LT2, FATmax)), and optionally "protocol",
+        "source" and "method" (the threshold method of the results).
+        """
+
+        ids = []
+        with self.connection:
+            for test in tests:
+                data = test["data"]
+                cursor = self.connection.execute(
+                    "INSERT INTO tests (athlete_id, test_date, protocol, source, "
+                    "method, ftp, lt1, lt2, fatmax) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        self._athlete_id(test["athlete"]),
+                        _iso_date(test["test_date"]),
+                        test.get("protocol"),
+                        test.get("source"),
+                        test.get("method"),
+                        *[_to_float(value) for value in test["results"]],
+                    ),
+                )
+                test_id = cursor.lastrowid
+                self.connection.executemany(
+                    "INSERT INTO stages (test_id, position, stage, lactate, "
+                    "heart_rate, power, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    zip(
+                        [test_id] * len(data),
+                        range(len(data)),
+                        data["stage"].tolist(),
+                        data["lactate"].tolist(),
+                        data["heart_rate"].tolist(),
+                        data["power"].tolist(),
+                        [None if t != t else t for t in data["time"].tolist()],
+                    ),
+                )
+                ids.append(test_id)
+        return ids
+
+    def update_results(self, updates, method=None):
+        # Replace the thresholds of many tests: (test_id, (FTP, LT1, LT2, FATmax)),
+        # calculated with ``method``
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE tests SET method = ?, ftp = ?, lt1 = ?, lt2 = ?, fatmax = ? "
+                "WHERE id = ?",
+                (
+                    (method, *[_to_float(value) for value in results], test_id)
+                    for test_id, results in updates
+                ),
+            )
+
+    def delete_test(self, test_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM tests WHERE id = ?", (test_id,))
+
+    def athletes(self):
+        rows = self.connection.execute("SELECT name FROM athletes ORDER BY name")
+        return [name for (name,) in rows]
+
+    def tests(self, athlete=None, start=None, end=None):
+        # Test metadata and thresholds, oldest first. start and end are
+        # inclusive dates.
+        where, parameters = self._filter(athlete, start, end)
+        return self._query_tests(
+            f"{where} ORDER BY tests.test_date, tests.id", parameters
+        )
+
+    def stacked_stages(self, athlete=None, start=None, end=None):
+        """
+        Lactate and power of many tests as padded 2-D arrays.
+
+        Returns the test ids and two arrays with one test per row, padded at
+        the end with NaN, as expected by
+        thresholds.calculate_thresholds_batch(). All stages are read with one
+        query and scattered into the arrays without a per-test loop.
+        """
+
+        import numpy as np
+
+        where, parameters = self._filter(athlete, start, end)
+        rows = self.connection.execute(
+            "SELECT stages.test_id, stages.position, stages.lactate, stages.power "
+            "FROM stages JOIN tests ON tests.id = stages.test_id "
+            f"JOIN athletes ON athletes.id = tests.athlete_id {where} "
+            "ORDER BY stages.test_id, stages.position",
+            parameters,
+        ).fetchall()
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 4).T
+        test_ids, rows = np.unique(columns[0].astype(np.int64), return_inverse=True)
+        positions = columns[1].astype(np.int64)
+        width = positions.max() + 1 if len(positions) else 0
+
+        lactate = np.full((len(test_ids), width), np.nan)
+        power = np.full((len(test_ids), width), np.nan)
+        lactate[rows, positions] = columns[2]
+        power[rows, positions] = columns[3]
+        return test_ids.tolist(), lactate, power
+
+    def previous_test(self, athlete, before=None):
+        # The latest test of an athlete, or the latest one before a date
+        before = _iso_date(before or datetime.date.max)
+        tests = self._query_tests(
+            "WHERE athletes.name = ? AND tests.test_date < ? "
+            "ORDER BY tests.test_date DESC, tests.id DESC LIMIT 1",
+            (athlete, before),
+        )
+        return tests[0] if tests else None
+
+    def load_test(self, test_id, data=None):
+        """
+        Load the stages of a test into ``data`` (a new TestStore by default)
+        and return it.
+        """
+
+        import numpy as np
+        from store import TestStore
+
+        rows = self.connection.execute(
+            "SELECT lactate, heart_rate, power, stage, time FROM stages "
+            "WHERE test_id = ? ORDER BY position",
+            (test_id,),
+        ).fetchall()
+        columns = np.array(rows, dtype=np.float64).reshape(-1, 5).T
+        if data is None:
+            data = TestStore(capacity=max(len(rows), 1))
+        data.extend(
+            columns[0],
+            columns[1],
+            columns[2],
+            stage=columns[3],
+            time=columns[4],
+        )
+        return data
+
+    def _query_tests(self, clause, parameters):
+        rows = self.connection.execute(
+            f"SELECT {', '.join(TEST_COLUMNS)} FROM tests "
+            f"JOIN athletes ON athletes.id = tests.athlete_id {clause}",
+            parameters,
+        )
+        keys = [column.split(".")[1] for column in TEST_COLUMNS]
+        keys[1] = "athlete"
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _filter(self, athlete, start, end):
+        conditions = []
+        parameters = []
+        if athlete is not None:
+            conditions.append("athletes.name = ?")
+            parameters.append(athlete)
+        if start is not None:
+            conditions.append("tests.test_date >= ?")
+            parameters.append(_iso_date(start))
+        if end is not None:
+            conditions.append("tests.test_date <= ?")
+            parameters.append(_iso_date(end))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, parameters
+
+    def _athlete_id(self, name):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO athletes (name) VALUES (?)", (name,)
+        )
+        (athlete_id,) = self.connection.execute(
+            "SELECT id FROM athletes WHERE name = ?", (name,)
+        ).fetchone()
+        return athlete_id
+
+
+def _iso_date(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()[:10]
+    return datetime.date.fromisoformat(str(value)).isoformat()
+
+
+def _to_float(value):
+    return float(value) if value is not None else None
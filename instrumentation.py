@@ -0,0 +1,207 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+DEFAULT_LOG_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "logs"
+)
+LOG_FILE = "timings.jsonl"
+LOG_MAX_BYTES = 2**20
+LOG_BACKUPS = 3
+
+# Records kept in memory for the in-app panel
+RECENT_RECORDS = 200
+
+# Event-loop stall detection: the monitor expects to run every
+# STALL_INTERVAL_MS and records a stall when it runs more than
+# STALL_THRESHOLD_MS late
+STALL_INTERVAL_MS = 100
+STALL_THRESHOLD_MS = 200
+
+
+class Instrumentation:
+    """
+    Opt-in timing of the main GUI operations.
+
+    Every measured call records its wall time, CPU time of the calling
+    thread and row count, both in memory (for the panel) and as one JSON
+    line in a rotating log under ``log_dir``. While disabled, measuring
+    costs one attribute check. profile_next() runs the next measured action
+    under cProfile and saves the stats next to the log.
+    """
+
+    def __init__(self, log_dir=DEFAULT_LOG_DIR, enabled=False):
+        self.log_dir = log_dir
+        self.enabled = enabled
+        self.recent = deque(maxlen=RECENT_RECORDS)
+        self._profile_next = False
+        self._lock = threading.Lock()
+        self._logger = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def profile_next(self):
+        self._profile_next = True
+
+    def timed(self, action, rows=None):
+        # Decorator for methods; ``rows(self)`` gives the row count after
+        # the call
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(obj, *args, **kwargs):
+                if not self.enabled:
+                    return function(obj, *args, **kwargs)
+                with self.span(action) as record:
+                    result = function(obj, *args, **kwargs)
+                    if rows is not None:
+                        record["rows"] = rows(obj)
+                    return result
+
+            return wrapper
+
+        return decorator
+
+    @contextlib.contextmanager
+    def span(self, action, rows=None):
+        """
+        Measure the enclosed block as ``action``.
+
+        Yields the record dict, so the block can fill in "rows" or other
+        fields before it is logged.
+        """
+
+        record = {"action": action, "rows": rows}
+        if not self.enabled:
+            yield record
+            return
+
+        profile = None
+        if self._profile_next and threading.current_thread() is threading.main_thread():
+            self._profile_next = False
+            profile = cProfile.Profile()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+            record["wall_ms"] = (time.perf_counter() - wall_start) * 1000
+            record["cpu_ms"] = (time.thread_time() - cpu_start) * 1000
+            if profile is not None:
+                record["profile"] = self._save_profile(profile, action)
+            self.record(record)
+
+    def record(self, record):
+        # Store a finished record; also used for stalls and timings measured
+        # elsewhere
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            **record,
+        }
+        with self._lock:
+            self.recent.append(record)
+            self._get_logger().info(json.dumps(record))
+
+    def _get_logger(self):
+        if self._logger is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            logger = logging.getLogger("lactatelab.timings")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(
+                os.path.join(self.log_dir, LOG_FILE),
+                maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUPS,
+                encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def _save_profile(self, profile, action):
+        import io
+        import pstats
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.log_dir, f"profile-{action}-{stamp}.prof")
+        profile.dump_stats(path)
+
+        # A readable summary of the slowest functions next to the raw stats
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(30)
+        with open(path[: -len(".prof")] + ".txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+        return path
+
+
+class StallMonitor:
+    """
+    Detects Tk event-loop stalls.
+
+    A callback is scheduled every ``interval_ms``; when it runs more than
+    ``threshold_ms`` late, the main thread was busy for that long and a
+    "stall" record is added to the instrumentation.
+    """
+
+    def __init__(
+        self,
+        root,
+        instrumentation,
+        interval_ms=STALL_INTERVAL_MS,
+        threshold_ms=STALL_THRESHOLD_MS,
+    ):
+        self.root = root
+        self.instrumentation = instrumentation
+        self.interval_ms = interval_ms
+        self.threshold_ms = threshold_ms
+        self.stalls = 0
+        self.longest_ms = 0.0
+        self._expected = None
+        self._job = None
+
+    def start(self):
+        if self._job is None:
+            self._schedule()
+
+    def stop(self):
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+
+    def _schedule(self):
+        self._expected = time.perf_counter() + self.interval_ms / 1000
+        self._job = self.root.after(self.interval_ms, self._tick)
+
+    def _tick(self):
+        late_ms = (time.perf_counter() - self._expected) * 1000
+        if late_ms > self.threshold_ms and self.instrumentation.enabled:
+            self.stalls += 1
+            self.longest_ms = max(self.longest_ms, late_ms)
+            self.instrumentation.record({"action": "stall", "wall_ms": late_ms})
+        self._schedule()
+
+
+# Shared by the GUI and its decorators
+instrumentation = Instrumentation(
+    enabled=os.environ.get("LACTATELAB_INSTRUMENT", "") not in ("", "0")
+)
+timed = instrumentation.timed
+span = instrumentation.span
@@ -0,0 +1,349 @@
+import base64
+import functools
+import json
+import os
+import threading
+
+import numpy as np
+
+from store import COLUMNS
+
+DEFAULT_JOURNAL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "session.journal"
+)
+
+# Bumped when the record format changes; older journals are not replayed
+JOURNAL_VERSION = 1
+
+# Seconds between writes of pending records; each write is one fsync
+SYNC_INTERVAL = 0.5
+
+# The journal is compacted once it grows past this size and past twice the
+# size of a snapshot of the data
+COMPACT_BYTES = 1 * 2**20
+
+
+class Journal:
+    """
+    Append-only journal of the changes to the tests of a session.
+
+    Every change of an attached TestStore (appended rows, edited cells,
+    clears and loads) is queued as a record. A background thread encodes
+    the queued records as JSON lines, writes them every SYNC_INTERVAL
+    seconds and fsyncs once per write, so a crash loses at most the last
+    fraction of a second, and neither typing a test nor loading a long file
+    waits for the disk.
+
+    A store loaded from a session file (see TestStore.replace_columns()) is
+    journaled as a reference to the file with its size and modification
+    time, not as a copy of its rows, so opening a large session writes a
+    few bytes. Compactions keep the reference and the records that followed
+    it until the store is loaded from elsewhere.
+
+    On startup replay() rebuilds the stores from the journal. A torn last
+    line, as left by a crash in the middle of a write, ends the replay, as
+    does a session file that was changed or removed since it was opened.
+    Once the journal is more than twice the size of the data it describes,
+    it is compacted into one snapshot per store, written to a temporary
+    file and renamed over the journal.
+    """
+
+    def __init__(
+        self,
+        path=DEFAULT_JOURNAL_PATH,
+        sync_interval=SYNC_INTERVAL,
+        compact_bytes=COMPACT_BYTES,
+    ):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_bytes = compact_bytes
+        self.stores = {}
+        self.records = 0
+        self.syncs = 0
+        self.compactions = 0
+        # Records, or the list of records of a compacted journal, in order
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        # Estimated journal size including pending records
+        self._size = 0
+        # name -> [session record, records since] of the stores loaded from
+        # a session file
+        self._references = {}
+
+    def replay(self, stores):
+        """
+        Apply the journal to ``stores``, a dict of name -> TestStore.
+
+        Returns the number of records applied. Records of stores that are
+        not in ``stores`` are skipped.
+        """
+
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        with open(self.path, "r", encoding="utf-8") as file:
+            for number, line in enumerate(file):
+                try:
+                    record = json.loads(line)
+                    if number == 0:
+                        if record.get("version") != JOURNAL_VERSION:
+                            return 0
+                        continue
+                    store = stores.get(record["test"])
+                    if store is not None:
+                        record = _decode(record)
+                        _apply(store, record)
+                        applied += 1
+                        self._follow(record)
+                except (ValueError, KeyError, IndexError, TypeError, OSError):
+                    # Torn or damaged record; later ones depend on it
+                    break
+        return applied
+
+    def attach(self, stores):
+        """
+        Journal every change of ``stores`` (name -> TestStore) from now on.
+
+        The journal is first rewritten as a snapshot of the stores, which
+        also drops a journal that was not replayed.
+        """
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.stores = dict(stores)
+        for name, store in self.stores.items():
+            store.subscribe(functools.partial(self._on_change, name))
+        self.compact()
+        self.flush()
+        self._thread = threading.Thread(
+            target=self._run, name="session-journal", daemon=True
+        )
+        self._thread.start()
+
+    def compact(self):
+        # Replace the journal by one snapshot per store. The snapshot is
+        # taken now and written by the background thread with the records.
+        records = [{"version": JOURNAL_VERSION}]
+        for name, store in self.stores.items():
+            # A session reference is kept while it is smaller than a copy
+            references = self._references.get(name, [])
+            size = sum(_record_size(record) for record in references)
+            if not references or size > 100 + _rows_size(len(store)):
+                self._references.pop(name, None)
+                references = [_snapshot(name, store)]
+            records.extend(references)
+        with self._lock:
+            self._pending.append(records)
+            self._size = sum(_record_size(record) for record in records)
+        self.compactions += 1
+
+    def compact_if_needed(self):
+        live = sum(_rows_size(len(store)) for store in self.stores.values())
+        if self._size <= max(self.compact_bytes, 2 * live):
+            return False
+        self.compact()
+        return True
+
+    def flush(self):
+        # Write and fsync the pending records now
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._write_lock:
+            compacted = [
+                index for index, item in enumerate(pending) if isinstance(item, list)
+            ]
+            if compacted:
+                # Records before the last compaction are part of its snapshot
+                last = compacted[-1]
+                self._rewrite(pending[last])
+                pending = pending[last + 1 :]
+                if not pending:
+                    return
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write("".join(_encode(record) for record in pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.syncs += 1
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            "records": self.records,
+            "syncs": self.syncs,
+            "compactions": self.compactions,
+        }
+
+    def _on_change(self, name, event, *args):
+        store = self.stores[name]
+        if event == "append":
+            start, stop = args
+            record = {"test": name, "op": "append", "rows": _rows(store, start, stop)}
+        elif event == "set":
+            index, column = args
+            record = {
+                "test": name,
+                "op": "set",
+                "index": index,
+                "column": column,
+                "value": store[column][index].item(),
+            }
+        elif args and args[0] is not None:
+            path, test = args[0]
+            record = {
+                "test": name,
+                "op": "session",
+                "path": os.path.abspath(path),
+                "name": test,
+                "stamp": _stamp(path),
+            }
+        else:
+            record = _snapshot(name, store)
+        self._follow(record)
+        with self._lock:
+            self._pending.append(record)
+            self._size += _record_size(record)
+        self.records += 1
+        self.compact_if_needed()
+
+    def _follow(self, record):
+        # Keep the records of a store since it was loaded from a session
+        # file, which together describe it without copying the file
+        name = record["test"]
+        if record["op"] == "session":
+            self._references[name] = [record]
+        elif record["op"] == "snapshot":
+            self._references.pop(name, None)
+        elif name in self._references:
+            self._references[name].append(record)
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            self.flush()
+
+    def _rewrite(self, records):
+        # Atomically replace the journal file
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write("".join(_encode(record) for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        _sync_directory(os.path.dirname(self.path) or ".")
+
+
+def _encode(record):
+    # Columns are stored as base64 of their raw bytes: exact, and cheap to
+    # encode even for loads of many rows
+    if "rows" in record:
+        rows = {
+            name: base64.b64encode(values.tobytes()).decode("ascii")
+            for name, values in record["rows"].items()
+        }
+        record = {**record, "rows": rows}
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def _rows(store, start=0, stop=None):
+    # Copies, as the store's columns change before the record is written
+    stop = len(store) if stop is None else stop
+    return {name: store[name][start:stop].copy() for name in COLUMNS}
+
+
+def _rows_size(count):
+    # Encoded size of ``count`` rows
+    return sum(
+        4 * -(-count * np.dtype(dtype).itemsize // 3) for dtype, _ in COLUMNS.values()
+    )
+
+
+def _record_size(record):
+    rows = record.get("rows")
+    return 100 if rows is None else 100 + _rows_size(len(rows["lactate"]))
+
+
+def _decode(record):
+    # A record as read from the journal with its columns as arrays again
+    if "rows" not in record:
+        return record
+    rows = {
+        name: np.frombuffer(base64.b64decode(encoded), dtype=COLUMNS[name][0])
+        for name, encoded in record["rows"].items()
+    }
+    return {**record, "rows": rows}
+
+
+def _snapshot(name, store):
+    return {"test": name, "op": "snapshot", "rows": _rows(store)}
+
+
+def _apply(store, record):
+    op = record["op"]
+    if op == "set":
+        store.set_value(record["index"], record["column"], record["value"])
+        return
+    if op == "session":
+        from session import read_session
+
+        path = record["path"]
+        if _stamp(path) != record["stamp"]:
+            raise ValueError(f"Session file changed: {path}")
+        columns = read_session(path).columns[record["name"]]
+        store.replace_columns(columns, source=(path, record["name"]))
+        return
+    columns = record["rows"]
+    if op == "snapshot":
+        store.clear()
+    elif op != "append":
+        raise ValueError(f"Unknown journal record '{op}'")
+    if len(columns["lactate"]):
+        store.extend(
+            columns["lactate"],
+            columns["heart_rate"],
+            columns["power"],
+            stage=columns["stage"],
+            time=columns["time"],
+        )
+
+
+def _stamp(path):
+    # Size and modification time of a file, or None if it is missing
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _sync_directory(path):
+    # Make a rename durable; directories cannot be opened on Windows
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
@@ -1,19 +1,49 @@
-import os
-import tempfile
+import argparse
+import queue
+import threading
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import platform
 
+# Imported before the other modules of the app, so its start time does not
+# miss their imports. The NumPy-backed modules (store, thresholds, journal)
+# are imported once the window is shown, see create_stores().
+from preload import DATA_STEP, FIRST_PLOT_STEP, Preloader, StartupTimer
+from instrumentation import StallMonitor, instrumentation, span, timed
+from methods import DEFAULT_METHOD, METHODS
+from table import VirtualTable
+
+# How often queued samples from a live stream are moved into the table
+STREAM_POLL_INTERVAL_MS = 200
+
+TEST_FILE_TYPES = [
+    ("Test files", "*.xls *.xlsx *.csv *.csv.gz"),
+    ("Excel files", "*.xls *.xlsx"),
+    ("CSV files", "*.csv *.csv.gz"),
+]
+
 
 class LactateLab:
-    def __init__(self, root):
+    def __init__(self, root, preload=True, print_timings=False, restore_session=True):
         self.root = root
         self.root.title("LactateLab")
         self.root.geometry("2560x1600")
 
-        self.data = {"lactate": [], "heart_rate": [], "power": []}
+        # Heavy libraries are imported on a background thread once the
+        # window is up, so the first plot, upload or export does not stall
+        self.startup = StartupTimer()
+        self.print_timings = print_timings
+        self.preloader = Preloader(on_done=self.on_preload_done) if preload else None
+
+        # The tests are created by create_stores() once the window is shown
+        self.data = None
+        self.thresholds = None
         self.results = {"FTP": None, "LT1": None, "LT2": None, "FATmax": None}
-        self.old_data = {"lactate": [], "heart_rate": [], "power": []}
+        self.old_data = None
+        self.journal = None
+        self.restore_session = restore_session
+
+        self.create_menu()
 
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill=tk.BOTH, expand=True)
@@ -29,6 +59,210 @@ class LactateLab:
         self.editing_column = None
         self.entry = None
 
+        self.stream_reader = None
+
+        self.test_figure = None
+        self.comparison_figure = None
+        self.spreadsheet_cache = None
+
+        self.intervals = None
+        self.intervals_key = None
+        # (version, method) of the intervals being calculated, if any
+        self.intervals_pending = None
+
+        # Comparison results are recalculated only when either test (or the
+        # threshold method) changed; toggling the new test while nothing
+        # changed only flips artist visibility
+        self.comparison_dirty = True
+        self.comparison_key = None
+        self.comparison_results = None
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        self.stall_monitor = StallMonitor(self.root, instrumentation)
+        if instrumentation.enabled:
+            self.stall_monitor.start()
+        self.performance_panel = None
+
+        self.root.after(0, self.on_window_shown)
+
+        self.history = None
+        self.athlete = None
+        self.test_date = None
+
+        # (label, TestStore) of every test in the overlay window
+        self.overlay_tests = []
+        self.overlay_window = None
+        self.overlay_figure = None
+        self.overlay_table = None
+
+    def create_menu(self):
+        menubar = tk.Menu(self.root)
+        self.root.config(menu=menubar)
+
+        file_menu = tk.Menu(menubar, tearoff=False)
+        menubar.add_cascade(label="File", menu=file_menu)
+        file_menu.add_command(label="Open Session...", command=self.open_session)
+        file_menu.add_command(label="Save Session...", command=self.save_session)
+
+        self.tools_menu = tk.Menu(menubar, tearoff=False)
+        menubar.add_cascade(label="Tools", menu=self.tools_menu)
+        self.tools_menu.add_command(
+            label="Spreadsheet Cache Stats", command=self.show_cache_stats
+        )
+        self.tools_menu.add_command(
+            label="Clear Spreadsheet Cache", command=self.clear_cache
+        )
+        self.tools_menu.add_command(
+            label="Render Cache Stats", command=self.show_render_cache_stats
+        )
+        self.tools_menu.add_command(
+            label="Clear Render Cache", command=self.clear_render_cache
+        )
+        self.tools_menu.add_separator()
+        self.tools_menu.add_command(
+            label="Startup Timings", command=self.show_startup_timings
+        )
+        self.tools_menu.add_command(
+            label="Performance Panel", command=self.show_performance_panel
+        )
+
+    def on_close(self):
+        self.stop_stream()
+        if self.journal is not None:
+            self.journal.close()
+        self.root.destroy()
+
+    def on_window_shown(self):
+        self.root.update_idletasks()
+        self.startup.mark("window shown")
+        if self.preloader is not None:
+            self.preloader.start()
+        self.create_stores()
+        self.startup.mark("session restored")
+        if self.preloader is None and self.print_timings:
+            self.startup.print_report()
+
+    def create_stores(self):
+        # NumPy is imported here, after the window is up, by the preloading
+        # thread when there is one
+        self.wait_for_preload(DATA_STEP)
+        from journal import Journal
+        from store import TestStore
+        from thresholds import IncrementalThresholds
+
+        self.data = TestStore()
+        # Follows every append/edit of self.data so results are never
+        # recomputed from scratch
+        self.thresholds = IncrementalThresholds(self.data)
+        self.old_data = TestStore()
+        self.tree.store = self.data
+        self.old_tree.store = self.old_data
+        self.data.subscribe(self.on_comparison_data_changed)
+        self.old_data.subscribe(self.on_comparison_data_changed)
+
+        # Every change of both tests is journaled to disk, so a crash or a
+        # closed window does not lose the session; it is restored on start
+        self.journal = Journal()
+        stores = {"new": self.data, "old": self.old_data}
+        if self.restore_session:
+            self.journal.replay(stores)
+        self.tree.refresh()
+        self.old_tree.refresh()
+        self.journal.attach(stores)
+
+    def on_preload_done(self):
+        # Runs on the preloading thread
+        for name, _, finished in self.preloader.timings:
+            if name == FIRST_PLOT_STEP:
+                self.startup.mark("first plot possible", finished)
+        if self.print_timings:
+            self.startup.print_report(self.preloader)
+
+    def show_performance_panel(self):
+        # Recent timings and event-loop stalls, refreshed while the panel is
+        # open
+        if self.performance_panel is not None:
+            self.performance_panel.lift()
+            return
+
+        panel = tk.Toplevel(self.root)
+        panel.title("Performance")
+        self.performance_panel = panel
+
+        controls = ttk.Frame(panel)
+        controls.pack(fill=tk.X, padx=10, pady=5)
+        enabled_var = tk.BooleanVar(value=instrumentation.enabled)
+
+        def toggle():
+            instrumentation.enable(enabled_var.get())
+            if enabled_var.get():
+                self.stall_monitor.start()
+            else:
+                self.stall_monitor.stop()
+
+        ttk.Checkbutton(
+            controls, text="Record timings", variable=enabled_var, command=toggle
+        ).pack(side=tk.LEFT, padx=5)
+        ttk.Button(
+            controls, text="Profile Next Action", command=instrumentation.profile_next
+        ).pack(side=tk.LEFT, padx=5)
+        stalls_label = ttk.Label(controls)
+        stalls_label.pack(side=tk.LEFT, padx=15)
+
+        columns = ("time", "action", "wall", "cpu", "rows")
+        tree = ttk.Treeview(panel, columns=columns, show="headings", height=20)
+        for column, heading, width in zip(
+            columns,
+            ("Time", "Action", "Wall (ms)", "CPU (ms)", "Rows"),
+            (110, 200, 90, 90, 80),
+        ):
+            tree.heading(column, text=heading)
+            tree.column(column, width=width, anchor="w" if column == "action" else "e")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        ttk.Label(panel, text=f"Log: {instrumentation.log_dir}").pack(
+            padx=10, pady=(0, 5), anchor="w"
+        )
+
+        def refresh():
+            if self.performance_panel is not panel:
+                return
+            tree.delete(*tree.get_children())
+            for record in reversed(instrumentation.recent):
+                tree.insert(
+                    "",
+                    tk.END,
+                    values=(
+                        record["time"][11:],
+                        record["action"] + (" (error)" if "error" in record else ""),
+                        f"{record['wall_ms']:.1f}",
+                        f"{record['cpu_ms']:.1f}" if "cpu_ms" in record else "",
+                        record.get("rows") if record.get("rows") is not None else "",
+                    ),
+                )
+            stalls_label.config(
+                text=f"Event-loop stalls: {self.stall_monitor.stalls} "
+                f"(longest {self.stall_monitor.longest_ms:.0f} ms)"
+            )
+            panel.after(1000, refresh)
+
+        def close():
+            self.performance_panel = None
+            panel.destroy()
+
+        panel.protocol("WM_DELETE_WINDOW", close)
+        refresh()
+
+    def wait_for_preload(self, step):
+        # Block until the preloading thread has done ``step`` rather than
+        # importing the same modules concurrently with it
+        if self.preloader is not None:
+            self.preloader.wait(step)
+
+    def show_startup_timings(self):
+        messagebox.showinfo("Startup Timings", self.startup.report(self.preloader))
+
     def create_data_input_tab(self):
         self.data_input_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.data_input_frame, text="Data Input")
@@ -61,9 +295,22 @@ class LactateLab:
             column=1, row=2, padx=5, pady=5, sticky="ew"
         )
 
+        ttk.Label(input_frame, text="Threshold Method:").grid(
+            column=0, row=3, padx=5, pady=5, sticky="w"
+        )
+        self.method_var = tk.StringVar(value=METHODS[DEFAULT_METHOD])
+        method_box = ttk.Combobox(
+            input_frame,
+            textvariable=self.method_var,
+            values=list(METHODS.values()),
+            state="readonly",
+        )
+        method_box.grid(column=1, row=3, padx=5, pady=5, sticky="ew")
+        method_box.bind("<<ComboboxSelected>>", self.on_method_selected)
+
         button_frame = ttk.Frame(self.data_input_frame)
         button_frame.grid(row=1, column=0, sticky="ew", padx=10, pady=5)
-        button_frame.columnconfigure((0, 1, 2, 3, 4, 5), weight=1)
+        button_frame.columnconfigure((0, 1, 2, 3, 4, 5, 6, 7), weight=1)
 
         ttk.Button(button_frame, text="Add Data", command=self.add_data).grid(
             row=0, column=0, padx=5, pady=5, sticky="ew"
@@ -71,9 +318,9 @@ class LactateLab:
         ttk.Button(button_frame, text="Plot Data", command=self.plot_data).grid(
             row=0, column=1, padx=5, pady=5, sticky="ew"
         )
-        ttk.Button(button_frame, text="Upload Excel", command=self.upload_excel).grid(
-            row=0, column=2, padx=5, pady=5, sticky="ew"
-        )
+        ttk.Button(
+            button_frame, text="Upload Excel/CSV", command=self.upload_excel
+        ).grid(row=0, column=2, padx=5, pady=5, sticky="ew")
         ttk.Button(button_frame, text="Clear Data", command=self.clear_data).grid(
             row=0, column=3, padx=5, pady=5, sticky="ew"
         )
@@ -83,6 +330,13 @@ class LactateLab:
         ttk.Button(button_frame, text="Calculate All", command=self.calculate_all).grid(
             row=0, column=5, padx=5, pady=5, sticky="ew"
         )
+        self.stream_button = ttk.Button(
+            button_frame, text="Start Stream", command=self.toggle_stream
+        )
+        self.stream_button.grid(row=0, column=6, padx=5, pady=5, sticky="ew")
+        ttk.Button(
+            button_frame, text="Import Ride File", command=self.import_ride_file
+        ).grid(row=0, column=7, padx=5, pady=5, sticky="ew")
 
         # Labels for FTP, LT1, LT2, and FATmax results
         self.ftp_label = ttk.Label(self.data_input_frame, text="FTP: Not Calculated")
@@ -99,23 +353,12 @@ class LactateLab:
         )
         self.fatmax_label.grid(row=5, column=0, padx=10, pady=5, sticky="w")
 
-        self.tree = ttk.Treeview(
-            self.data_input_frame,
-            columns=("Lactate", "Heart Rate", "Power"),
-            show="headings",
-        )
-        self.tree.heading("Lactate", text="Lactate (mmol/L)")
-        self.tree.heading("Heart Rate", text="Heart Rate (bpm)")
-        self.tree.heading("Power", text="Power (W)")
+        # Only the visible rows are Treeview items; they are filled from
+        # self.data as the table scrolls
+        self.tree = VirtualTable(self.data_input_frame, self.data)
         self.tree.grid(row=6, column=0, sticky="nsew", padx=10, pady=5)
-        self.tree.bind("<Double-1>", self.on_double_click)
-        self.tree.bind("<Return>", self.on_enter_key)
-
-        tree_scroll = ttk.Scrollbar(
-            self.data_input_frame, orient="vertical", command=self.tree.yview
-        )
-        self.tree.configure(yscroll=tree_scroll.set)
-        tree_scroll.grid(row=6, column=1, sticky="ns")
+        self.tree.treeview.bind("<Double-1>", self.on_double_click)
+        self.tree.treeview.bind("<Return>", self.on_enter_key)
 
         # Adjust the row/column configurations for resizing
         self.data_input_frame.rowconfigure(6, weight=1)
@@ -131,6 +374,11 @@ class LactateLab:
             text="Export Table to Excel",
             command=self.export_to_excel,
         ).grid(row=8, column=0, padx=5, pady=5, sticky="ew")
+        ttk.Button(
+            self.data_input_frame,
+            text="Export Workbook (Tests, Thresholds, Progress)",
+            command=self.export_workbook,
+        ).grid(row=9, column=0, padx=5, pady=5, sticky="ew")
 
     def create_compare_tab(self):
         # Tab for comparing tests
@@ -153,25 +401,22 @@ class LactateLab:
             button_frame,
             text="Show New Test",
             variable=self.show_new_test_var,
-            command=self.compare_tests,
+            command=self.toggle_new_test,
         )
         show_new_test_checkbox.grid(row=0, column=2, padx=5, pady=5, sticky="ew")
 
-        self.old_tree = ttk.Treeview(
-            self.compare_frame,
-            columns=("Lactate", "Heart Rate", "Power"),
-            show="headings",
-        )
-        self.old_tree.heading("Lactate", text="Lactate (mmol/L)")
-        self.old_tree.heading("Heart Rate", text="Heart Rate (bpm)")
-        self.old_tree.heading("Power", text="Power (W)")
-        self.old_tree.grid(row=1, column=0, sticky="nsew", padx=10, pady=5)
+        ttk.Button(
+            button_frame, text="Save to History", command=self.save_to_history
+        ).grid(row=0, column=3, padx=5, pady=5, sticky="ew")
+        ttk.Button(
+            button_frame, text="Load Previous Test", command=self.load_previous_test
+        ).grid(row=0, column=4, padx=5, pady=5, sticky="ew")
+        ttk.Button(
+            button_frame, text="Overlay Tests", command=self.show_overlay_window
+        ).grid(row=0, column=5, padx=5, pady=5, sticky="ew")
 
-        tree_scroll = ttk.Scrollbar(
-            self.compare_frame, orient="vertical", command=self.old_tree.yview
-        )
-        self.old_tree.configure(yscroll=tree_scroll.set)
-        tree_scroll.grid(row=1, column=1, sticky="ns")
+        self.old_tree = VirtualTable(self.compare_frame, self.old_data)
+        self.old_tree.grid(row=1, column=0, sticky="nsew", padx=10, pady=5)
 
         self.compare_frame.rowconfigure(1, weight=1)
         self.compare_frame.columnconfigure(0, weight=1)
@@ -265,17 +510,20 @@ class LactateLab:
             self.add_data()
 
     def on_double_click(self, event):
-        # Start editing a cell on double-click
-        item = self.tree.selection()[0]
-        column = self.tree.identify_column(event.x)
-        row = self.tree.identify_row(event.y)
-        self.editing_index = int(self.tree.index(item))
+        # Start editing a cell on double-click. The table only holds the
+        # visible rows, so the edit is tracked by absolute row index.
+        column = self.tree.treeview.identify_column(event.x)
+        index = self.tree.index_at(event.y)
+        if index is None:
+            return
+        self.cancel_edit()
+        self.editing_index = index
         self.editing_column = int(column[1:]) - 1
-        value = self.tree.item(item, "values")[self.editing_column]
+        value = self.data.row(index)[self.editing_column]
 
         # Positioning the Entry widget over the cell
-        x, y, width, height = self.tree.bbox(item, column)
-        self.entry = tk.Entry(self.tree, width=width)
+        x, y, width, height = self.tree.bbox(index, column)
+        self.entry = tk.Entry(self.tree.treeview, width=width)
         self.entry.insert(0, value)
         self.entry.place(x=x, y=y, width=width, height=height)
         self.entry.focus()
@@ -290,21 +538,14 @@ class LactateLab:
         try:
             if self.editing_column == 0:
                 new_value = float(new_value)
-                self.data["lactate"][self.editing_index] = new_value
+                self.data.set_value(self.editing_index, "lactate", new_value)
             elif self.editing_column == 1:
                 new_value = int(new_value)
-                self.data["heart_rate"][self.editing_index] = new_value
+                self.data.set_value(self.editing_index, "heart_rate", new_value)
             elif self.editing_column == 2:
                 new_value = int(new_value)
-                self.data["power"][self.editing_index] = new_value
-            self.tree.item(
-                self.tree.selection()[0],
-                values=(
-                    self.data["lactate"][self.editing_index],
-                    self.data["heart_rate"][self.editing_index],
-                    self.data["power"][self.editing_index],
-                ),
-            )
+                self.data.set_value(self.editing_index, "power", new_value)
+            self.tree.refresh_row(self.editing_index)
         except ValueError:
             messagebox.showerror("Invalid input", "Please enter a valid number.")
         finally:
@@ -329,11 +570,10 @@ class LactateLab:
                 heart_rate = int(heart_rate)
                 power = int(power)
 
-                self.data["lactate"].append(lactate)
-                self.data["heart_rate"].append(heart_rate)
-                self.data["power"].append(power)
+                self.data.append(lactate, heart_rate, power)
 
-                self.tree.insert("", "end", values=(lactate, heart_rate, power))
+                self.tree.refresh()
+                self.refresh_test_figure()
 
                 # Clear input fields
                 self.lactate_var.set("")
@@ -345,41 +585,235 @@ class LactateLab:
                 )
 
     def upload_excel(self):
-        import pandas as pd
+        # Upload data from an Excel or CSV file
+        file_path = filedialog.askopenfilename(filetypes=TEST_FILE_TYPES)
+        if file_path:
+            try:
+                with span("upload_excel") as record:
+                    self.read_test_file(file_path, self.data)
+                    self.tree.refresh()
+                    record["rows"] = len(self.data)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load file: {e}")
+
+    def read_test_file(self, file_path, data):
+        # CSV files are streamed into the store in chunks; spreadsheets go
+        # through the parsed-spreadsheet cache
+        if file_path.lower().endswith((".csv", ".csv.gz")):
+            self.wait_for_preload("pandas")
+            with span("load_data_from_csv") as record:
+                start = data.extend_csv(file_path)
+                record["rows"] = len(data) - start
+        else:
+            df = self.get_spreadsheet_cache().read_excel(file_path)
+            with span("load_data_from_dataframe", rows=len(df)):
+                data.extend_dataframe(df)
+
+    def import_ride_file(self):
+        # Stages of a head-unit recording, with lactate entered by the time
+        # it was drawn
+        import ridefile
 
-        # Upload data from an Excel file
         file_path = filedialog.askopenfilename(
-            filetypes=[("Excel files", "*.xls *.xlsx")]
+            filetypes=[
+                ("Ride files", "*.fit *.tcx *.csv *.fit.gz *.tcx.gz *.csv.gz"),
+                ("All files", "*.*"),
+            ]
         )
-        if file_path:
+        if not file_path:
+            return
+        try:
+            with span("import_ride_file") as record:
+                ride = ridefile.load_ride(file_path)
+                starts, stops = ridefile.detect_stages(ride["time"], ride["power"])
+                record["rows"] = len(ride["time"])
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read the ride file: {e}")
+            return
+        if len(starts) == 0:
+            messagebox.showerror("Error", "No stages found in the ride file.")
+            return
+
+        power, heart_rate, end_time = ridefile.stage_means(
+            ride["time"], ride["power"], ride["heart_rate"], starts, stops
+        )
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Import Ride File")
+        dialog.transient(self.root)
+
+        columns = ("stage", "start", "end", "power", "heart_rate")
+        stages = ttk.Treeview(
+            dialog, columns=columns, show="headings", height=min(len(starts), 15)
+        )
+        for column, heading in zip(
+            columns, ("Stage", "Start", "End", "Power (W)", "Heart Rate (bpm)")
+        ):
+            stages.heading(column, text=heading)
+            stages.column(column, width=110, anchor="e")
+        for number, (start, stop) in enumerate(zip(starts, stops), start=1):
+            stages.insert(
+                "",
+                tk.END,
+                values=(
+                    number,
+                    _format_clock(ride["time"][start]),
+                    _format_clock(end_time[number - 1]),
+                    f"{power[number - 1]:.0f}",
+                    f"{heart_rate[number - 1]:.0f}",
+                ),
+            )
+        stages.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+
+        ttk.Label(
+            dialog,
+            text="Lactate samples, one per line as <time> <mmol/L>, the time "
+            "as mm:ss since the start of the ride. Each sample is matched to "
+            "the stage ending nearest to it.",
+            wraplength=550,
+        ).pack(padx=10, pady=5, anchor="w")
+        entries = tk.Text(dialog, height=8, width=40)
+        entries.insert(
+            "1.0",
+            "\n".join(f"{_format_clock(end)} " for end in end_time),
+        )
+        entries.pack(fill=tk.X, padx=10, pady=5)
+
+        def add():
             try:
-                df = pd.read_excel(file_path)
-                self.load_data_from_dataframe(df)
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load Excel file: {e}")
-
-    def load_data_from_dataframe(self, df):
-        # Load data from a DataFrame
-        for _, row in df.iterrows():
-            lactate = row["Lactate"]
-            heart_rate = row["Heart Rate"]
-            power = row["Power"]
-            self.data["lactate"].append(lactate)
-            self.data["heart_rate"].append(heart_rate)
-            self.data["power"].append(power)
-            self.tree.insert("", "end", values=(lactate, heart_rate, power))
+                times, values = ridefile.parse_lactate_entries(
+                    "\n".join(
+                        line
+                        for line in entries.get("1.0", tk.END).splitlines()
+                        if len(line.split()) > 1
+                    )
+                )
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=dialog)
+                return
+            count = len(self.data)
+            ridefile.import_ride(ride, starts, stops, times, values, self.data)
+            self.tree.refresh()
+            dialog.destroy()
+            messagebox.showinfo(
+                "Imported", f"Added {len(self.data) - count} stages with lactate."
+            )
+
+        ttk.Button(dialog, text="Add Stages", command=add).pack(padx=10, pady=10)
+
+    def get_spreadsheet_cache(self):
+        if self.spreadsheet_cache is None:
+            self.wait_for_preload("cache")
+            from cache import SpreadsheetCache
+
+            self.spreadsheet_cache = SpreadsheetCache()
+        return self.spreadsheet_cache
+
+    def show_cache_stats(self):
+        stats = self.get_spreadsheet_cache().stats()
+        messagebox.showinfo(
+            "Spreadsheet Cache",
+            f"Location: {stats['directory']}\n"
+            f"Entries: {stats['entries']}\n"
+            f"Size: {stats['bytes'] / 2**20:.1f} of "
+            f"{stats['max_bytes'] / 2**20:.0f} MB\n"
+            f"Hits this session: {stats['hits']}\n"
+            f"Misses this session: {stats['misses']}\n"
+            f"Evictions this session: {stats['evictions']}",
+        )
+
+    def clear_cache(self):
+        self.get_spreadsheet_cache().clear()
+
+    def show_render_cache_stats(self):
+        from render import default_renderer
+
+        stats = default_renderer().stats()
+        messagebox.showinfo(
+            "Render Cache",
+            f"Location: {stats['directory']}\n"
+            f"Entries: {stats['entries']}\n"
+            f"Size: {stats['bytes'] / 2**20:.1f} of "
+            f"{stats['max_bytes'] / 2**20:.0f} MB\n"
+            f"Hits this session: {stats['hits']}\n"
+            f"Misses this session: {stats['misses']}\n"
+            f"Evictions this session: {stats['evictions']}",
+        )
+
+    def clear_render_cache(self):
+        from render import default_renderer
+
+        default_renderer().clear()
+
+    def toggle_stream(self):
+        if self.stream_reader:
+            self.stop_stream()
+        else:
+            self.start_stream()
+
+    def start_stream(self):
+        from streaming import StreamReader, open_source
+
+        # Read live samples from a socket, serial device or replayed file
+        spec = simpledialog.askstring(
+            "Live Stream",
+            "Source (file:PATH, tcp:HOST:PORT or serial:DEVICE[:BAUD]):",
+            parent=self.root,
+        )
+        if not spec:
+            return
+        try:
+            source = open_source(spec)
+        except ValueError as e:
+            messagebox.showerror("Error", f"Failed to open stream: {e}")
+            return
+
+        self.stream_reader = StreamReader(source).start()
+        self.stream_button.config(text="Stop Stream")
+        self.root.after(STREAM_POLL_INTERVAL_MS, self.poll_stream)
+
+    def stop_stream(self):
+        if self.stream_reader:
+            self.stream_reader.stop()
+            self.stream_reader = None
+        self.stream_button.config(text="Start Stream")
+
+    def poll_stream(self):
+        # Move the samples queued by the reader thread into the data store in
+        # one batch, then refresh the table once
+        reader = self.stream_reader
+        if reader is None:
+            return
+
+        samples = reader.drain()
+        if samples:
+            lactate, heart_rate, power, times = zip(*samples)
+            self.data.extend(lactate, heart_rate, power, time=times)
+            self.tree.see(len(self.data) - 1)
+            self.refresh_test_figure()
+
+        if reader.finished.is_set() and reader.samples.empty():
+            errors = list(reader.errors.queue)
+            self.stop_stream()
+            if errors:
+                messagebox.showwarning(
+                    "Stream ended",
+                    f"{len(errors)} line(s) could not be read. First error: "
+                    f"{errors[0]}",
+                )
+            return
+        self.root.after(STREAM_POLL_INTERVAL_MS, self.poll_stream)
 
     def clear_data(self):
         # Clear all data
-        for key in self.data:
-            self.data[key].clear()
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self.data.clear()
+        self.tree.refresh()
         self.ftp_label.config(text="FTP: Not Calculated")
         self.lt1_label.config(text="LT1: Not Calculated")
         self.lt2_label.config(text="LT2: Not Calculated")
         self.fatmax_label.config(text="FATmax: Not Calculated")
 
+    @timed("calculate_all", rows=lambda self: len(self.data))
     def calculate_all(self):
         ftp, lt1, lt2, fatmax = self.calculate_ftp_lt1_lt2_fatmax()
 
@@ -389,375 +823,414 @@ class LactateLab:
         self.results["LT2"] = lt2
         self.results["FATmax"] = fatmax
 
-        # Update the labels with the calculated results
-        self.ftp_label.config(
-            text=(
-                f"FTP: {
-                ftp:.2f} W"
-                if ftp is not None
-                else "FTP: Not Calculated"
-            )
-        )
-        self.lt1_label.config(
-            text=(
-                f"LT1: {
-                lt1:.2f} W"
-                if lt1 is not None
-                else "LT1: Not Calculated"
-            )
-        )
-        self.lt2_label.config(
-            text=(
-                f"LT2: {
-                lt2:.2f} W"
-                if lt2 is not None
-                else "LT2: Not Calculated"
-            )
-        )
-        self.fatmax_label.config(
-            text=(
-                f"FATmax: {
-                fatmax:.2f} W"
-                if fatmax is not None
-                else "FATmax: Not Calculated"
+        self.update_intervals()
+
+    def show_results(self, intervals):
+        # Update the labels with the calculated results and their
+        # bootstrap confidence intervals (None while they are calculated)
+        from report import format_interval
+
+        labels = (self.ftp_label, self.lt1_label, self.lt2_label, self.fatmax_label)
+        for label, (name, value), interval in zip(
+            labels, self.results.items(), intervals
+        ):
+            label.config(
+                text=(
+                    f"{name}: {value:.2f} W{format_interval(interval)}"
+                    if value is not None
+                    else f"{name}: Not Calculated"
+                )
             )
-        )
 
     def calculate_ftp_lt1_lt2_fatmax(self):
-        import numpy as np
-
-        """
-        Calculate FTP, LT1, LT2, and FATmax based on lactate and power data.
-
-        Returns:
-            ftp_power (float): Estimated Functional Threshold Power (FTP).
-            lt1_power (float): Power at the first lactate threshold (LT1).
-            lt2_power (float): Power at the second lactate threshold (LT2).
-            fatmax_power (float): Power at which fat oxidation is maximized (Fatmax).
-        """
-
-        lactate = np.array(self.data["lactate"])
-        power = np.array(self.data["power"])
-
-        if len(lactate) < 4:
+        if len(self.data["lactate"]) < 4:
             messagebox.showerror(
                 "Insufficient data",
                 "Please add more data points to calculate FTP, LT1, LT2, and FATmax.",
             )
             return None, None, None, None
 
-        # Find LT1: the first significant rise in lactate within 1.5-2.0 mmol/L
-        lt1_index = np.argmax((lactate[1:] >= 1.5) & (lactate[1:] <= 2.0)) + 1
-        lt1_power = power[lt1_index] if lt1_index > 0 else None
-
-        # Find LT2: the next significant rise in lactate within 3.0-6.0 mmol/L
-        # after LT1
-        lt2_index = (
-            np.argmax(
-                (lactate[lt1_index + 1 :] >= 3.0) & (lactate[lt1_index + 1 :] <= 6.0)
-            )
-            + lt1_index
-            + 1
+        return self.threshold_results()
+
+    def threshold_method(self):
+        description = self.method_var.get()
+        return next(name for name, text in METHODS.items() if text == description)
+
+    def threshold_results(self):
+        # The fixed-band method follows the store incrementally; the curve
+        # fits are recalculated from the whole test
+        method = self.threshold_method()
+        if method == DEFAULT_METHOD:
+            return self.thresholds.results()
+        from thresholds import calculate_thresholds
+
+        return calculate_thresholds(self.data["lactate"], self.data["power"], method)
+
+    def update_intervals(self):
+        # Resampling is the expensive part of calculate_all(), so it runs on
+        # a worker thread and the labels get the intervals when they arrive.
+        # The intervals are kept until the data or the method changes.
+        key = (self.data.version, self.threshold_method())
+        if self.intervals_key == key:
+            self.show_results(self.intervals)
+            return
+        self.show_results([None] * len(self.results))
+        if self.intervals_pending == key:
+            return
+        self.intervals_pending = key
+
+        def done(intervals):
+            if self.intervals_pending == key:
+                self.intervals_pending = None
+            if intervals is None:
+                return
+            self.intervals, self.intervals_key = intervals, key
+            if key == (self.data.version, self.threshold_method()):
+                self.show_results(intervals)
+
+        self.run_in_background(
+            self.intervals_job(), done, "Failed to calculate confidence intervals"
         )
-        lt2_power = power[lt2_index] if lt2_index > lt1_index else None
-
-        # FTP: Typically 5-10% above LT2
-        ftp_power = lt2_power * 1.075 if lt2_power else power[-1]
 
-        # FATmax: Typically 90-100% of LT1
-        fatmax_power = lt1_power * 0.95 if lt1_power else None
+    def intervals_job(self):
+        # A function returning the bootstrap intervals of the current data
+        # and method. It reads copies of the columns, so it can run on a
+        # worker thread while the table changes.
+        key = (self.data.version, self.threshold_method())
+        if self.intervals_key == key:
+            intervals = self.intervals
+            return lambda: intervals
 
-        return ftp_power, lt1_power, lt2_power, fatmax_power
+        from thresholds import bootstrap_intervals
 
-    def plot_data(self):
-        import matplotlib.pyplot as plt
-        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-
-        for widget in self.plot_frame.winfo_children():
-            widget.destroy()
-
-        ftp, lt1, lt2, fatmax = self.calculate_ftp_lt1_lt2_fatmax()
-
-        figure, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(8, 12))
-
-        stages = list(range(1, len(self.data["lactate"]) + 1))
-
-        ax1.plot(
-            stages, self.data["lactate"], marker="o", color="blue", label="New Test"
+        lactate, power, stage = (
+            self.data[name].copy() for name in ("lactate", "power", "stage")
         )
-        ax1.set_title("Lactate Levels")
-        ax1.set_xlabel("Stage")
-        ax1.set_ylabel("Lactate (mmol/L)")
 
-        ax2.plot(
-            stages, self.data["heart_rate"], marker="o", color="red", label="New Test"
-        )
-        ax2.set_title("Heart Rate")
-        ax2.set_xlabel("Stage")
-        ax2.set_ylabel("Heart Rate (bpm)")
+        def job():
+            with span("threshold_intervals", rows=len(lactate)):
+                return bootstrap_intervals(lactate, power, key[1], stage=stage)
 
-        ax3.plot(
-            stages, self.data["power"], marker="o", color="green", label="New Test"
-        )
-        ax3.set_title("Power Output")
-        ax3.set_xlabel("Stage")
-        ax3.set_ylabel("Power (W)")
+        return job
 
-        if ftp is not None:
-            ax3.axhline(
-                y=ftp,
-                color="blue",
-                linestyle="--",
-                label=f"FTP: {
-                    ftp:.2f} W",
-            )
-        if lt1 is not None:
-            ax3.axhline(
-                y=lt1,
-                color="orange",
-                linestyle="--",
-                label=f"LT1: {
-                    lt1:.2f} W",
+    def on_method_selected(self, event=None):
+        self.comparison_dirty = True
+        if self.ftp_label.cget("text") != "FTP: Not Calculated":
+            self.calculate_all()
+        self.refresh_test_figure()
+        self.refresh_overlay()
+
+    @timed("plot_data", rows=lambda self: len(self.data))
+    def plot_data(self):
+        ftp, lt1, lt2, fatmax = self.calculate_ftp_lt1_lt2_fatmax()
+        self.get_test_figure().update(self.data, (ftp, lt1, lt2, fatmax))
+
+    def get_test_figure(self):
+        # The left pane keeps one figure for the lifetime of the app; plots
+        # update its lines in place
+        if self.test_figure is None:
+            self.wait_for_preload("plotting")
+            from matplotlib.backends.backend_tkagg import (
+                FigureCanvasTkAgg,
+                NavigationToolbar2Tk,
             )
-        if lt2 is not None:
-            ax3.axhline(
-                y=lt2,
-                color="purple",
-                linestyle="--",
-                label=f"LT2: {
-                    lt2:.2f} W",
+            from plotting import TestFigure
+
+            self.test_figure = TestFigure()
+            canvas = FigureCanvasTkAgg(self.test_figure.figure, self.plot_frame)
+            # Zooming and panning redraw long recordings at full detail for
+            # the visible range
+            NavigationToolbar2Tk(canvas, self.plot_frame, pack_toolbar=False).pack(
+                side=tk.TOP, fill=tk.X
             )
-        if fatmax is not None:
-            ax3.axhline(
-                y=fatmax,
-                color="cyan",
-                linestyle="--",
-                label=f"FATmax: {
-                    fatmax:.2f} W",
+            canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+            self.test_figure.attach(canvas)
+            self.startup.mark("first plot possible")
+        return self.test_figure
+
+    def refresh_test_figure(self):
+        # Keep an already shown plot in sync with new stages; this is a
+        # partial redraw unless the axis limits change
+        if self.test_figure is not None:
+            self.test_figure.update(
+                self.data,
+                self.threshold_results(),
+                comparison=self.test_figure.comparison,
             )
 
-        ax3.legend()
+    def get_comparison_figure(self):
+        if self.comparison_figure is None:
+            self.wait_for_preload("plotting")
+            from matplotlib.backends.backend_tkagg import (
+                FigureCanvasTkAgg,
+                NavigationToolbar2Tk,
+            )
+            from plotting import ComparisonFigure
 
-        figure.tight_layout()
-        canvas = FigureCanvasTkAgg(figure, self.plot_frame)
-        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        canvas.draw()
+            self.comparison_figure = ComparisonFigure()
+            canvas = FigureCanvasTkAgg(
+                self.comparison_figure.figure, self.compare_plot_frame
+            )
+            NavigationToolbar2Tk(
+                canvas, self.compare_plot_frame, pack_toolbar=False
+            ).pack(side=tk.TOP, fill=tk.X)
+            canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+            self.comparison_figure.attach(canvas)
+        return self.comparison_figure
 
     def export_to_pdf(self):
-        from reportlab.lib.pagesizes import letter
-        from reportlab.lib.styles import getSampleStyleSheet
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-        import matplotlib.pyplot as plt
-        import tempfile
-        import pandas as pd
-
         file_path = filedialog.asksaveasfilename(
             defaultextension=".pdf", filetypes=[("PDF files", "*.pdf")]
         )
         if not file_path:
             return
 
-        # Recalculate the results before exporting
-        ftp, lt1, lt2, fatmax = self.calculate_ftp_lt1_lt2_fatmax()
-        self.results["FTP"] = ftp
-        self.results["LT1"] = lt1
-        self.results["LT2"] = lt2
-        self.results["FATmax"] = fatmax
-
-        pdf_doc = SimpleDocTemplate(file_path, pagesize=letter)
-        elements = []
-
-        styles = getSampleStyleSheet()
-        title_style = styles["Title"]
-        normal_style = styles["BodyText"]
+        # The part on the Tk thread is timed here, the document build on the
+        # worker thread separately as export_to_pdf.build
+        with span("export_to_pdf", rows=len(self.data)):
+            # With the default method thresholds come from the incremental
+            # state, so this is cheap
+            ftp, lt1, lt2, fatmax = self.calculate_ftp_lt1_lt2_fatmax()
+            method = self.threshold_method()
+            intervals_job = self.intervals_job()
+            self.results["FTP"] = ftp
+            self.results["LT1"] = lt1
+            self.results["LT2"] = lt2
+            self.results["FATmax"] = fatmax
+
+            # Matplotlib is not thread-safe, so the figures are rendered here
+            # and only the document is built on the worker thread
+            image = self.render_report_image((ftp, lt1, lt2, fatmax))
+            comparison = None
+            if len(self.old_data) > 0:
+                from report import render_comparison_image
+
+                _, improvements = self.calculate_comparison()
+                comparison = render_comparison_image(
+                    self.data, self.old_data, improvements
+                )
 
-        elements.append(Paragraph("Lactate Test Results", title_style))
-        elements.append(Spacer(1, 12))
+        def build(progress):
+            from report import build_report
+
+            intervals = intervals_job()
+            with span("export_to_pdf.build", rows=len(self.data)):
+                build_report(
+                    file_path,
+                    (ftp, lt1, lt2, fatmax),
+                    image,
+                    progress,
+                    method=method,
+                    intervals=intervals,
+                    comparison=comparison,
+                )
 
-        elements.append(
-            Paragraph(
-                (
-                    f"FTP: {
-                    ftp:.2f} W. Calculated approx. 5-10% above LT2"
-                    if ftp is not None
-                    else "FTP: Not Calculated"
-                ),
-                normal_style,
-            )
-        )
-        elements.append(Spacer(1, 12))
-        elements.append(
-            Paragraph(
-                (
-                    f"LT1: {
-                    lt1:.2f} W. Calculated approx. 1.5 - 2.0 mmol/L"
-                    if lt1 is not None
-                    else "LT1: Not Calculated"
-                ),
-                normal_style,
-            )
+        self.run_with_progress(
+            "Export to PDF", "Building PDF report...", build, "Failed to export PDF"
         )
-        elements.append(Spacer(1, 12))
-        elements.append(
-            Paragraph(
-                (
-                    f"LT2: {
-                    lt2:.2f} W. Calculated approx. 3.0 - 6.0 mmol/L"
-                    if lt2 is not None
-                    else "LT2: Not Calculated"
-                ),
-                normal_style,
-            )
-        )
-        elements.append(Spacer(1, 12))
-        elements.append(
-            Paragraph(
-                (
-                    f"FATmax: {
-                    fatmax:.2f} W. Calculated approx. 90-100% below LT1"
-                    if fatmax is not None
-                    else "FATmax: Not Calculated"
-                ),
-                normal_style,
-            )
-        )
-        elements.append(Spacer(1, 24))
-
-        # Create the figure and save it as an image
-        figure, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(8, 12))
-        stages = list(range(1, len(self.data["lactate"]) + 1))
-
-        ax1.plot(stages, self.data["lactate"], marker="o", color="blue")
-        ax1.set_title("Lactate Levels")
-        ax1.set_xlabel("Stage")
-        ax1.set_ylabel("Lactate (mmol/L)")
-
-        ax2.plot(stages, self.data["heart_rate"], marker="o", color="red")
-        ax2.set_title("Heart Rate")
-        ax2.set_xlabel("Stage")
-        ax2.set_ylabel("Heart Rate (bpm)")
-
-        ax3.plot(stages, self.data["power"], marker="o", color="green")
-        ax3.set_title("Power Output")
-        ax3.set_xlabel("Stage")
-        ax3.set_ylabel("Power (W)")
-
-        if ftp is not None:
-            ax3.axhline(
-                y=ftp,
-                color="blue",
-                linestyle="--",
-                label=f"FTP: {
-                    ftp:.2f} W",
-            )
-        if lt1 is not None:
-            ax3.axhline(
-                y=lt1,
-                color="orange",
-                linestyle="--",
-                label=f"LT1: {
-                    lt1:.2f} W",
-            )
-        if lt2 is not None:
-            ax3.axhline(
-                y=lt2,
-                color="purple",
-                linestyle="--",
-                label=f"LT2: {
-                    lt2:.2f} W",
-            )
-        if fatmax is not None:
-            ax3.axhline(
-                y=fatmax,
-                color="cyan",
-                linestyle="--",
-                label=f"FATmax: {
-                    fatmax:.2f} W",
-            )
-            ax3.legend()
-
-        figure.tight_layout()
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmpfile:
-            pdf_image_path = tmpfile.name
-            figure.savefig(pdf_image_path, bbox_inches="tight")
-            plt.close(figure)
+    def run_with_progress(self, title, text, work, error):
+        # Run work(progress) on a worker thread behind a modal progress bar;
+        # progress(fraction) may be called from the worker thread
+        dialog = tk.Toplevel(self.root)
+        dialog.title(title)
+        dialog.transient(self.root)
+        dialog.protocol("WM_DELETE_WINDOW", lambda: None)
+        ttk.Label(dialog, text=text).pack(padx=20, pady=(15, 5))
+        progress_bar = ttk.Progressbar(dialog, length=300, maximum=1.0)
+        progress_bar.pack(padx=20, pady=(5, 15))
 
-        # Add image to PDF
-        elements.append(
-            Image(pdf_image_path, width=350, height=450, kind="proportional")
-        )
+        updates = queue.Queue()
 
-        # Build the PDF
-        pdf_doc.build(elements)
+        def run():
+            try:
+                work(updates.put)
+            except Exception as e:
+                updates.put(e)
+            else:
+                updates.put(None)
+
+        def poll():
+            while True:
+                try:
+                    update = updates.get_nowait()
+                except queue.Empty:
+                    self.root.after(50, poll)
+                    return
+                if isinstance(update, float):
+                    progress_bar["value"] = update
+                    continue
+                dialog.destroy()
+                if update is not None:
+                    messagebox.showerror("Error", f"{error}: {update}")
+                return
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(50, poll)
+
+    def run_in_background(self, work, done, error):
+        # Run work() on a worker thread and pass its result to done() on the
+        # Tk thread; after an error done() gets None
+        results = queue.Queue()
+
+        def run():
+            try:
+                results.put(work())
+            except Exception as e:
+                results.put(e)
 
-        # Clean up the temporary file
-        if os.path.exists(pdf_image_path):
-            os.remove(pdf_image_path)
+        def poll():
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                self.root.after(50, poll)
+                return
+            if isinstance(result, Exception):
+                messagebox.showerror("Error", f"{error}: {result}")
+                result = None
+            done(result)
+
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(50, poll)
+
+    def render_report_image(self, results):
+        self.wait_for_preload("report")
+        from report import render_report_image
+
+        # The shared renderer keeps the PNG of every test it has drawn, so
+        # exporting an unchanged test again does not redraw it
+        return render_report_image(self.data, results)
 
     def export_to_csv(self):
-        import pandas as pd
-
         file_path = filedialog.asksaveasfilename(
             defaultextension=".csv", filetypes=[("CSV files", "*.csv")]
         )
         if not file_path:
             return
 
-        df = pd.DataFrame(self.data)
-        df.to_csv(file_path, index=False)
+        self.wait_for_preload("pandas")
+        with span("export_to_csv", rows=len(self.data)):
+            df = self.data.to_dataframe()
+            df.to_csv(file_path, index=False)
 
     def export_to_excel(self):
-        import pandas as pd
-
         file_path = filedialog.asksaveasfilename(
             defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")]
         )
         if not file_path:
             return
 
-        df = pd.DataFrame(self.data)
-        df.to_excel(file_path, index=False)
+        self.wait_for_preload("excel")
+        with span("export_to_excel", rows=len(self.data)):
+            df = self.data.to_dataframe()
+            df.to_excel(file_path, index=False)
 
-    def upload_old_test(self):
-        import pandas as pd
+    def export_workbook(self):
+        # The current test, the old test and the tests in the overlay window
+        # with their thresholds and progress in one workbook
+        if len(self.data) == 0:
+            messagebox.showerror("Error", "No data to export.")
+            return
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")]
+        )
+        if not file_path:
+            return
 
-        # Upload old test data from an Excel file
-        file_path = filedialog.askopenfilename(
-            filetypes=[("Excel files", "*.xls *.xlsx")]
+        self.wait_for_preload("excel")
+        with span("export_workbook", rows=len(self.data)):
+            # The tests are copied, so the table can be edited while the
+            # workbook is written
+            method = self.threshold_method()
+            tests = [("New Test", self.data.copy())]
+            thresholds = [self.threshold_results()]
+            methods = [method]
+            improvements = None
+            if len(self.old_data) > 0:
+                _, improvements = self.calculate_comparison()
+                tests.append(("Old Test", self.old_data.copy()))
+                thresholds.append(self.calculate_old_ftp_lt1_lt2_fatmax())
+                # The old test is always scored with the baseline rule
+                methods.append("baseline")
+            if self.overlay_tests:
+                from overlay import stack_column
+                from thresholds import calculate_thresholds_batch
+
+                history = [test for _, test in self.overlay_tests]
+                tests.extend(self.overlay_tests)
+                thresholds.extend(
+                    calculate_thresholds_batch(
+                        stack_column(history, "lactate"),
+                        stack_column(history, "power"),
+                        method,
+                    )
+                )
+                methods.extend([method] * len(history))
+            intervals_job = self.intervals_job()
+
+        def write(progress):
+            from workbook import write_workbook
+
+            intervals = intervals_job()
+            rows = sum(len(test) for _, test in tests)
+            with span("export_workbook.write", rows=rows):
+                write_workbook(
+                    file_path,
+                    tests,
+                    thresholds,
+                    methods=methods,
+                    improvements=improvements,
+                    intervals=intervals,
+                    progress=progress,
+                )
+
+        self.run_with_progress(
+            "Export Workbook", "Writing workbook...", write, "Failed to export"
         )
+
+    def upload_old_test(self):
+        # Upload old test data from an Excel or CSV file
+        file_path = filedialog.askopenfilename(filetypes=TEST_FILE_TYPES)
         if file_path:
+            from store import COLUMNS, TestStore
+
+            # Read into a new store, so a file that fails to load leaves the
+            # current old test in place
+            test = TestStore()
             try:
-                df = pd.read_excel(file_path)
-                self.load_old_data_from_dataframe(df)
+                self.read_test_file(file_path, test)
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to load Excel file: {e}")
-
-    def load_old_data_from_dataframe(self, df):
-        # Load old data from a DataFrame
-        for key in self.old_data:
-            self.old_data[key].clear()
-        for item in self.old_tree.get_children():
-            self.old_tree.delete(item)
-
-        for _, row in df.iterrows():
-            lactate = row["Lactate"]
-            heart_rate = row["Heart Rate"]
-            power = row["Power"]
-            self.old_data["lactate"].append(lactate)
-            self.old_data["heart_rate"].append(heart_rate)
-            self.old_data["power"].append(power)
-            self.old_tree.insert("", "end", values=(lactate, heart_rate, power))
+                messagebox.showerror("Error", f"Failed to load file: {e}")
+                return
+            self.old_data.replace_columns({name: test[name] for name in COLUMNS})
+            self.old_tree.refresh()
 
+    @timed("compare_tests", rows=lambda self: len(self.data) + len(self.old_data))
     def compare_tests(self):
-        import matplotlib.pyplot as plt
-        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-
         # Plot comparison of old and new test data
-        if not self.old_data["lactate"]:
+        if len(self.old_data) == 0:
             messagebox.showerror("Error", "No old test data available for comparison.")
             return
 
+        new_results, improvements = self.calculate_comparison()
+        self.get_test_figure().update(self.data, new_results, comparison=True)
+        self.get_comparison_figure().update(
+            self.data, self.old_data, improvements, self.show_new_test_var.get()
+        )
+        self.comparison_dirty = False
+
+    def calculate_comparison(self):
+        # Results of the new test and the progress over the old one, cached
+        # by a fingerprint of both tests so that unchanged (or identically
+        # reloaded) data is never recalculated
+        key = (
+            self.data.fingerprint(),
+            self.old_data.fingerprint(),
+            self.threshold_method(),
+        )
+        if key == self.comparison_key:
+            return self.comparison_results
+
         # Calculate the new and old results
         new_ftp, new_lt1, new_lt2, new_fatmax = self.calculate_ftp_lt1_lt2_fatmax()
         old_ftp, old_lt1, old_lt2, old_fatmax = self.calculate_old_ftp_lt1_lt2_fatmax()
@@ -769,197 +1242,410 @@ class LactateLab:
             "FATmax": (new_fatmax - old_fatmax) if new_fatmax and old_fatmax else None,
         }
 
-        for widget in self.plot_frame.winfo_children():
-            widget.destroy()
+        results = ((new_ftp, new_lt1, new_lt2, new_fatmax), improvements)
+        if len(self.data) >= 4:
+            self.comparison_key = key
+            self.comparison_results = results
+        return results
 
-        for widget in self.compare_plot_frame.winfo_children():
-            widget.destroy()
+    def toggle_new_test(self):
+        if self.comparison_figure is None or len(self.old_data) == 0:
+            return
+        if self.comparison_dirty:
+            self.compare_tests()
+        else:
+            # The figure already shows these tests
+            self.comparison_figure.set_new_visible(self.show_new_test_var.get())
+
+    def on_comparison_data_changed(self, event, *args):
+        self.comparison_dirty = True
+
+    def on_tab_changed(self, event=None):
+        # Bring a shown comparison up to date when its tabs are reopened;
+        # without changes there is nothing to redraw
+        if (
+            self.notebook.select() in (str(self.compare_frame), str(self.graph_frame))
+            and self.comparison_figure is not None
+            and self.comparison_dirty
+            and len(self.data) >= 4
+            and len(self.old_data) > 0
+        ):
+            self.compare_tests()
+
+    def get_history(self):
+        if self.history is None:
+            from history import HistoryStore
+
+            self.history = HistoryStore()
+        return self.history
+
+    def save_session(self):
+        # Both tests, the shown results and their context in one binary file
+        from session import SESSION_FILE_TYPES, write_session
 
-        # Plot new test data in the left pane
-        new_figure, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(8, 12))
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".llsession", filetypes=SESSION_FILE_TYPES
+        )
+        if not file_path:
+            return
 
-        stages_new = list(range(1, len(self.data["lactate"]) + 1))
+        method = self.threshold_method()
+        results = {"new": tuple(self.results.values())}
+        intervals = None
+        if self.intervals_key == (self.data.version, method):
+            intervals = self.intervals
+        fingerprints = (self.data.fingerprint(), self.old_data.fingerprint(), method)
+        if self.comparison_key == fingerprints:
+            results["improvements"] = tuple(self.comparison_results[1].values())
+        metadata = {
+            "method": method,
+            "athlete": self.athlete,
+            "test_date": str(self.test_date) if self.test_date else None,
+            "fingerprints": fingerprints[:2],
+        }
+        try:
+            with span("save_session", rows=len(self.data) + len(self.old_data)):
+                write_session(
+                    file_path,
+                    {"new": self.data, "old": self.old_data},
+                    results,
+                    intervals,
+                    metadata,
+                )
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save the session: {e}")
 
-        ax1.plot(
-            stages_new, self.data["lactate"], marker="o", color="blue", label="New Test"
-        )
-        ax1.set_title("Lactate Levels (New Test)")
-        ax1.set_xlabel("Stage")
-        ax1.set_ylabel("Lactate (mmol/L)")
-        ax1.legend()
+    def open_session(self):
+        # The tests are memory-mapped from the file rather than read, so
+        # even long recordings open at once; saved results are shown without
+        # recalculating them
+        import datetime
 
-        ax2.plot(
-            stages_new,
-            self.data["heart_rate"],
-            marker="o",
-            color="red",
-            label="New Test",
-        )
-        ax2.set_title("Heart Rate (New Test)")
-        ax2.set_xlabel("Stage")
-        ax2.set_ylabel("Heart Rate (bpm)")
-        ax2.legend()
+        from session import SESSION_FILE_TYPES, THRESHOLDS, read_session
 
-        ax3.plot(
-            stages_new, self.data["power"], marker="o", color="green", label="New Test"
-        )
-        ax3.set_title("Power Output (New Test)")
-        ax3.set_xlabel("Stage")
-        ax3.set_ylabel("Power (W)")
+        file_path = filedialog.askopenfilename(filetypes=SESSION_FILE_TYPES)
+        if not file_path:
+            return
+        try:
+            session = read_session(file_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open the session: {e}")
+            return
 
-        if new_ftp is not None:
-            ax3.axhline(
-                y=new_ftp,
-                color="blue",
-                linestyle="--",
-                label=f"FTP: {
-                    new_ftp:.2f} W",
-            )
-        if new_lt1 is not None:
-            ax3.axhline(
-                y=new_lt1,
-                color="orange",
-                linestyle="--",
-                label=f"LT1: {
-                    new_lt1:.2f} W",
-            )
-        if new_lt2 is not None:
-            ax3.axhline(
-                y=new_lt2,
-                color="purple",
-                linestyle="--",
-                label=f"LT2: {
-                    new_lt2:.2f} W",
+        self.stop_stream()
+        with span("open_session"):
+            for name, store, table in (
+                ("new", self.data, self.tree),
+                ("old", self.old_data, self.old_tree),
+            ):
+                if name in session.columns:
+                    store.replace_columns(
+                        session.columns[name], source=(file_path, name)
+                    )
+                else:
+                    store.clear()
+                table.refresh()
+
+        metadata = session.metadata
+        method = metadata.get("method")
+        if method in METHODS:
+            self.method_var.set(METHODS[method])
+        method = self.threshold_method()
+        self.athlete = metadata.get("athlete")
+        test_date = metadata.get("test_date")
+        self.test_date = datetime.date.fromisoformat(test_date) if test_date else None
+
+        values = session.results.get("new", [float("nan")] * len(THRESHOLDS))
+        values = [value.item() if value == value else None for value in values]
+        self.results = dict(zip(THRESHOLDS, values))
+        intervals = [None] * len(THRESHOLDS)
+        if session.intervals is not None:
+            intervals = self.intervals = session.intervals
+            self.intervals_key = (self.data.version, method)
+        self.show_results(intervals)
+
+        improvements = session.results.get("improvements")
+        if improvements is not None:
+            # The fingerprints only depend on the values, so the comparison
+            # is known to match the opened tests
+            self.comparison_key = (*metadata["fingerprints"], method)
+            self.comparison_results = (
+                tuple(values),
+                {
+                    name: value.item() if value == value else None
+                    for name, value in zip(THRESHOLDS, improvements)
+                },
             )
-        if new_fatmax is not None:
-            ax3.axhline(
-                y=new_fatmax,
-                color="cyan",
-                linestyle="--",
-                label=f"FATmax: {
-                    new_fatmax:.2f} W",
+        self.refresh_test_figure()
+
+    def save_to_history(self):
+        # Store the current test and its thresholds in the history database
+        import datetime
+
+        if len(self.data) < 4:
+            messagebox.showerror("Error", "At least 4 data points are required.")
+            return
+
+        athlete = simpledialog.askstring(
+            "Save to History", "Athlete:", initialvalue=self.athlete or ""
+        )
+        if not athlete:
+            return
+        test_date = simpledialog.askstring(
+            "Save to History",
+            "Test date (YYYY-MM-DD):",
+            initialvalue=str(self.test_date or datetime.date.today()),
+        )
+        if not test_date:
+            return
+
+        try:
+            test_date = datetime.date.fromisoformat(test_date)
+            self.get_history().add_test(
+                athlete,
+                test_date,
+                self.data,
+                self.threshold_results(),
+                method=self.threshold_method(),
             )
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save the test: {e}")
+            return
+        self.athlete = athlete
+        self.test_date = test_date
+        messagebox.showinfo("Saved", f"Test of {athlete} on {test_date} saved.")
 
-        ax3.legend()
+    def load_previous_test(self):
+        # Load the athlete's latest test before the current one as the old test
+        import datetime
 
-        new_figure.tight_layout()
-        new_canvas = FigureCanvasTkAgg(new_figure, self.plot_frame)
-        new_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        new_canvas.draw()
+        athlete = simpledialog.askstring(
+            "Load Previous Test", "Athlete:", initialvalue=self.athlete or ""
+        )
+        if not athlete:
+            return
 
-        # Plot old test data in the right pane
-        old_figure, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(8, 12))
+        history = self.get_history()
+        test = history.previous_test(
+            athlete, before=self.test_date or datetime.date.today()
+        )
+        if test is None:
+            messagebox.showerror("Error", f"No earlier test of {athlete} found.")
+            return
 
-        stages_old = list(range(1, len(self.old_data["lactate"]) + 1))
+        self.old_data.clear()
+        history.load_test(test["id"], self.old_data)
+        self.old_tree.refresh()
+        self.athlete = athlete
+        messagebox.showinfo(
+            "Loaded", f"Loaded the test of {athlete} from {test['test_date']}."
+        )
 
-        if self.show_new_test_var.get():
-            ax1.plot(
-                stages_new,
-                self.data["lactate"],
-                marker="o",
-                color="blue",
-                label="New Test",
-            )
-            ax2.plot(
-                stages_new,
-                self.data["heart_rate"],
-                marker="o",
-                color="red",
-                label="New Test",
-            )
-            ax3.plot(
-                stages_new,
-                self.data["power"],
-                marker="o",
-                color="green",
-                label="New Test",
+    def show_overlay_window(self):
+        # Any number of tests on a shared power axis, with their thresholds
+        # and the progress between them
+        if self.overlay_window is not None:
+            self.overlay_window.lift()
+            return
+
+        self.wait_for_preload("plotting")
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from overlay import THRESHOLDS
+        from plotting import OverlayFigure
+
+        window = tk.Toplevel(self.root)
+        window.title("Overlay Tests")
+        self.overlay_window = window
+
+        controls = ttk.Frame(window)
+        controls.pack(fill=tk.X, padx=10, pady=5)
+        for text, command in (
+            ("Add Test Files", self.add_overlay_files),
+            ("Add Athlete History", self.add_overlay_history),
+            ("Add Current Test", lambda: self.add_overlay_test("Current", self.data)),
+            ("Add Old Test", lambda: self.add_overlay_test("Old", self.old_data)),
+            ("Remove Selected", self.remove_overlay_tests),
+            ("Clear", self.clear_overlay),
+        ):
+            ttk.Button(controls, text=text, command=command).pack(side=tk.LEFT, padx=5)
+
+        columns = ("test",) + THRESHOLDS
+        self.overlay_table = ttk.Treeview(
+            window, columns=columns, show="headings", height=8
+        )
+        for column, heading in zip(columns, ("Test",) + THRESHOLDS):
+            self.overlay_table.heading(column, text=heading)
+            self.overlay_table.column(
+                column, width=200 if column == "test" else 140, anchor="w"
             )
+        self.overlay_table.pack(fill=tk.X, padx=10, pady=5)
 
-        ax1.plot(
-            stages_old,
-            self.old_data["lactate"],
-            marker="x",
-            color="green",
-            label="Old Test",
-        )
-
-        ax1.set_title("Lactate Levels (Old Test)")
-        ax1.set_xlabel("Stage")
-        ax1.set_ylabel("Lactate (mmol/L)")
-        ax1.legend()
-
-        ax2.plot(
-            stages_old,
-            self.old_data["heart_rate"],
-            marker="x",
-            color="orange",
-            label="Old Test",
-        )
-        ax2.set_title("Heart Rate (Old Test)")
-        ax2.set_xlabel("Stage")
-        ax2.set_ylabel("Heart Rate (bpm)")
-        ax2.legend()
-
-        ax3.plot(
-            stages_old,
-            self.old_data["power"],
-            marker="x",
-            color="purple",
-            label="Old Test",
-        )
-        ax3.set_title("Power Output (Old Test)")
-        ax3.set_xlabel("Stage")
-        ax3.set_ylabel("Power (W)")
-        ax3.legend()
-
-        # Display improvements
-        text_x = max(stages_new + stages_old) * 0.5
-        text_y = max(self.data["power"] + self.old_data["power"]) * 0.8
-        ax3.text(
-            text_x,
-            text_y,
-            f"Progress:\nFTP: {improvements['FTP']:.2f} W\n"
-            f"LT1: {improvements['LT1']:.2f} W\n"
-            f"LT2: {improvements['LT2']:.2f} W\n"
-            f"FATmax: {improvements['FATmax']:.2f} W",
-            bbox=dict(facecolor="white", alpha=0.8),
-        )
-
-        old_figure.tight_layout()
-        old_canvas = FigureCanvasTkAgg(old_figure, self.compare_plot_frame)
-        old_canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        old_canvas.draw()
+        self.overlay_figure = OverlayFigure()
+        canvas = FigureCanvasTkAgg(self.overlay_figure.figure, window)
+        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.overlay_figure.attach(canvas)
+
+        def close():
+            self.overlay_window = None
+            self.overlay_figure = None
+            self.overlay_table = None
+            window.destroy()
+
+        window.protocol("WM_DELETE_WINDOW", close)
+        self.refresh_overlay()
+
+    def add_overlay_test(self, label, data):
+        # A copy, so later edits of the current or old test do not change
+        # the overlay
+        if len(data) == 0:
+            messagebox.showerror("Error", f"The {label.lower()} test has no data.")
+            return
+        self.overlay_tests.append((f"{label} test", data.copy()))
+        self.refresh_overlay()
 
-    def calculate_old_ftp_lt1_lt2_fatmax(self):
-        import numpy as np
+    def add_overlay_files(self):
+        import os
 
-        # Calculate FTP, LT1, LT2, and FATmax based on old lactate and power
-        # data
-        lactate = np.array(self.old_data["lactate"])
-        power = np.array(self.old_data["power"])
+        from store import TestStore
 
-        if len(lactate) < 4:
-            return None, None, None, None
+        file_paths = filedialog.askopenfilenames(filetypes=TEST_FILE_TYPES)
+        errors = []
+        for file_path in file_paths:
+            try:
+                test = TestStore()
+                self.read_test_file(file_path, test)
+            except Exception as e:
+                errors.append(f"{os.path.basename(file_path)}: {e}")
+                continue
+            self.overlay_tests.append((os.path.basename(file_path), test))
+        if file_paths:
+            self.refresh_overlay()
+        if errors:
+            messagebox.showerror("Error", "Failed to load:\n" + "\n".join(errors))
+
+    def add_overlay_history(self):
+        # All tests of an athlete, oldest first
+        athlete = simpledialog.askstring(
+            "Add Athlete History", "Athlete:", initialvalue=self.athlete or ""
+        )
+        if not athlete:
+            return
 
-        baseline_lactate = lactate[0]
+        history = self.get_history()
+        tests = history.tests(athlete)
+        if not tests:
+            messagebox.showerror("Error", f"No tests of {athlete} found.")
+            return
+        for test in tests:
+            self.overlay_tests.append(
+                (f"{athlete} {test['test_date']}", history.load_test(test["id"]))
+            )
+        self.athlete = athlete
+        self.refresh_overlay()
 
-        lt1_index = np.argmax(lactate > (baseline_lactate + 0.5))
-        lt1_power = power[lt1_index] if lt1_index > 0 else None
+    def remove_overlay_tests(self):
+        selected = {
+            int(item) for item in self.overlay_table.selection() if item.isdigit()
+        }
+        self.overlay_tests = [
+            test
+            for index, test in enumerate(self.overlay_tests)
+            if index not in selected
+        ]
+        self.refresh_overlay()
+
+    def clear_overlay(self):
+        self.overlay_tests = []
+        self.refresh_overlay()
+
+    @timed("refresh_overlay", rows=lambda self: len(self.overlay_tests))
+    def refresh_overlay(self):
+        # Resampling and thresholds are array operations over all tests, and
+        # the figure has a fixed number of artists, so this stays fast with
+        # dozens of tests
+        if self.overlay_window is None:
+            return
+        from matplotlib.colors import to_hex
+        from overlay import format_change, format_progress, overlay_tests, progress
 
-        lt2_index = np.argmax(lactate >= 4)
-        lt2_power = power[lt2_index] if lt2_index > 0 else None
+        overlay = overlay_tests(
+            [test for _, test in self.overlay_tests], self.threshold_method()
+        )
+        self.overlay_figure.update(overlay)
+
+        table = self.overlay_table
+        table.delete(*table.get_children())
+        changes, season = progress(overlay.thresholds)
+        for index, ((label, _), color) in enumerate(
+            zip(self.overlay_tests, self.overlay_figure.colors)
+        ):
+            cells = map(format_progress, overlay.thresholds[index], changes[index])
+            table.tag_configure(f"test{index}", foreground=to_hex(color))
+            table.insert(
+                "",
+                tk.END,
+                iid=str(index),
+                values=(label, *cells),
+                tags=(f"test{index}",),
+            )
+        if len(self.overlay_tests) > 1:
+            table.insert(
+                "",
+                tk.END,
+                iid="season",
+                values=("Change first to last", *map(format_change, season)),
+            )
 
-        ftp_power = lt2_power * 0.95 if lt2_power else power[-1]
+    def calculate_old_ftp_lt1_lt2_fatmax(self):
+        from thresholds import calculate_old_ftp_lt1_lt2_fatmax
+
+        return calculate_old_ftp_lt1_lt2_fatmax(
+            self.old_data["lactate"], self.old_data["power"]
+        )
 
-        fatmax_power = None
-        if lt1_index > 0:
-            fatmax_power = power[:lt1_index].max() if lt1_index > 0 else None
 
-        return ftp_power, lt1_power, lt2_power, fatmax_power
+def _format_clock(seconds):
+    # "mm:ss" (or "h:mm:ss") of seconds since the start of a ride
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
 
 
 # THIS RUNS THE PROGRAM
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LactateLab")
+    parser.add_argument(
+        "--no-preload",
+        action="store_true",
+        help="Do not import plotting, spreadsheet and PDF libraries in the "
+        "background after startup",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the startup timing breakdown",
+    )
+    parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="Record operation timings and event-loop stalls to data/logs",
+    )
+    parser.add_argument(
+        "--new-session",
+        action="store_true",
+        help="Start with empty tests instead of restoring the last session",
+    )
+    args = parser.parse_args()
+    if args.instrument:
+        instrumentation.enable()
+
     root = tk.Tk()
-    app = LactateLab(root)
+    app = LactateLab(
+        root,
+        preload=not args.no_preload,
+        print_timings=args.timings,
+        restore_session=not args.new_session,
+    )
     root.mainloop()
@@ -0,0 +1,12 @@
+# Threshold methods: name -> description. Kept apart from thresholds.py,
+# which imports NumPy, so the window can list them before NumPy is loaded.
+METHODS = {
+    "bands": "Fixed lactate bands (1.5-2.0 / 3.0-6.0 mmol/L)",
+    "baseline": "Baseline + 0.5 mmol/L / 4.0 mmol/L",
+    "dmax": "Dmax, 3rd order polynomial",
+    "dmax_exp": "Dmax, exponential",
+    "modified_dmax": "Modified Dmax",
+    "log_log": "Log-log breakpoint / OBLA 4.0 mmol/L",
+    "obla": "OBLA 2.0 / 4.0 mmol/L",
+}
+DEFAULT_METHOD = "bands"
@@ -0,0 +1,132 @@
+from collections import namedtuple
+
+import numpy as np
+
+from thresholds import DEFAULT_METHOD, calculate_thresholds_batch
+
+# Points of the shared power axis the curves are resampled onto
+GRID_POINTS = 200
+
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+# grid: (points,) watts; lactate and heart_rate: (n, points) curves, NaN
+# outside a test's own power range; thresholds: (n, 4) watts; markers:
+# lactate and heart rate at the thresholds, each (n, 4)
+Overlay = namedtuple(
+    "Overlay",
+    "grid lactate heart_rate thresholds marker_lactate marker_heart_rate",
+)
+
+
+def stack_column(tests, column):
+    """
+    One column of many TestStores as a 2-D array, one test per row, padded
+    at the end with NaN.
+    """
+
+    width = max((len(test) for test in tests), default=0)
+    stacked = np.full((len(tests), width), np.nan)
+    for row, test in enumerate(tests):
+        stacked[row, : len(test)] = test[column]
+    return stacked
+
+
+def power_grid(power, points=GRID_POINTS):
+    # Evenly spaced watts covering the power range of all tests
+    if np.isnan(power).all():
+        return np.zeros(0)
+    return np.linspace(np.nanmin(power), np.nanmax(power), points)
+
+
+def resample(power, values, x):
+    """
+    Interpolate every test's ``values`` as a function of its ``power``.
+
+    ``power`` and ``values`` hold one test per row (NaN-padded); ``x`` is
+    either one set of watts shared by all tests or one row per test. The
+    result has a row per test and is NaN outside the test's own power range.
+    All tests are interpolated with a single np.interp call: each test is
+    shifted onto its own stretch of one long axis.
+    """
+
+    power = np.atleast_2d(np.asarray(power, dtype=np.float64))
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    n = len(power)
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), (n, np.shape(x)[-1]))
+    result = np.full(x.shape, np.nan)
+    valid = ~np.isnan(power) & ~np.isnan(values)
+    if not valid.any():
+        return result
+
+    # Sort the stages of each test by power; invalid ones go to the end
+    order = np.argsort(np.where(valid, power, np.inf), axis=1, kind="stable")
+    power = np.take_along_axis(power, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    low = np.where(valid, power, np.inf).min(axis=1)
+    high = np.where(valid, power, -np.inf).max(axis=1)
+
+    origin = min(power[valid].min(), np.nanmin(x, initial=np.inf))
+    end = max(power[valid].max(), np.nanmax(x, initial=-np.inf))
+    offsets = np.arange(n)[:, None] * (end - origin + 1) - origin
+    interpolated = np.interp(
+        (x + offsets).ravel(), (power + offsets)[valid], values[valid]
+    ).reshape(x.shape)
+
+    inside = (x >= low[:, None]) & (x <= high[:, None])
+    result[inside] = interpolated[inside]
+    return result
+
+
+def overlay_tests(tests, method=DEFAULT_METHOD, points=GRID_POINTS):
+    """
+    Resample any number of tests (TestStores) onto a shared power axis.
+
+    Tests with different step protocols line up on the grid, and their
+    thresholds are calculated together with
+    thresholds.calculate_thresholds_batch(). Returns an Overlay.
+    """
+
+    power = stack_column(tests, "power")
+    lactate = stack_column(tests, "lactate")
+    heart_rate = stack_column(tests, "heart_rate")
+    grid = power_grid(power, points)
+    thresholds = calculate_thresholds_batch(lactate, power, method)
+    return Overlay(
+        grid,
+        resample(power, lactate, grid),
+        resample(power, heart_rate, grid),
+        thresholds,
+        resample(power, lactate, thresholds),
+        resample(power, heart_rate, thresholds),
+    )
+
+
+def progress(thresholds):
+    """
+    Changes of the (n, 4) thresholds between tests.
+
+    Returns the change of every test over the previous one (NaN for the
+    first test) and the change from the first to the last test.
+    """
+
+    thresholds = np.atleast_2d(thresholds)
+    previous = np.full(thresholds.shape, np.nan)
+    previous[1:] = thresholds[1:] - thresholds[:-1]
+    if len(thresholds) == 0:
+        return previous, np.full(len(THRESHOLDS), np.nan)
+    return previous, thresholds[-1] - thresholds[0]
+
+
+def format_progress(value, change=np.nan):
+    # "245 W (+12)" for a threshold and its change, "245 W" without a change
+    if np.isnan(value):
+        return "n/a"
+    text = f"{value:.0f} W"
+    if not np.isnan(change):
+        text += f" ({change:+.0f})"
+    return text
+
+
+def format_change(change):
+    return "n/a" if np.isnan(change) else f"{change:+.0f} W"
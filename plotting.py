@@ -0,0 +1,349 @@
+import numpy as np
+from matplotlib.figure import Figure
+
+# Threshold name -> line color, in the order returned by the calculations
+THRESHOLD_COLORS = {"FTP": "blue", "LT1": "orange", "LT2": "purple", "FATmax": "cyan"}
+THRESHOLD_MARKERS = {"FTP": "s", "LT1": "o", "LT2": "^", "FATmax": "D"}
+TITLES = ("Lactate Levels", "Heart Rate", "Power Output")
+Y_LABELS = ("Lactate (mmol/L)", "Heart Rate (bpm)", "Power (W)")
+COLUMNS = ("lactate", "heart_rate", "power")
+
+# Series longer than this many points per pixel of the axes width are drawn
+# downsampled
+POINTS_PER_PIXEL = 2
+
+
+class BlitFigure:
+    """
+    A long-lived three-panel figure whose data artists are updated in place.
+
+    Data artists are marked animated: a full draw renders everything else
+    (axes, ticks, titles) and caches it as the background, and later updates
+    only restore that background and redraw the animated artists on top.
+    A full draw is only needed when axis limits, titles or the figure size
+    change.
+    """
+
+    def __init__(
+        self, figsize=(8, 12), titles=TITLES, y_labels=Y_LABELS, x_label="Stage"
+    ):
+        self.figure = Figure(figsize=figsize)
+        self.axes = self.figure.subplots(len(titles), 1)
+        for ax, title, ylabel in zip(self.axes, titles, y_labels):
+            ax.set_title(title)
+            ax.set_xlabel(x_label)
+            ax.set_ylabel(ylabel)
+        self.canvas = None
+        self.legends = {}
+        # line -> full-resolution (x, y, keep) of a downsampled line
+        self.series = {}
+        self._animated = []
+        self._background = None
+        self._rescaling = False
+        for ax in self.axes:
+            ax.callbacks.connect("xlim_changed", self._on_xlim_changed)
+
+    def attach(self, canvas):
+        # Render into an interactive canvas, e.g. FigureCanvasTkAgg
+        self.canvas = canvas
+        canvas.mpl_connect("draw_event", self._on_draw)
+
+    def animate(self, artist):
+        artist.set_animated(True)
+        self._animated.append(artist)
+        return artist
+
+    def set_legend(self, ax, handles):
+        # Legends list only visible artists, so they are rebuilt on update
+        old = self.legends.pop(ax, None)
+        if old is not None:
+            self._animated.remove(old)
+            old.remove()
+        if handles:
+            self.legends[ax] = self.animate(ax.legend(handles=handles))
+
+    def set_series(self, line, x, y, keep=None):
+        """
+        Show (x, y) on ``line``, downsampled when it is long.
+
+        A series with more points than POINTS_PER_PIXEL per pixel of the
+        axes width is drawn reduced with LTTB (see downsample.py), and drawn
+        again from the full data when the axes are zoomed or panned. The
+        ``keep`` indices, e.g. the measured stage points, are always drawn
+        exactly and carry the markers.
+        """
+
+        self.series[line] = (x, y, keep)
+        self._show_series(line)
+
+    def autoscale(self):
+        # Rescale all axes to the visible data; True if any limits changed
+        changed = False
+        self._rescaling = True
+        try:
+            for ax in self.axes:
+                limits = (ax.get_xlim(), ax.get_ylim())
+                ax.relim(visible_only=True)
+                ax.autoscale_view()
+                changed = changed or limits != (ax.get_xlim(), ax.get_ylim())
+        finally:
+            self._rescaling = False
+        return changed
+
+    def redraw(self, full=False):
+        if self.canvas is None:
+            return
+        if full or self._background is None:
+            self.figure.tight_layout()
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_animated()
+            self.canvas.blit(self.figure.bbox)
+
+    def _show_series(self, line, limits=None):
+        x, y, keep = self.series[line]
+        threshold = int(line.axes.get_window_extent().width * POINTS_PER_PIXEL)
+        if len(x) <= threshold:
+            line.set_data(x, y)
+            line.set_markevery(None)
+            return
+
+        from downsample import downsample
+
+        selected = downsample(x, y, threshold, keep, limits)
+        line.set_data(x[selected], y[selected])
+        markers = [] if keep is None else np.intersect1d(selected, keep)
+        line.set_markevery(np.searchsorted(selected, markers).tolist())
+
+    def _on_xlim_changed(self, ax):
+        # Zooming or panning shows a different part of long series; updates
+        # set their data before rescaling, so they are skipped here
+        if self._rescaling:
+            return
+        for line in self.series:
+            if line.axes is ax:
+                self._show_series(line, ax.get_xlim())
+
+    def _on_draw(self, event):
+        # savefig() already renders animated artists itself
+        if self.canvas.is_saving():
+            return
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self._animated:
+            if artist.get_visible():
+                self.figure.draw_artist(artist)
+
+
+class TestFigure(BlitFigure):
+    # Lactate, heart rate and power by stage with threshold lines on the
+    # power panel
+
+    def __init__(self, figsize=(8, 12)):
+        super().__init__(figsize)
+        ax1, ax2, ax3 = self.axes
+        self.lines = [
+            self.animate(ax.plot([], [], marker="o", color=color, label="New Test")[0])
+            for ax, color in zip(self.axes, ("blue", "red", "green"))
+        ]
+        self.threshold_lines = {
+            name: self.animate(
+                ax3.axhline(y=0, color=color, linestyle="--", visible=False)
+            )
+            for name, color in THRESHOLD_COLORS.items()
+        }
+        self.comparison = None
+
+    def update(self, data, results, comparison=False):
+        """
+        Show ``data`` (a TestStore) and the (FTP, LT1, LT2, FATmax) results.
+
+        With ``comparison`` the panels are titled as the new test of a
+        comparison and every panel gets a legend.
+        """
+
+        from downsample import sample_points
+
+        stages = np.arange(1, len(data) + 1)
+        keep = sample_points(data["stage"], data["lactate"])
+        for line, column in zip(self.lines, COLUMNS):
+            self.set_series(line, stages, data[column], keep)
+
+        for (name, line), value in zip(self.threshold_lines.items(), results):
+            line.set_visible(value is not None)
+            if value is not None:
+                line.set_ydata([value, value])
+                line.set_label(f"{name}: {value:.2f} W")
+
+        full = comparison != self.comparison
+        if full:
+            self.comparison = comparison
+            suffix = " (New Test)" if comparison else ""
+            for ax, title in zip(self.axes, TITLES):
+                ax.set_title(title + suffix)
+            for ax, line in zip(self.axes[:2], self.lines):
+                self.set_legend(ax, [line] if comparison else [])
+
+        ax3 = self.axes[2]
+        visible = [line for line in self.threshold_lines.values() if line.get_visible()]
+        self.set_legend(ax3, [self.lines[2]] + visible)
+
+        full = self.autoscale() or full
+        self.redraw(full)
+
+
+class ComparisonFigure(BlitFigure):
+    # The old test, optionally overlaid with the new test, and the progress
+    # between them
+
+    def __init__(self, figsize=(8, 12)):
+        super().__init__(figsize)
+        for ax, title in zip(self.axes, TITLES):
+            ax.set_title(f"{title} (Old Test)")
+        self.new_lines = [
+            self.animate(ax.plot([], [], marker="o", color=color, label="New Test")[0])
+            for ax, color in zip(self.axes, ("blue", "red", "green"))
+        ]
+        self.old_lines = [
+            self.animate(ax.plot([], [], marker="x", color=color, label="Old Test")[0])
+            for ax, color in zip(self.axes, ("green", "orange", "purple"))
+        ]
+        self.progress_text = self.animate(
+            self.axes[2].text(0, 0, "", bbox=dict(facecolor="white", alpha=0.8))
+        )
+
+    def update(self, new_data, old_data, improvements, show_new=True):
+        from downsample import sample_points
+
+        stages_new = np.arange(1, len(new_data) + 1)
+        stages_old = np.arange(1, len(old_data) + 1)
+        keep_new = sample_points(new_data["stage"], new_data["lactate"])
+        keep_old = sample_points(old_data["stage"], old_data["lactate"])
+        for new_line, old_line, column in zip(self.new_lines, self.old_lines, COLUMNS):
+            self.set_series(new_line, stages_new, new_data[column], keep_new)
+            self.set_series(old_line, stages_old, old_data[column], keep_old)
+
+        # Display improvements
+        self.progress_text.set_position(
+            (
+                max(len(new_data), len(old_data)) * 0.5,
+                max(new_data["power"].max(initial=0), old_data["power"].max()) * 0.8,
+            )
+        )
+        self.progress_text.set_text(
+            "Progress:\n"
+            + "\n".join(
+                f"{name}: {_format_watts(value)}"
+                for name, value in improvements.items()
+            )
+        )
+
+        self.set_new_visible(show_new)
+
+    def set_new_visible(self, visible):
+        for line in self.new_lines:
+            line.set_visible(visible)
+        for ax, new_line, old_line in zip(self.axes, self.new_lines, self.old_lines):
+            self.set_legend(ax, [new_line, old_line] if visible else [old_line])
+        self.redraw(self.autoscale())
+
+
+class OverlayFigure(BlitFigure):
+    """
+    Any number of tests overlaid on a shared power axis (see overlay.py).
+
+    Each panel draws all curves as one LineCollection and each threshold as
+    one scatter of per-test markers, so the number of artists does not grow
+    with the number of tests. Tests are colored from oldest to newest.
+    """
+
+    def __init__(self, figsize=(8, 10)):
+        from matplotlib.collections import LineCollection
+        from matplotlib.lines import Line2D
+
+        super().__init__(
+            figsize,
+            ("Lactate by Power", "Heart Rate by Power"),
+            Y_LABELS[:2],
+            "Power (W)",
+        )
+        self.curves = [
+            self.animate(ax.add_collection(LineCollection([]))) for ax in self.axes
+        ]
+        self.markers = [
+            {
+                name: self.animate(
+                    ax.scatter(
+                        [],
+                        [],
+                        marker=marker,
+                        edgecolors=THRESHOLD_COLORS[name],
+                        linewidths=1.5,
+                        s=50,
+                        zorder=3,
+                    )
+                )
+                for name, marker in THRESHOLD_MARKERS.items()
+            }
+            for ax in self.axes
+        ]
+        # The markers only change position, so their legend is static
+        self.axes[0].legend(
+            handles=[
+                Line2D(
+                    [],
+                    [],
+                    linestyle="",
+                    marker=marker,
+                    markerfacecolor="white",
+                    markeredgecolor=THRESHOLD_COLORS[name],
+                    label=name,
+                )
+                for name, marker in THRESHOLD_MARKERS.items()
+            ],
+            loc="upper left",
+        )
+        self.colors = []
+
+    def update(self, overlay):
+        from matplotlib import colormaps
+
+        n = len(overlay.thresholds)
+        self.colors = colormaps["viridis"](np.linspace(0.1, 0.9, n)) if n else []
+        curves = (overlay.lactate, overlay.heart_rate)
+        markers = (overlay.marker_lactate, overlay.marker_heart_rate)
+
+        full = False
+        for ax, collection, scatters, values, marker_values in zip(
+            self.axes, self.curves, self.markers, curves, markers
+        ):
+            collection.set_segments(
+                [np.column_stack((overlay.grid, row)) for row in values]
+            )
+            collection.set_colors(self.colors)
+            for column, scatter in enumerate(scatters.values()):
+                x = overlay.thresholds[:, column]
+                y = marker_values[:, column]
+                shown = ~np.isnan(x) & ~np.isnan(y)
+                scatter.set_offsets(np.column_stack((x[shown], y[shown])))
+                scatter.set_facecolors(np.asarray(self.colors)[shown] if n else [])
+            full = self._set_limits(ax, overlay.grid, values) or full
+        self.redraw(full)
+
+    def _set_limits(self, ax, grid, values):
+        # Collections are ignored by autoscaling, so limits are set from the
+        # curves; True if they changed
+        limits = (ax.get_xlim(), ax.get_ylim())
+        if len(grid) and not np.isnan(values).all():
+            low, high = np.nanmin(values), np.nanmax(values)
+            margin = (high - low) * 0.05 or 1.0
+            ax.set_xlim(grid[0], grid[-1] if grid[-1] > grid[0] else grid[0] + 1)
+            ax.set_ylim(low - margin, high + margin)
+        return limits != (ax.get_xlim(), ax.get_ylim())
+
+
+def _format_watts(value):
+    return f"{value:.2f} W" if value is not None else "n/a"
@@ -0,0 +1,130 @@
+import importlib
+import sys
+import threading
+import time
+
+# Process start as seen by this module, which main.py imports first
+STARTED = time.perf_counter()
+
+
+def _import(name):
+    return lambda: importlib.import_module(name)
+
+
+def _warm_data():
+    # NumPy and the modules the window needs to hold the tests
+    import journal  # noqa: F401
+    import store  # noqa: F401
+    import thresholds  # noqa: F401
+
+
+def _warm_fonts():
+    # Resolving the default font loads matplotlib's font cache, which
+    # otherwise happens while the first figure is drawn
+    from matplotlib import font_manager, rcParams
+
+    font_manager.findfont(font_manager.FontProperties(family=rcParams["font.family"]))
+
+
+def _warm_reportlab():
+    from reportlab.lib.styles import getSampleStyleSheet
+    import reportlab.platypus  # noqa: F401
+
+    getSampleStyleSheet()
+
+
+# Work done ahead of the first click, in the order the features are usually
+# needed: the test stores first, then plotting, loading spreadsheets and PDF
+# export
+STEPS = (
+    ("data", _warm_data),
+    ("matplotlib", _import("matplotlib.figure")),
+    ("tkagg backend", _import("matplotlib.backends.backend_tkagg")),
+    ("fonts", _warm_fonts),
+    ("plotting", _import("plotting")),
+    ("pandas", _import("pandas")),
+    ("excel", _import("openpyxl")),
+    ("cache", _import("cache")),
+    ("reportlab", _warm_reportlab),
+    ("report", _import("report")),
+)
+
+# Step the window waits for before it creates the tests
+DATA_STEP = "data"
+
+# Step after which the first plot can be drawn without waiting on imports
+FIRST_PLOT_STEP = "plotting"
+
+
+class Preloader:
+    """
+    Runs the STEPS (mostly heavy imports) on a background thread.
+
+    The GUI calls wait() before it needs a step, so a click that arrives
+    early blocks only until that step is done instead of importing the same
+    modules concurrently with the thread. A step that fails is still marked
+    done; the GUI then hits the same error when it imports the module itself.
+    """
+
+    def __init__(self, steps=STEPS, on_done=None):
+        self.steps = steps
+        self.on_done = on_done
+        self.timings = []
+        self.errors = {}
+        self._done = {name: threading.Event() for name, _ in steps}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wait(self, step, timeout=None):
+        return self._done[step].wait(timeout)
+
+    def finished(self):
+        return all(event.is_set() for event in self._done.values())
+
+    def _run(self):
+        for name, step in self.steps:
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                self.errors[name] = e
+            end = time.perf_counter()
+            self.timings.append((name, end - start, end - STARTED))
+            self._done[name].set()
+            # Let the Tk main loop run between steps
+            time.sleep(0)
+        if self.on_done is not None:
+            self.on_done()
+
+
+class StartupTimer:
+    # Named moments of the startup, in seconds since STARTED
+
+    def __init__(self):
+        self.marks = {}
+
+    def mark(self, name, elapsed=None):
+        # The first mark of a name wins
+        if elapsed is None:
+            elapsed = time.perf_counter() - STARTED
+        self.marks.setdefault(name, elapsed)
+
+    def report(self, preloader=None):
+        lines = ["Startup timings (seconds since launch):"]
+        for name, elapsed in self.marks.items():
+            lines.append(f"  {name:<24}{elapsed:7.2f}")
+        if preloader is not None:
+            lines.append("Background preloading:")
+            for name, duration, finished in preloader.timings:
+                error = preloader.errors.get(name)
+                status = f"  failed: {error}" if error is not None else ""
+                lines.append(
+                    f"  {name:<24}{duration:7.2f}  (done at {finished:.2f}){status}"
+                )
+        return "\n".join(lines)
+
+    def print_report(self, preloader=None):
+        print(self.report(preloader), file=sys.stderr)
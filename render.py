@@ -0,0 +1,227 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_RENDER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", ".cache", "renders"
+)
+DEFAULT_MAX_BYTES = 128 * 2**20
+MEMORY_ITEMS = 32
+FORMATS = ("png", "svg")
+
+# Part of every cache key; bump it when the look of the figures changes so
+# old renders are not served
+RENDER_VERSION = 3
+
+
+class Renderer:
+    """
+    Headless renderer of test and comparison figures to PNG or SVG bytes.
+
+    Figures are drawn off-screen (PNG with the Agg backend) on long-lived
+    plotting figures (one per size) and cached in memory and on disk, keyed
+    by the fingerprints of the tests, the thresholds and the render size. An
+    unchanged test is therefore drawn once, whether the GUI, a PDF export or
+    a batch run asks for it. Disk entries are written atomically and shared
+    between processes; the oldest are evicted beyond ``max_bytes``.
+    """
+
+    def __init__(
+        self,
+        directory=DEFAULT_RENDER_DIR,
+        max_bytes=DEFAULT_MAX_BYTES,
+        memory_items=MEMORY_ITEMS,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._figures = {}
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._entries())
+
+    def render_test(self, data, results, format="png", figsize=(8, 12), dpi=100):
+        # The report figure of one test (a TestStore) with its
+        # (FTP, LT1, LT2, FATmax) results
+        key = _key("test", data.fingerprint(), _values(results), format, figsize, dpi)
+
+        def draw(figure):
+            figure.update(data, results)
+
+        return self._render(key, "test", draw, format, figsize, dpi)
+
+    def render_comparison(
+        self,
+        new_data,
+        old_data,
+        improvements,
+        show_new=True,
+        format="png",
+        figsize=(8, 12),
+        dpi=100,
+    ):
+        # The comparison figure of a new and an old test
+        key = _key(
+            "comparison",
+            new_data.fingerprint(),
+            old_data.fingerprint(),
+            _values(improvements.values()),
+            show_new,
+            format,
+            figsize,
+            dpi,
+        )
+
+        def draw(figure):
+            figure.update(new_data, old_data, improvements, show_new)
+
+        return self._render(key, "comparison", draw, format, figsize, dpi)
+
+    def stats(self):
+        entries = self._entries() if self.directory is not None else []
+        return {
+            "directory": self.directory,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.directory is not None:
+                for path, _, _ in self._entries():
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self._disk_bytes = 0
+
+    def _render(self, key, kind, draw, format, figsize, dpi):
+        if format not in FORMATS:
+            raise ValueError(f"unsupported render format: {format}")
+
+        with self._lock:
+            image = self._memory.get(key)
+            if image is None:
+                image = self._read(key, format)
+            if image is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                figure = self._figure(kind, tuple(figsize))
+                draw(figure)
+                # Headless figures are never redrawn by a canvas, which is
+                # where the GUI lays them out
+                figure.figure.tight_layout()
+                buffer = io.BytesIO()
+                figure.figure.savefig(
+                    buffer, format=format, dpi=dpi, bbox_inches="tight"
+                )
+                image = buffer.getvalue()
+                self._write(key, format, image)
+
+            self._memory[key] = image
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+            return image
+
+    def _figure(self, kind, figsize):
+        # Figures are reused per kind and size; their artists are updated in
+        # place rather than rebuilt. They are never attached to a GUI canvas,
+        # so savefig() renders PNG with Agg and SVG with the SVG backend.
+        figure = self._figures.get((kind, figsize))
+        if figure is None:
+            from plotting import ComparisonFigure, TestFigure
+
+            figure_class = TestFigure if kind == "test" else ComparisonFigure
+            figure = self._figures[(kind, figsize)] = figure_class(figsize)
+        return figure
+
+    def _path(self, key, format):
+        return os.path.join(self.directory, f"{key}.{format}")
+
+    def _read(self, key, format):
+        if self.directory is None:
+            return None
+        path = self._path(key, format)
+        try:
+            with open(path, "rb") as f:
+                image = f.read()
+        except OSError:
+            return None
+        # The modification time orders entries for eviction
+        os.utime(path)
+        return image
+
+    def _write(self, key, format, image):
+        if self.directory is None:
+            return
+        path = self._path(key, format)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(image)
+        os.replace(temporary_path, path)
+        self._disk_bytes += len(image)
+        if self._disk_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # Other processes share the directory, so the real total is
+        # recounted before removing the least recently used entries
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._disk_bytes = total
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(FORMATS):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+
+def _values(values):
+    # Thresholds rounded for the key, so float noise does not miss the cache
+    return tuple(None if value is None else round(float(value), 6) for value in values)
+
+
+def _key(*parts):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((RENDER_VERSION, *parts)).encode())
+    return digest.hexdigest()
+
+
+# One renderer per process, created on first use
+_default_renderer = None
+
+
+def default_renderer():
+    global _default_renderer
+
+    if _default_renderer is None:
+        _default_renderer = Renderer()
+    return _default_renderer
@@ -0,0 +1,176 @@
+import io
+
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+# Explanation printed after each threshold in the report, per threshold
+# method (see thresholds.METHODS), in THRESHOLDS order
+FTP_FROM_LT2 = "Calculated approx. 5-10% above LT2"
+FATMAX_FROM_LT1 = "Calculated approx. 90-100% below LT1"
+DESCRIPTIONS = {
+    "bands": (
+        FTP_FROM_LT2,
+        "Calculated approx. 1.5 - 2.0 mmol/L",
+        "Calculated approx. 3.0 - 6.0 mmol/L",
+        FATMAX_FROM_LT1,
+    ),
+    "baseline": (
+        "Calculated as 95% of LT2",
+        "First stage more than 0.5 mmol/L above the first stage",
+        "First stage at 4.0 mmol/L or more",
+        "Highest power before LT1",
+    ),
+    "dmax": (
+        FTP_FROM_LT2,
+        "Interpolated at 0.5 mmol/L above the first stage",
+        "Point of a 3rd order polynomial fit farthest from the line joining "
+        "its first and last stage",
+        FATMAX_FROM_LT1,
+    ),
+    "dmax_exp": (
+        FTP_FROM_LT2,
+        "Interpolated at 0.5 mmol/L above the first stage",
+        "Point of an exponential fit farthest from the line joining its first "
+        "and last stage",
+        FATMAX_FROM_LT1,
+    ),
+    "modified_dmax": (
+        FTP_FROM_LT2,
+        "Interpolated at 0.5 mmol/L above the first stage",
+        "Point of a 3rd order polynomial fit farthest from the line joining "
+        "the stage before the first rise of more than 0.4 mmol/L and the last "
+        "stage",
+        FATMAX_FROM_LT1,
+    ),
+    "log_log": (
+        FTP_FROM_LT2,
+        "Breakpoint of log lactate over log power",
+        "Interpolated at 4.0 mmol/L",
+        FATMAX_FROM_LT1,
+    ),
+    "obla": (
+        FTP_FROM_LT2,
+        "Interpolated at 2.0 mmol/L",
+        "Interpolated at 4.0 mmol/L",
+        FATMAX_FROM_LT1,
+    ),
+}
+
+
+def format_interval(interval):
+    # " (95% CI low-high W)" for a bootstrap interval, or "" without one
+    from thresholds import CONFIDENCE
+
+    if interval is None or any(bound != bound for bound in interval):
+        return ""
+    low, high = interval
+    return f" ({CONFIDENCE:.0%} CI {low:.0f}-{high:.0f} W)"
+
+
+def render_report_image(data, results, renderer=None):
+    """
+    Render the report figure of a test to PNG bytes.
+
+    ``renderer`` is the render.Renderer to use, by default the one shared by
+    the process, so a test that was already rendered is not drawn again.
+    """
+
+    if renderer is None:
+        from render import default_renderer
+
+        renderer = default_renderer()
+    return renderer.render_test(data, results)
+
+
+def render_comparison_image(new_data, old_data, improvements, renderer=None):
+    # The comparison figure of a new and an old test as PNG bytes, from the
+    # shared renderer like render_report_image()
+    if renderer is None:
+        from render import default_renderer
+
+        renderer = default_renderer()
+    return renderer.render_comparison(new_data, old_data, improvements)
+
+
+def build_report(
+    destination,
+    results,
+    image,
+    progress=None,
+    method=None,
+    intervals=None,
+    comparison=None,
+):
+    """
+    Write the PDF report to ``destination`` (a path or a binary file object).
+
+    ``results`` is the (FTP, LT1, LT2, FATmax) tuple and ``image`` the PNG
+    bytes of the figure. The image is handed to reportlab in memory, so no
+    temporary files are written. ``progress`` is called with a fraction
+    between 0 and 1 while the document is laid out. ``method`` is the name
+    of the threshold method (see thresholds.METHODS) the results came from
+    and ``intervals`` their (low, high) bootstrap confidence intervals.
+    ``comparison`` is the PNG of the comparison with an old test, added on
+    a second page.
+    """
+
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import (
+        Image,
+        PageBreak,
+        Paragraph,
+        SimpleDocTemplate,
+        Spacer,
+    )
+
+    pdf_doc = SimpleDocTemplate(destination, pagesize=letter)
+    if progress is not None:
+        total = {"flowables": 1}
+
+        def on_progress(kind, value):
+            if kind == "SIZE_EST":
+                total["flowables"] = max(value, 1)
+            elif kind == "PROGRESS":
+                progress(min(value / total["flowables"], 1.0))
+
+        pdf_doc.setProgressCallBack(on_progress)
+
+    styles = getSampleStyleSheet()
+    title_style = styles["Title"]
+    normal_style = styles["BodyText"]
+
+    from methods import DEFAULT_METHOD, METHODS
+
+    elements = [Paragraph("Lactate Test Results", title_style), Spacer(1, 12)]
+    if method is not None:
+        elements.append(Paragraph(f"Method: {METHODS[method]}", normal_style))
+        elements.append(Spacer(1, 12))
+    if intervals is None:
+        intervals = [None] * len(results)
+    descriptions = DESCRIPTIONS[DEFAULT_METHOD if method is None else method]
+    for name, description, value, interval in zip(
+        THRESHOLDS, descriptions, results, intervals
+    ):
+        text = (
+            f"{name}: {value:.2f} W{format_interval(interval)}. {description}"
+            if value is not None
+            else f"{name}: Not Calculated"
+        )
+        elements.append(Paragraph(text, normal_style))
+        elements.append(Spacer(1, 12))
+    elements[-1] = Spacer(1, 24)
+
+    elements.append(
+        Image(io.BytesIO(image), width=350, height=450, kind="proportional")
+    )
+    if comparison is not None:
+        elements.append(PageBreak())
+        elements.append(Paragraph("Comparison with the Old Test", title_style))
+        elements.append(Spacer(1, 24))
+        elements.append(
+            Image(io.BytesIO(comparison), width=350, height=450, kind="proportional")
+        )
+
+    pdf_doc.build(elements)
+    if progress is not None:
+        progress(1.0)
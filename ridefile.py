@@ -0,0 +1,409 @@
+import datetime
+import gzip
+import os
+import re
+import struct
+
+import numpy as np
+
+# Samples per chunk yielded while a ride file is read
+CHUNK_SAMPLES = 8192
+
+# Step detection: the mean power of the STEP_WINDOW_SECONDS after a sample
+# has to differ by at least MIN_STEP_WATTS from the window before it, and
+# stages shorter than MIN_STAGE_SECONDS (e.g. the ramp between two steps)
+# are dropped
+STEP_WINDOW_SECONDS = 30
+MIN_STEP_WATTS = 15
+MIN_STAGE_SECONDS = 60
+
+# Heart rate lags behind power, so a stage's heart rate is the mean of its
+# last HR_TAIL_SECONDS
+HR_TAIL_SECONDS = 60
+
+# Alternative CSV headers (lowercase) of the ride columns
+CSV_COLUMNS = {
+    "time": ("time", "secs", "seconds", "timestamp", "elapsed_time", "elapsed"),
+    "power": ("power", "watts", "power (w)"),
+    "heart_rate": ("heart_rate", "heartrate", "heart rate", "hr", "heart rate (bpm)"),
+}
+
+# FIT "record" messages and the fields read from them
+FIT_RECORD = 20
+FIT_TIMESTAMP = 253
+FIT_HEART_RATE = 3
+FIT_POWER = 7
+FIT_INVALID = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+FIT_FORMATS = {1: "B", 2: "H", 4: "I"}
+
+
+def read_ride(path, chunk_samples=CHUNK_SAMPLES):
+    """
+    Stream the samples of a FIT, TCX or CSV ride file (optionally gzipped).
+
+    Yields dicts of "time" (seconds, as recorded), "power" and "heart_rate"
+    arrays of up to ``chunk_samples`` samples, NaN where a value is missing.
+    The file is decoded incrementally, so only one chunk of samples is held
+    at a time.
+    """
+
+    name = path[: -len(".gz")] if path.lower().endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".fit":
+        samples = _fit_samples(path)
+    elif extension == ".tcx":
+        samples = _tcx_samples(path)
+    elif extension == ".csv":
+        yield from _csv_chunks(path, chunk_samples)
+        return
+    else:
+        raise ValueError(f"Unsupported ride file: {os.path.basename(path)}")
+
+    chunk = []
+    for sample in samples:
+        chunk.append(sample)
+        if len(chunk) == chunk_samples:
+            yield _chunk(chunk)
+            chunk = []
+    if chunk:
+        yield _chunk(chunk)
+
+
+def load_ride(path):
+    # All samples of a ride file as numeric arrays, time in seconds from the
+    # first sample
+    chunks = list(read_ride(path))
+    if not chunks:
+        raise ValueError(f"No samples in {os.path.basename(path)}")
+    ride = {
+        name: np.concatenate([chunk[name] for chunk in chunks])
+        for name in ("time", "power", "heart_rate")
+    }
+    ride["time"] = ride["time"] - ride["time"][0]
+    return ride
+
+
+def detect_stages(
+    time,
+    power,
+    window_seconds=STEP_WINDOW_SECONDS,
+    min_step=MIN_STEP_WATTS,
+    min_seconds=MIN_STAGE_SECONDS,
+):
+    """
+    Find the steps of a step test in a power recording.
+
+    A boundary is a sample where the mean power of the following window
+    differs by at least ``min_step`` watts from the preceding window, and the
+    difference is the largest within a window on either side. Means come
+    from a cumulative sum, so the whole ride is scanned with array
+    operations. Returns the (starts, stops) sample indices of the stages
+    lasting at least ``min_seconds``.
+    """
+
+    time = np.asarray(time, dtype=np.float64)
+    power = np.nan_to_num(np.asarray(power, dtype=np.float64))
+    n = len(power)
+    if n < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    interval = np.median(np.diff(time)) or 1.0
+    window = max(int(round(window_seconds / interval)), 1)
+    total = np.concatenate(([0.0], np.cumsum(power)))
+    jump = np.zeros(n)
+    if n > 2 * window:
+        index = np.arange(window, n - window + 1)
+        after = total[index + window] - total[index]
+        before = total[index] - total[index - window]
+        jump[window : n - window + 1] = np.abs(after - before) / window
+
+    # Local maxima of the jump within +-window samples
+    padded = np.pad(jump, window)
+    neighbourhood = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1)
+    peaks = np.flatnonzero((jump >= min_step) & (jump == neighbourhood.max(axis=1)))
+    # A flat peak gives neighbouring candidates; keep the first of each run
+    peaks = peaks[np.diff(peaks, prepend=-window - 1) > window]
+
+    bounds = np.concatenate(([0], peaks, [n]))
+    starts, stops = bounds[:-1], bounds[1:]
+    duration = time[stops - 1] - time[starts]
+    long_enough = duration >= min_seconds
+    return starts[long_enough], stops[long_enough]
+
+
+def stage_means(time, power, heart_rate, starts, stops, hr_tail=HR_TAIL_SECONDS):
+    """
+    Mean power of every stage and mean heart rate of its last ``hr_tail``
+    seconds, ignoring missing samples. Returns (power, heart_rate, end time)
+    arrays with one value per stage.
+    """
+
+    time = np.asarray(time, dtype=np.float64)
+
+    def window_means(values, begin, end):
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        total = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+        count = np.concatenate(([0], np.cumsum(valid)))
+        counts = count[end] - count[begin]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, (total[end] - total[begin]) / counts, np.nan)
+
+    end_time = time[stops - 1]
+    tail = np.maximum(starts, np.searchsorted(time, end_time - hr_tail))
+    return (
+        window_means(power, starts, stops),
+        window_means(heart_rate, tail, stops),
+        end_time,
+    )
+
+
+def align_lactate(end_times, sample_times):
+    """
+    Index of the stage each lactate sample belongs to.
+
+    Lactate is drawn at the end of a stage, a little before or after the
+    step, so every sample is matched to the stage that ends nearest to it.
+    """
+
+    end_times = np.asarray(end_times, dtype=np.float64)
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    after = np.clip(np.searchsorted(end_times, sample_times), 1, len(end_times) - 1)
+    if len(end_times) == 1:
+        return np.zeros(len(sample_times), dtype=np.int64)
+    before = after - 1
+    nearer_before = sample_times - end_times[before] <= end_times[after] - sample_times
+    return np.where(nearer_before, before, after)
+
+
+def parse_lactate_entries(text):
+    """
+    Parse lines of "<time> <lactate>", the time as seconds, mm:ss or
+    hh:mm:ss since the start of the ride. Returns (times, values) arrays.
+    """
+
+    times = []
+    values = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        parts = re.split(r"[\s,;]+", line)
+        if len(parts) != 2:
+            raise ValueError(f"Line {number}: expected '<time> <lactate>'")
+        try:
+            seconds = 0.0
+            for part in parts[0].split(":"):
+                seconds = seconds * 60 + float(part)
+            times.append(seconds)
+            values.append(float(parts[1]))
+        except ValueError:
+            raise ValueError(f"Line {number}: invalid time or lactate value")
+    return np.array(times), np.array(values)
+
+
+def import_ride(ride, starts, stops, lactate_times, lactate_values, data=None):
+    """
+    Append the stages of a ride with a lactate sample to ``data`` (a new
+    TestStore by default) and return it.
+
+    Every stage gets its mean power and heart rate, and its end time in
+    seconds as the Time column. When several samples match one stage the
+    last one is used; stages without a sample are left out.
+    """
+
+    from store import TestStore
+
+    power, heart_rate, end_time = stage_means(
+        ride["time"], ride["power"], ride["heart_rate"], starts, stops
+    )
+    lactate = np.full(len(starts), np.nan)
+    if len(starts) and len(lactate_times):
+        order = np.argsort(lactate_times, kind="stable")
+        lactate[align_lactate(end_time, lactate_times[order])] = lactate_values[order]
+    sampled = ~np.isnan(lactate) & ~np.isnan(power) & ~np.isnan(heart_rate)
+
+    if data is None:
+        data = TestStore(capacity=max(int(sampled.sum()), 1))
+    data.extend(
+        lactate[sampled],
+        np.rint(heart_rate[sampled]),
+        np.rint(power[sampled]),
+        stage=np.flatnonzero(sampled) + 1,
+        time=end_time[sampled],
+    )
+    return data
+
+
+def _open(path, mode):
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _chunk(samples):
+    columns = np.array(samples, dtype=np.float64).reshape(-1, 3).T
+    return {"time": columns[0], "power": columns[1], "heart_rate": columns[2]}
+
+
+def _fit_samples(path):
+    # Minimal decoder of FIT activity files: yields (timestamp, power,
+    # heart rate) of every record message and skips everything else
+    with _open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[8:12] != b".FIT":
+            raise ValueError(f"Not a FIT file: {os.path.basename(path)}")
+        f.read(header[0] - 12)
+        remaining = struct.unpack("<I", header[4:8])[0]
+
+        definitions = {}
+        timestamp = 0
+        while remaining > 0:
+            record_header = f.read(1)[0]
+            remaining -= 1
+            if record_header & 0x80:
+                # Compressed timestamp header: 5-bit offset to the last one
+                local = (record_header >> 5) & 0x03
+                offset = record_header & 0x1F
+                timestamp = (
+                    (timestamp & ~0x1F)
+                    + offset
+                    + (0x20 if offset < timestamp & 0x1F else 0)
+                )
+                compressed = True
+            elif record_header & 0x40:
+                local = record_header & 0x0F
+                definition, size = _fit_definition(f, record_header & 0x20)
+                definitions[local] = definition
+                remaining -= size
+                continue
+            else:
+                local = record_header & 0x0F
+                compressed = False
+
+            number, layout, size, fields = definitions[local]
+            content = f.read(size)
+            remaining -= size
+            if number != FIT_RECORD:
+                continue
+            values = layout.unpack(content)
+            if FIT_TIMESTAMP in fields and not compressed:
+                timestamp = values[fields[FIT_TIMESTAMP][0]]
+            yield (
+                timestamp,
+                _fit_value(values, fields, FIT_POWER),
+                _fit_value(values, fields, FIT_HEART_RATE),
+            )
+
+
+def _fit_definition(f, developer):
+    # Returns ((global number, struct layout, content size, {field: (index,
+    # size)}), bytes read) of a definition message
+    fixed = f.read(5)
+    endian = ">" if fixed[1] else "<"
+    number = struct.unpack(endian + "H", fixed[2:4])[0]
+    field_count = fixed[4]
+    field_bytes = f.read(3 * field_count)
+    size = 5 + 3 * field_count
+
+    layout = endian
+    fields = {}
+    content_size = 0
+    for index in range(field_count):
+        field, field_size, _ = field_bytes[3 * index : 3 * index + 3]
+        if field in (FIT_TIMESTAMP, FIT_HEART_RATE, FIT_POWER) and (
+            field_size in FIT_FORMATS
+        ):
+            layout += FIT_FORMATS[field_size]
+            fields[field] = (index, field_size)
+        else:
+            layout += f"{field_size}s"
+        content_size += field_size
+    if developer:
+        developer_count = f.read(1)[0]
+        developer_bytes = f.read(3 * developer_count)
+        size += 1 + 3 * developer_count
+        for index in range(developer_count):
+            developer_size = developer_bytes[3 * index + 1]
+            layout += f"{developer_size}s"
+            content_size += developer_size
+    return (number, struct.Struct(layout), content_size, fields), size
+
+
+def _fit_value(values, fields, field):
+    if field not in fields:
+        return np.nan
+    index, size = fields[field]
+    value = values[index]
+    return np.nan if value == FIT_INVALID[size] else value
+
+
+def _tcx_samples(path):
+    # Trackpoints of a TCX file, parsed incrementally; every finished
+    # element is cleared so the tree never holds the whole file
+    import xml.etree.ElementTree as ET
+
+    time = power = heart_rate = value = None
+    with _open(path, "rb") as f:
+        for _, element in ET.iterparse(f, events=("end",)):
+            tag = element.tag.rsplit("}", 1)[-1]
+            if tag == "Time":
+                time = datetime.datetime.fromisoformat(element.text.strip())
+            elif tag == "Watts":
+                power = float(element.text)
+            elif tag == "Value":
+                value = float(element.text)
+            elif tag == "HeartRateBpm":
+                # Only a trackpoint's own heart rate, not the average or
+                # maximum of its lap, which also have a Value
+                heart_rate = value
+            elif tag == "Trackpoint":
+                if time is not None:
+                    yield (
+                        time.timestamp(),
+                        np.nan if power is None else power,
+                        np.nan if heart_rate is None else heart_rate,
+                    )
+                time = power = heart_rate = None
+                element.clear()
+            elif tag in ("Lap", "Track"):
+                element.clear()
+
+
+def _csv_chunks(path, chunk_samples):
+    import pandas as pd
+
+    header = pd.read_csv(path, nrows=0).columns
+    names = {}
+    for name, aliases in CSV_COLUMNS.items():
+        for column in header:
+            if column.strip().lower() in aliases:
+                names[name] = column
+                break
+    if "power" not in names:
+        raise ValueError(f"No power column in {os.path.basename(path)}")
+
+    for chunk in pd.read_csv(
+        path, usecols=list(names.values()), chunksize=chunk_samples
+    ):
+        columns = {}
+        for name in ("time", "power", "heart_rate"):
+            if name not in names:
+                columns[name] = np.full(len(chunk), np.nan)
+                continue
+            values = chunk[names[name]]
+            if name == "time" and not pd.api.types.is_numeric_dtype(values):
+                # Seconds since the epoch, whatever the resolution pandas
+                # parsed the timestamps at
+                times = pd.to_datetime(values)
+                epoch = pd.Timestamp(0, tz=times.dt.tz)
+                values = (times - epoch) / pd.Timedelta(seconds=1)
+            columns[name] = pd.to_numeric(values, errors="coerce").to_numpy(
+                dtype=np.float64
+            )
+        if "time" not in names:
+            # Without a time column samples are taken to be 1 s apart
+            columns["time"] = np.arange(len(chunk), dtype=np.float64) + (
+                chunk.index[0] if len(chunk) else 0
+            )
+        yield columns
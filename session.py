@@ -0,0 +1,143 @@
+import json
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from store import COLUMNS
+
+SESSION_FILE_TYPES = [("LactateLab sessions", "*.llsession")]
+
+# File signature, format version and header length
+MAGIC = b"LLSESS\x00\x00"
+FORMAT_VERSION = 1
+PREFIX = struct.Struct("<8sII")
+
+# Arrays start at multiples of this many bytes
+ALIGNMENT = 64
+
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+# columns: test name -> {column -> array}; results: test name -> (4,)
+# watts, NaN where not calculated; intervals: (4, 2) bootstrap intervals of
+# the new test, or None; metadata: dict
+Session = namedtuple("Session", "columns results intervals metadata")
+
+
+def write_session(path, tests, results=None, intervals=None, metadata=None):
+    """
+    Save ``tests`` (name -> TestStore) with their threshold results to a
+    session file.
+
+    The file is a fixed prefix, a JSON header with the metadata and the
+    position of every array, and the test columns, results and intervals as
+    raw little-endian arrays, each aligned to ALIGNMENT bytes so they can be
+    mapped straight into memory by read_session(). ``results`` maps test
+    names to their (FTP, LT1, LT2, FATmax); None means not calculated.
+    """
+
+    arrays = {}
+    for name, test in tests.items():
+        for column, (dtype, _) in COLUMNS.items():
+            arrays[f"{name}/{column}"] = np.asarray(test[column], dtype=dtype)
+    for name, values in (results or {}).items():
+        arrays[f"results/{name}"] = _watts(values)
+    if intervals is not None:
+        arrays["intervals"] = _watts(intervals).reshape(len(THRESHOLDS), 2)
+
+    # The offsets depend on the header length and the header holds the
+    # offsets, so the layout is repeated until the header fits
+    start = PREFIX.size
+    while True:
+        entries = {}
+        offset = _align(start)
+        for key, values in arrays.items():
+            entries[key] = {
+                "dtype": values.dtype.newbyteorder("<").str,
+                "shape": list(values.shape),
+                "offset": offset,
+            }
+            offset = _align(offset + values.nbytes)
+        header = _header(metadata, tests, entries)
+        if PREFIX.size + len(header) <= start:
+            break
+        start = PREFIX.size + len(header)
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+        file.write(header)
+        for key, values in arrays.items():
+            file.seek(entries[key]["offset"])
+            file.write(values.astype(entries[key]["dtype"], copy=False).tobytes())
+        file.truncate(max(offset, file.tell()))
+    os.replace(temporary, path)
+
+
+def read_session(path):
+    """
+    Open a session file written by write_session() and return a Session.
+
+    The file is memory-mapped copy-on-write, and the returned arrays are
+    views of the mapping: nothing is read until it is used, so large
+    sessions open almost instantly, and edits of the arrays stay in memory
+    without changing the file.
+    """
+
+    with open(path, "rb") as file:
+        prefix = file.read(PREFIX.size)
+        if len(prefix) < PREFIX.size:
+            raise ValueError("Not a LactateLab session file.")
+        magic, version, length = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError("Not a LactateLab session file.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported session file version {version}.")
+        header = file.read(length)
+        if len(header) < length:
+            raise ValueError("Session file is truncated (header).")
+        header = json.loads(header.decode("utf-8"))
+
+    size = os.path.getsize(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode="c") if size else None
+    arrays = {}
+    for key, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        count = int(np.prod(shape))
+        if entry["offset"] + count * dtype.itemsize > size:
+            raise ValueError(f"Session file is truncated ({key}).")
+        arrays[key] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=entry["offset"]
+        ).reshape(shape)
+
+    columns = {
+        name: {column: arrays[f"{name}/{column}"] for column in COLUMNS}
+        for name in header["tests"]
+    }
+    results = {
+        key.split("/", 1)[1]: values
+        for key, values in arrays.items()
+        if key.startswith("results/")
+    }
+    return Session(columns, results, arrays.get("intervals"), header["metadata"])
+
+
+def _header(metadata, tests, entries):
+    return json.dumps(
+        {"metadata": metadata or {}, "tests": list(tests), "arrays": entries},
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _watts(values):
+    # Threshold values as float64, NaN for None
+    return np.array(
+        [np.nan if value is None else value for value in np.ravel(values)],
+        dtype=np.float64,
+    )
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,292 @@
+import hashlib
+
+import numpy as np
+
+# Column name in the store -> (dtype, column header in spreadsheets)
+COLUMNS = {
+    "lactate": (np.float64, "Lactate"),
+    "heart_rate": (np.int64, "Heart Rate"),
+    "power": (np.int64, "Power"),
+    "stage": (np.int64, "Stage"),
+    "time": (np.float64, "Time"),
+}
+REQUIRED_COLUMNS = ("lactate", "heart_rate", "power")
+
+# Rows parsed at a time by TestStore.extend_csv()
+CSV_CHUNK_ROWS = 65536
+
+
+class TestStore:
+    """
+    Columnar store for the stages of one lactate test.
+
+    Each column is a contiguous NumPy array that grows geometrically, so
+    appending a stage is amortized O(1) and bulk loads are a single copy.
+    ``store["lactate"]`` returns a view of the filled part of a column; views
+    are only valid until the next append or load.
+
+    Listeners registered with subscribe() are called after every change as
+    ``listener("append", start, stop)``, ``listener("set", index, name)`` or
+    ``listener("reset")``; replace_columns() calls ``listener("reset",
+    source)`` with the source it was given. ``version`` increases with every
+    change.
+    """
+
+    def __init__(self, capacity=64):
+        self._size = 0
+        self._listeners = []
+        self.version = 0
+        self._fingerprint = None
+        self._fingerprint_version = None
+        self._columns = {
+            name: np.empty(capacity, dtype=dtype)
+            for name, (dtype, _) in COLUMNS.items()
+        }
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        return self._columns[name][: self._size]
+
+    def keys(self):
+        return REQUIRED_COLUMNS
+
+    def fingerprint(self):
+        # Hash of the stored values; equal data gives an equal fingerprint
+        # even across clear() and reload. It is recomputed only after a
+        # change.
+        if self._fingerprint_version != self.version:
+            digest = hashlib.blake2b(digest_size=16)
+            for name in COLUMNS:
+                digest.update(self[name].tobytes())
+            self._fingerprint = digest.hexdigest()
+            self._fingerprint_version = self.version
+        return self._fingerprint
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, event, *args):
+        self.version += 1
+        for listener in self._listeners:
+            listener(event, *args)
+
+    def _reserve(self, size):
+        capacity = len(self._columns["lactate"])
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._size] = column[: self._size]
+            self._columns[name] = grown
+
+    def append(self, lactate, heart_rate, power, stage=None, time=np.nan):
+        # Append a single stage
+        self._reserve(self._size + 1)
+        if stage is None:
+            stage = self._next_stage()
+        index = self._size
+        self._columns["lactate"][index] = lactate
+        self._columns["heart_rate"][index] = heart_rate
+        self._columns["power"][index] = power
+        self._columns["stage"][index] = stage
+        self._columns["time"][index] = time
+        self._size += 1
+        self._notify("append", index, self._size)
+        return index
+
+    def extend(self, lactate, heart_rate, power, stage=None, time=None):
+        # Append whole columns at once. All arrays must have the same length.
+        count = len(lactate)
+        if len(heart_rate) != count or len(power) != count:
+            raise ValueError("All columns must have the same length.")
+        if stage is None:
+            stage = np.arange(count) + self._next_stage()
+        if time is None:
+            time = np.full(count, np.nan)
+
+        start = self._size
+        self._reserve(start + count)
+        end = start + count
+        self._columns["lactate"][start:end] = lactate
+        self._columns["heart_rate"][start:end] = heart_rate
+        self._columns["power"][start:end] = power
+        self._columns["stage"][start:end] = stage
+        self._columns["time"][start:end] = time
+        self._size = end
+        self._notify("append", start, end)
+        return start
+
+    def extend_dataframe(self, df):
+        # Validate and append a DataFrame with Lactate, Heart Rate and Power
+        # columns (and optional Stage and Time columns) in one copy
+        columns = validate_dataframe(df)
+        return self.extend(
+            columns["lactate"],
+            columns["heart_rate"],
+            columns["power"],
+            stage=columns.get("stage"),
+            time=columns.get("time"),
+        )
+
+    def extend_csv(self, path, chunksize=CSV_CHUNK_ROWS):
+        """
+        Append the test columns of a CSV file, plain or gzip-compressed.
+
+        Only the Lactate, Heart Rate and Power columns (and Stage and Time
+        when present) are parsed, all as float64, ``chunksize`` rows at a
+        time. Each chunk is validated and copied straight into the columns,
+        so memory stays flat however long the file is. If a chunk is
+        invalid, the rows appended from the file are dropped again.
+        """
+
+        import pandas as pd
+
+        present = set(pd.read_csv(path, nrows=0).columns)
+        missing = [
+            COLUMNS[name][1]
+            for name in REQUIRED_COLUMNS
+            if COLUMNS[name][1] not in present
+        ]
+        if missing:
+            raise ValueError(f"Missing column(s): {', '.join(missing)}")
+        headers = [header for _, header in COLUMNS.values() if header in present]
+
+        start = self._size
+        try:
+            for chunk in pd.read_csv(
+                path,
+                usecols=headers,
+                dtype={header: np.float64 for header in headers},
+                chunksize=chunksize,
+                engine="c",
+            ):
+                columns = validate_dataframe(chunk, first_row=self._size - start)
+                self.extend(
+                    columns["lactate"],
+                    columns["heart_rate"],
+                    columns["power"],
+                    stage=columns.get("stage"),
+                    time=columns.get("time"),
+                )
+        except Exception:
+            if self._size != start:
+                self._size = start
+                self._notify("reset")
+            raise
+        return start
+
+    def copy(self):
+        # An independent store with the same rows
+        data = TestStore(capacity=max(self._size, 1))
+        data.extend(
+            self["lactate"],
+            self["heart_rate"],
+            self["power"],
+            stage=self["stage"],
+            time=self["time"],
+        )
+        return data
+
+    def replace_columns(self, columns, source=None):
+        """
+        Replace all rows by ``columns`` (name -> array, all of equal length)
+        without copying them.
+
+        The arrays, e.g. views of a memory-mapped session file, become the
+        columns of the store, so the table and plots read from them directly.
+        They are only copied once rows are appended past their end.
+        ``source`` tells listeners where the columns came from, e.g. the
+        (path, test name) of a session file, so they need not copy them.
+        """
+
+        size = len(columns["lactate"])
+        if any(len(columns[name]) != size for name in COLUMNS):
+            raise ValueError("All columns must have the same length.")
+        self._columns = {
+            name: np.asarray(columns[name], dtype=dtype)
+            for name, (dtype, _) in COLUMNS.items()
+        }
+        self._size = size
+        self._notify("reset", source)
+
+    def set_value(self, index, name, value):
+        if not 0 <= index < self._size:
+            raise IndexError(f"Row {index} is out of range.")
+        self._columns[name][index] = value
+        self._notify("set", index, name)
+
+    def row(self, index):
+        return (
+            self._columns["lactate"][index].item(),
+            self._columns["heart_rate"][index].item(),
+            self._columns["power"][index].item(),
+        )
+
+    def rows(self, start=0, stop=None):
+        # Yield (lactate, heart_rate, power) tuples of plain Python numbers
+        stop = self._size if stop is None else min(stop, self._size)
+        return zip(
+            self._columns["lactate"][start:stop].tolist(),
+            self._columns["heart_rate"][start:stop].tolist(),
+            self._columns["power"][start:stop].tolist(),
+        )
+
+    def clear(self):
+        self._size = 0
+        self._notify("reset")
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame({name: self[name] for name in REQUIRED_COLUMNS})
+
+    def _next_stage(self):
+        if self._size == 0:
+            return 1
+        return int(self._columns["stage"][self._size - 1]) + 1
+
+
+def validate_dataframe(df, first_row=0):
+    """
+    Convert the test columns of ``df`` to typed NumPy arrays.
+
+    Raises ValueError when a required column is missing or contains missing
+    or non-numeric values. The check runs on whole columns at once.
+    ``first_row`` is the position of ``df`` in its file, for error messages.
+    """
+
+    import pandas as pd
+
+    headers = [COLUMNS[name][1] for name in REQUIRED_COLUMNS]
+    missing = [header for header in headers if header not in df.columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+
+    columns = {}
+    for name, (dtype, header) in COLUMNS.items():
+        if header not in df.columns:
+            continue
+        values = pd.to_numeric(df[header], errors="coerce").to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        invalid = np.isnan(values)
+        if name == "time":
+            # Time is informational, so unparseable values are kept as NaN
+            columns[name] = values
+            continue
+        if invalid.any():
+            # Report spreadsheet row numbers (1-based, below the header row)
+            rows = ", ".join(
+                str(first_row + row + 2) for row in np.flatnonzero(invalid)[:5]
+            )
+            raise ValueError(
+                f"Column '{header}' has missing or non-numeric values "
+                f"(row {rows}{', ...' if invalid.sum() > 5 else ''})"
+            )
+        if dtype is np.int64:
+            values = np.rint(values)
+        columns[name] = values.astype(dtype)
+    return columns
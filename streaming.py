@@ -0,0 +1,273 @@
+import json
+import queue
+import socket
+import threading
+
+# Accepted field names for each sample value, in default CSV column order
+FIELDS = {
+    "lactate": ("lactate", "Lactate"),
+    "heart_rate": ("heart_rate", "Heart Rate", "hr"),
+    "power": ("power", "Power"),
+    "time": ("time", "Time"),
+}
+
+
+class LineParser:
+    """
+    Parse newline-delimited JSON objects or CSV rows into samples.
+
+    A sample is a (lactate, heart_rate, power, time) tuple; time is NaN when
+    the source does not send it. CSV rows follow the header line if the
+    stream starts with one, otherwise lactate, heart rate, power and an
+    optional time column; empty CSV fields count as missing.
+
+    Lines may leave out lactate, as a head unit streaming power and heart
+    rate does between measurements. A line with lactate then ends the
+    stage: its sample has the mean power and heart rate of the lines since
+    the previous stage, including its own values if it has them.
+    """
+
+    def __init__(self):
+        self.columns = list(FIELDS)
+        # Power and heart rate of the current stage
+        self._power = []
+        self._heart_rate = []
+
+    def parse(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        if line.startswith("{"):
+            return self._sample(json.loads(line))
+
+        values = [value.strip() for value in line.split(",")]
+        try:
+            numbers = [float(value) if value else None for value in values]
+        except ValueError:
+            # A header row names the columns of the rows that follow
+            columns = [_field_name(value) for value in values]
+            if not set(FIELDS).issuperset(columns):
+                raise ValueError("Malformed row") from None
+            self.columns = columns
+            return None
+        return self._sample(dict(zip(self.columns, numbers)))
+
+    def _sample(self, record):
+        values = {}
+        for field, names in FIELDS.items():
+            for name in names:
+                if name in record and record[name] is not None:
+                    try:
+                        values[field] = float(record[name])
+                    except (TypeError, ValueError):
+                        raise ValueError(f"'{name}' is not a number") from None
+                    break
+
+        if "power" in values and "heart_rate" in values:
+            self._power.append(values["power"])
+            self._heart_rate.append(values["heart_rate"])
+        elif "lactate" not in values or "power" in values or "heart_rate" in values:
+            missing = [
+                field for field in FIELDS if field != "time" and field not in values
+            ]
+            raise ValueError(f"Sample is missing {', '.join(missing)}")
+        if "lactate" not in values:
+            return None
+        if not self._power:
+            raise ValueError("Sample is missing heart_rate, power")
+
+        power = sum(self._power) / len(self._power)
+        heart_rate = sum(self._heart_rate) / len(self._heart_rate)
+        self._power.clear()
+        self._heart_rate.clear()
+        return (
+            values["lactate"],
+            int(round(heart_rate)),
+            int(round(power)),
+            values.get("time", float("nan")),
+        )
+
+
+def _field_name(header):
+    for field, names in FIELDS.items():
+        if header in names:
+            return field
+    return None
+
+
+class StreamSource:
+    # A blocking line source. close() may be called from another thread and
+    # must unblock a pending read.
+
+    def lines(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileReplaySource(StreamSource):
+    # Replays a recorded log, waiting `interval` seconds between lines, so the
+    # streaming path can be exercised without hardware
+
+    def __init__(self, path, interval=0.0):
+        self.path = path
+        self.interval = interval
+        self._closed = threading.Event()
+
+    def lines(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if self._closed.wait(self.interval):
+                    return
+                yield line
+
+    def close(self):
+        self._closed.set()
+
+
+class SocketSource(StreamSource):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._socket = None
+
+    def lines(self):
+        self._socket = socket.create_connection((self.host, self.port))
+        with self._socket.makefile("r", encoding="utf-8", newline="") as f:
+            for line in f:
+                yield line
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+
+
+class SerialSource(StreamSource):
+    def __init__(self, device, baudrate=9600):
+        self.device = device
+        self.baudrate = baudrate
+        self._port = None
+
+    def lines(self):
+        try:
+            import serial
+        except ImportError:
+            serial = None
+
+        if serial is None:
+            # Without pyserial, read the device node as an already configured
+            # line stream
+            self._port = open(self.device, "rb", buffering=0)
+        else:
+            self._port = serial.Serial(self.device, self.baudrate, timeout=0.5)
+
+        buffer = b""
+        while True:
+            port = self._port
+            if port is None:
+                return
+            try:
+                chunk = port.read(256)
+            except (OSError, ValueError, TypeError):
+                # The port was closed by close() from the UI thread
+                return
+            if not chunk:
+                # pyserial returns nothing on timeout, a device node at EOF
+                if serial is None:
+                    return
+                continue
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8", errors="replace")
+
+    def close(self):
+        port, self._port = self._port, None
+        if port is not None:
+            port.close()
+
+
+def open_source(spec):
+    """
+    Create a source from a spec string:
+
+        file:PATH[?interval=SECONDS]
+        tcp:HOST:PORT
+        serial:DEVICE[:BAUDRATE]
+    """
+
+    kind, _, target = spec.partition(":")
+    if kind == "file":
+        path, _, options = target.partition("?interval=")
+        return FileReplaySource(path, float(options) if options else 0.0)
+    if kind == "tcp":
+        host, _, port = target.rpartition(":")
+        return SocketSource(host or "localhost", int(port))
+    if kind == "serial":
+        device, _, baudrate = target.rpartition(":")
+        if device and baudrate.isdigit():
+            return SerialSource(device, int(baudrate))
+        return SerialSource(target)
+    raise ValueError(f"Unknown stream source: {spec}")
+
+
+class StreamReader:
+    """
+    Read samples from a source on a background thread.
+
+    Parsed samples are queued; the UI thread collects them in batches with
+    drain(), so neither I/O nor parsing ever runs on the Tk event loop.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.samples = queue.Queue()
+        self.errors = queue.Queue()
+        self.finished = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.source.close()
+        self._thread.join(timeout=1.0)
+
+    def drain(self, max_samples=None):
+        samples = []
+        while max_samples is None or len(samples) < max_samples:
+            try:
+                samples.append(self.samples.get_nowait())
+            except queue.Empty:
+                break
+        return samples
+
+    def _run(self):
+        parser = LineParser()
+        try:
+            for line in self.source.lines():
+                try:
+                    sample = parser.parse(line)
+                except ValueError as e:
+                    self.errors.put(f"{e}: {line.strip()}")
+                    continue
+                if sample is not None:
+                    self.samples.put(sample)
+        except OSError as e:
+            self.errors.put(str(e))
+        finally:
+            self.finished.set()
+
+
+def replay(path, interval=0.0, timeout=None):
+    # Read a whole file through the streaming path and return its samples
+    reader = StreamReader(FileReplaySource(path, interval)).start()
+    reader.finished.wait(timeout)
+    reader.stop()
+    return reader.drain()
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from store import COLUMNS
+
+
+def lactate_curve(power, low, high, baseline=1.0, peak=9.0, curvature=4.0):
+    """
+    Blood lactate (mmol/L) at ``power`` watts for a test from ``low`` to
+    ``high`` watts.
+
+    Lactate stays near ``baseline`` at low intensity and rises exponentially
+    to ``peak`` at ``high``; a larger ``curvature`` gives a sharper bend.
+    """
+
+    fraction = (np.asarray(power, dtype=np.float64) - low) / (high - low)
+    scale = (peak - baseline) / np.expm1(curvature)
+    return baseline + scale * np.expm1(curvature * fraction)
+
+
+def generate_test(
+    stages=10,
+    start_power=100,
+    step=25,
+    stage_seconds=240,
+    seed=None,
+):
+    """
+    A synthetic incremental step test in the spreadsheet layout.
+
+    Each stage is one row with the lactate sampled at its end, the heart
+    rate (which rises with power and drifts upward over the test) and the
+    stage power. The shape of the lactate curve and the heart-rate response
+    are drawn at random from ``seed``.
+    """
+
+    rng = np.random.default_rng(seed)
+    power = start_power + step * np.arange(stages)
+    lactate = lactate_curve(
+        power,
+        power[0],
+        power[-1],
+        baseline=rng.uniform(0.7, 1.5),
+        peak=rng.uniform(7, 12),
+        curvature=rng.uniform(3, 5),
+    )
+    lactate = np.round(lactate * rng.normal(1.0, 0.04, stages), 1).clip(0.3)
+
+    time = stage_seconds * np.arange(1, stages + 1)
+    heart_rate = _heart_rate(power, time, rng)
+    return _frame(lactate, heart_rate, power, np.arange(1, stages + 1), time)
+
+
+def generate_continuous(
+    samples=100_000,
+    start_power=100,
+    step=25,
+    stage_seconds=240,
+    seed=None,
+):
+    """
+    Synthetic 1 Hz recording of repeated step protocols, ``samples`` rows.
+
+    Power follows stages of ``stage_seconds`` with a little pedalling noise
+    and restarts at ``start_power`` after every ten stages. Heart rate
+    follows power with a lag, and lactate follows the lactate curve of the
+    current power with a slower lag, as a continuous sensor would.
+    """
+
+    rng = np.random.default_rng(seed)
+    time = np.arange(samples, dtype=np.float64)
+    stage = (time // stage_seconds).astype(np.int64)
+    target = start_power + step * (stage % 10)
+    power = np.rint(target + rng.normal(0, 4, samples)).astype(np.int64)
+
+    steady_lactate = lactate_curve(target, start_power, start_power + 9 * step)
+    lactate = _lag(steady_lactate, 90.0)
+    lactate = np.round(lactate + rng.normal(0, 0.05, samples), 2).clip(0.3)
+    # Cardiac drift builds up within each protocol, not over the recording
+    protocol_time = time % (10 * stage_seconds)
+    heart_rate = _heart_rate(_lag(target.astype(np.float64), 30.0), protocol_time, rng)
+    return _frame(lactate, heart_rate, power, stage + 1, time)
+
+
+def _heart_rate(power, time, rng):
+    # Linear in power plus cardiac drift of a few beats per hour
+    resting = rng.uniform(55, 75)
+    slope = rng.uniform(0.3, 0.45)
+    drift = rng.uniform(2, 8) / 3600
+    heart_rate = resting + slope * power + drift * time
+    heart_rate += rng.normal(0, 1.5, len(heart_rate))
+    return np.rint(heart_rate.clip(40, 210)).astype(np.int64)
+
+
+def _lag(values, seconds):
+    # First-order response to a step signal sampled at 1 Hz. Within each
+    # run of equal values the response decays geometrically towards the
+    # value, so it is computed per run instead of per sample.
+    values = np.asarray(values, dtype=np.float64)
+    output = np.empty_like(values)
+    alpha = 1 - np.exp(-1 / seconds)
+    starts = np.flatnonzero(np.diff(values, prepend=np.nan) != 0)
+    level = values[0]
+    for start, stop in zip(starts, list(starts[1:]) + [len(values)]):
+        steps = np.arange(1, stop - start + 1)
+        target = values[start]
+        output[start:stop] = target + (level - target) * (1 - alpha) ** steps
+        level = output[stop - 1]
+    return output
+
+
+def _frame(lactate, heart_rate, power, stage, time):
+    headers = {name: header for name, (_, header) in COLUMNS.items()}
+    return pd.DataFrame(
+        {
+            headers["lactate"]: lactate,
+            headers["heart_rate"]: heart_rate,
+            headers["power"]: power,
+            headers["stage"]: stage,
+            headers["time"]: time,
+        }
+    )
@@ -0,0 +1,203 @@
+import tkinter.font as tkfont
+from tkinter import ttk
+import platform
+
+TEST_COLUMNS = (
+    ("Lactate", "Lactate (mmol/L)"),
+    ("Heart Rate", "Heart Rate (bpm)"),
+    ("Power", "Power (W)"),
+)
+
+
+class VirtualTable(ttk.Frame):
+    """
+    Table view over a TestStore that only creates Treeview items for the
+    rows that fit on screen.
+
+    Scrolling moves a window over the store and refills the visible items
+    from it, so the widget cost does not grow with the number of samples.
+    All public methods take absolute row indices into the store. A table
+    without a store (``store`` is None) is empty.
+    """
+
+    def __init__(self, master, store, columns=TEST_COLUMNS):
+        super().__init__(master)
+        self.store = store
+        self.first = 0
+        self.selected_index = None
+        self._visible_rows = 1
+        self._row_height = None
+        self._header_height = 0
+
+        self.treeview = ttk.Treeview(
+            self,
+            columns=[name for name, _ in columns],
+            show="headings",
+            selectmode="browse",
+        )
+        for name, heading in columns:
+            self.treeview.heading(name, text=heading)
+        self.treeview.grid(row=0, column=0, sticky="nsew")
+
+        self.scrollbar = ttk.Scrollbar(
+            self, orient="vertical", command=self._on_scrollbar
+        )
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+
+        self.treeview.bind("<Configure>", self._on_configure)
+        self.treeview.bind("<<TreeviewSelect>>", self._on_select)
+        if platform.system() == "Windows":
+            self.treeview.bind("<MouseWheel>", self._on_mouse_wheel)
+        else:
+            self.treeview.bind("<Button-4>", self._on_mouse_wheel)
+            self.treeview.bind("<Button-5>", self._on_mouse_wheel)
+        for key, delta in (("<Up>", -1), ("<Down>", 1)):
+            self.treeview.bind(key, lambda event, delta=delta: self._move(delta))
+        self.treeview.bind("<Prior>", lambda event: self._move(-self._visible_rows))
+        self.treeview.bind("<Next>", lambda event: self._move(self._visible_rows))
+
+    def refresh(self):
+        # Refill the visible items from the store after it changed
+        total = self._total()
+        self.first = max(0, min(self.first, total - self._visible_rows))
+        count = max(0, min(self._visible_rows, total - self.first))
+
+        items = self.treeview.get_children()
+        for item in items[count:]:
+            self.treeview.delete(item)
+        for _ in range(len(items), count):
+            self.treeview.insert("", "end")
+
+        if count:
+            rows = self.store.rows(self.first, self.first + count)
+            for item, values in zip(self.treeview.get_children(), rows):
+                self.treeview.item(item, values=values)
+
+        if self.selected_index is not None and self.selected_index >= total:
+            self.selected_index = None
+        self._sync_selection()
+        self._update_scrollbar()
+
+    def refresh_row(self, index):
+        # Redraw a single row if it is inside the visible window
+        item = self._item(index)
+        if item is not None:
+            self.treeview.item(item, values=self.store.row(index))
+
+    def see(self, index):
+        # Scroll the window so that the row is visible
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + self._visible_rows:
+            self.first = index - self._visible_rows + 1
+        self.refresh()
+
+    def index_at(self, y):
+        # Absolute row index at a y coordinate inside the Treeview
+        item = self.treeview.identify_row(y)
+        if not item:
+            return None
+        return self.first + self.treeview.index(item)
+
+    def bbox(self, index, column):
+        item = self._item(index)
+        if item is None:
+            return None
+        return self.treeview.bbox(item, column)
+
+    def _total(self):
+        return 0 if self.store is None else len(self.store)
+
+    def _item(self, index):
+        items = self.treeview.get_children()
+        position = index - self.first
+        if 0 <= position < len(items):
+            return items[position]
+        return None
+
+    def _scroll_to(self, first):
+        self.first = int(first)
+        self.refresh()
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self._scroll_to(float(amount) * self._total())
+        elif action == "scroll":
+            step = self._visible_rows if unit == "pages" else 1
+            self._scroll_to(self.first + int(amount) * step)
+
+    def _on_mouse_wheel(self, event):
+        if platform.system() == "Windows":
+            delta = -1 * int(event.delta / 120)
+        else:
+            delta = -1 if event.num == 4 else 1
+        self._scroll_to(self.first + 3 * delta)
+        return "break"
+
+    def _move(self, delta):
+        # Keyboard navigation over absolute rows, scrolling at the edges
+        total = self._total()
+        if total == 0:
+            return "break"
+        if self.selected_index is None:
+            index = self.first
+        else:
+            index = max(0, min(total - 1, self.selected_index + delta))
+        self.selected_index = index
+        self.see(index)
+        return "break"
+
+    def _on_select(self, event):
+        selection = self.treeview.selection()
+        if selection:
+            self.selected_index = self.first + self.treeview.index(selection[0])
+
+    def _sync_selection(self):
+        item = None
+        if self.selected_index is not None:
+            item = self._item(self.selected_index)
+        if item is None:
+            self.treeview.selection_set(())
+        elif self.treeview.selection() != (item,):
+            self.treeview.selection_set(item)
+            self.treeview.focus(item)
+
+    def _update_scrollbar(self):
+        total = self._total()
+        if total <= self._visible_rows:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(
+                self.first / total, (self.first + self._visible_rows) / total
+            )
+
+    def _measure_rows(self):
+        # Measure the row and header height from a rendered item
+        items = self.treeview.get_children()
+        temporary = None
+        if not items:
+            temporary = self.treeview.insert("", "end")
+            items = (temporary,)
+        self.treeview.update_idletasks()
+        bbox = self.treeview.bbox(items[0])
+        if temporary is not None:
+            self.treeview.delete(temporary)
+        if bbox:
+            _, y, _, height = bbox
+            self._row_height = height
+            self._header_height = y
+        else:
+            linespace = tkfont.nametofont("TkDefaultFont").metrics("linespace")
+            self._row_height = linespace + 4
+            self._header_height = self._row_height + 4
+
+    def _on_configure(self, event):
+        if not self._row_height:
+            self._measure_rows()
+        self._visible_rows = max(
+            1, (event.height - self._header_height) // self._row_height
+        )
+        self.refresh()
@@ -0,0 +1,574 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from methods import DEFAULT_METHOD, METHODS
+
+# Lactate bands (mmol/L) used to locate LT1 and LT2
+LT1_BAND = (1.5, 2.0)
+LT2_BAND = (3.0, 6.0)
+
+
+def calculate_ftp_lt1_lt2_fatmax(lactate, power):
+    """
+    Calculate FTP, LT1, LT2, and FATmax based on lactate and power data.
+
+    Returns:
+        ftp_power (float): Estimated Functional Threshold Power (FTP).
+        lt1_power (float): Power at the first lactate threshold (LT1).
+        lt2_power (float): Power at the second lactate threshold (LT2).
+        fatmax_power (float): Power at which fat oxidation is maximized (Fatmax).
+    """
+
+    lactate = np.asarray(lactate)
+    power = np.asarray(power)
+
+    if len(lactate) < 4:
+        return None, None, None, None
+
+    # Find LT1: the first significant rise in lactate within 1.5-2.0 mmol/L
+    lt1_index = np.argmax(_in_band(lactate[1:], LT1_BAND)) + 1
+
+    # Find LT2: the next significant rise in lactate within 3.0-6.0 mmol/L
+    # after LT1. When LT1 is the last stage there is nothing left to search.
+    if lt1_index + 1 < len(lactate):
+        lt2_index = (
+            np.argmax(_in_band(lactate[lt1_index + 1 :], LT2_BAND)) + lt1_index + 1
+        )
+    else:
+        lt2_index = lt1_index
+
+    return _threshold_powers(power, lt1_index, lt2_index)
+
+
+def _in_band(lactate, band):
+    return (lactate >= band[0]) & (lactate <= band[1])
+
+
+def _threshold_powers(power, lt1_index, lt2_index):
+    lt1_power = power[lt1_index] if lt1_index > 0 else None
+    lt2_power = power[lt2_index] if lt2_index > lt1_index else None
+
+    # FTP: Typically 5-10% above LT2
+    ftp_power = lt2_power * 1.075 if lt2_power else power[-1]
+
+    # FATmax: Typically 90-100% of LT1
+    fatmax_power = lt1_power * 0.95 if lt1_power else None
+
+    return ftp_power, lt1_power, lt2_power, fatmax_power
+
+
+def calculate_old_ftp_lt1_lt2_fatmax(lactate, power):
+    # Calculate FTP, LT1, LT2, and FATmax based on old lactate and power
+    # data
+    lactate = np.asarray(lactate)
+    power = np.asarray(power)
+
+    if len(lactate) < 4:
+        return None, None, None, None
+
+    baseline_lactate = lactate[0]
+
+    lt1_index = np.argmax(lactate > (baseline_lactate + 0.5))
+    lt1_power = power[lt1_index] if lt1_index > 0 else None
+
+    lt2_index = np.argmax(lactate >= 4)
+    lt2_power = power[lt2_index] if lt2_index > 0 else None
+
+    ftp_power = lt2_power * 0.95 if lt2_power else power[-1]
+
+    fatmax_power = None
+    if lt1_index > 0:
+        fatmax_power = power[:lt1_index].max() if lt1_index > 0 else None
+
+    return ftp_power, lt1_power, lt2_power, fatmax_power
+
+
+class IncrementalThresholds:
+    """
+    Threshold state for a TestStore that follows its changes.
+
+    Instead of rescanning the whole series, the state keeps the index of the
+    first stage in the LT1 band and the sorted indices of all stages in the
+    LT2 band. Appending a stage updates them in amortized O(1), and editing a
+    lactate value only rescans the suffix after the edited stage. results()
+    returns the same values as calculate_ftp_lt1_lt2_fatmax() on the store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lt1_index = None
+        self._lt2_indices = []
+        self._results = None
+        store.subscribe(self._on_change)
+        self._on_change("reset")
+
+    def results(self):
+        if self._results is None:
+            self._results = self._compute()
+        return self._results
+
+    def _compute(self):
+        size = len(self.store)
+        if size < 4:
+            return None, None, None, None
+
+        # Without a stage in the LT1 band the original argmax lands on stage 1
+        lt1_index = self._lt1_index if self._lt1_index is not None else 1
+        if lt1_index + 1 < size:
+            position = bisect_right(self._lt2_indices, lt1_index)
+            if position < len(self._lt2_indices):
+                lt2_index = self._lt2_indices[position]
+            else:
+                lt2_index = lt1_index + 1
+        else:
+            lt2_index = lt1_index
+
+        return _threshold_powers(self.store["power"], lt1_index, lt2_index)
+
+    def _on_change(self, event, *args):
+        self._results = None
+        if event == "reset":
+            self._lt1_index = None
+            self._lt2_indices = []
+            self._append(0, len(self.store))
+        elif event == "append":
+            self._append(*args)
+        elif event == "set":
+            index, name = args
+            if name == "lactate":
+                self._update(index)
+
+    def _append(self, start, stop):
+        lactate = self.store["lactate"][start:stop]
+        if self._lt1_index is None:
+            candidates = np.flatnonzero(_in_band(lactate, LT1_BAND)) + start
+            candidates = candidates[candidates >= 1]
+            if len(candidates):
+                self._lt1_index = int(candidates[0])
+        self._lt2_indices.extend(
+            (np.flatnonzero(_in_band(lactate, LT2_BAND)) + start).tolist()
+        )
+
+    def _update(self, index):
+        lactate = self.store["lactate"]
+
+        if index >= 1:
+            in_lt1_band = bool(_in_band(lactate[index], LT1_BAND))
+            if in_lt1_band and (self._lt1_index is None or index < self._lt1_index):
+                self._lt1_index = index
+            elif not in_lt1_band and index == self._lt1_index:
+                # The first LT1 stage moved out of the band; only the stages
+                # after it can hold the new one
+                candidates = np.flatnonzero(_in_band(lactate[index + 1 :], LT1_BAND))
+                self._lt1_index = (
+                    int(candidates[0]) + index + 1 if len(candidates) else None
+                )
+
+        position = bisect_left(self._lt2_indices, index)
+        listed = (
+            position < len(self._lt2_indices) and self._lt2_indices[position] == index
+        )
+        in_lt2_band = bool(_in_band(lactate[index], LT2_BAND))
+        if in_lt2_band and not listed:
+            self._lt2_indices.insert(position, index)
+        elif listed and not in_lt2_band:
+            del self._lt2_indices[position]
+
+
+# Fixed lactate levels (mmol/L) of the OBLA method
+OBLA_LEVELS = (2.0, 4.0)
+# Rise over baseline (mmol/L) that marks LT1 for the Dmax methods
+BASELINE_RISE = 0.5
+# Rise between two stages (mmol/L) that starts the modified Dmax line
+MODIFIED_DMAX_RISE = 0.4
+# Points per test at which fitted curves are evaluated
+GRID_POINTS = 512
+# Growth rates tried for the exponential fit, on power scaled to 0-1
+EXPONENTIAL_RATES = np.geomspace(0.25, 16, 64)
+
+# Resampled tests and coverage of the bootstrap confidence intervals
+BOOTSTRAP_SAMPLES = 1000
+CONFIDENCE = 0.95
+# Largest temporary array (in values) while scoring a block of resamples;
+# bounds the memory of the bootstrap at a few hundred MB for any test length
+BOOTSTRAP_BLOCK_VALUES = 2**22
+
+
+def calculate_thresholds(lactate, power, method=DEFAULT_METHOD):
+    """
+    Calculate FTP, LT1, LT2, and FATmax of one test with any of METHODS.
+
+    Returns the same (FTP, LT1, LT2, FATmax) tuple as
+    calculate_ftp_lt1_lt2_fatmax(), with None for values that could not be
+    calculated.
+    """
+
+    if method == "bands":
+        return calculate_ftp_lt1_lt2_fatmax(lactate, power)
+    if method == "baseline":
+        return calculate_old_ftp_lt1_lt2_fatmax(lactate, power)
+    row = calculate_thresholds_batch(*stack_tests([(lactate, power)]), method)[0]
+    return tuple(None if np.isnan(value) else float(value) for value in row)
+
+
+def bootstrap_intervals(
+    lactate,
+    power,
+    method=DEFAULT_METHOD,
+    samples=BOOTSTRAP_SAMPLES,
+    confidence=CONFIDENCE,
+    seed=0,
+    stage=None,
+):
+    """
+    Bootstrap confidence intervals for FTP, LT1, LT2, and FATmax of one test.
+
+    A smooth curve is fitted to lactate over power and its residuals are
+    resampled onto it, giving ``samples`` plausible repeats of the test at
+    the same stage powers. All of them are scored with a single
+    calculate_thresholds_batch() call, so this is one array operation
+    rather than one threshold calculation per resample. The fixed ``seed``
+    keeps repeated calculations on the same data identical.
+
+    With ``stage`` (the stage column of a continuous recording) only the
+    measured points, e.g. the last row of every stage, are resampled; the
+    rows in between repeat the lactate of a stage and add no information.
+    Resamples are scored in blocks of at most BOOTSTRAP_BLOCK_VALUES values
+    in the largest temporary array, so memory stays bounded for long tests.
+
+    Returns:
+        A (4, 2) array of the (low, high) bounds of FTP, LT1, LT2, and
+        FATmax, NaN where fewer than half of the resamples had a value.
+    """
+
+    lactate = np.asarray(lactate, dtype=np.float64)
+    power = np.asarray(power, dtype=np.float64)
+    if stage is not None:
+        from downsample import sample_points
+
+        points = sample_points(stage, lactate)
+        lactate, power = lactate[points], power[points]
+    intervals = np.full((4, 2), np.nan)
+    size = len(lactate)
+    if size < 4:
+        return intervals
+
+    # Leave at least one residual degree of freedom; short tests get a
+    # quadratic instead of a cubic
+    degree = min(3, size - 2)
+    low, high = power.min(), power.max()
+    x = ((power - low) / (high - low) if high > low else np.zeros(size))[None, :]
+    with np.errstate(all="ignore"):
+        fitted = _polynomial_fit(
+            x, lactate[None, :], np.ones((1, size), dtype=bool), x, degree
+        )[0]
+    # Residuals of a fit are smaller than the errors; rescale them
+    residuals = (lactate - fitted) * np.sqrt(size / (size - degree - 1))
+
+    # Blocks draw from one generator in order, so the intervals do not
+    # depend on the block size
+    rng = np.random.default_rng(seed)
+    block = max(1, BOOTSTRAP_BLOCK_VALUES // (size * _values_per_stage(method)))
+    scores = []
+    for start in range(0, samples, block):
+        count = min(block, samples - start)
+        resampled = fitted + residuals[rng.integers(0, size, (count, size))]
+        resampled = np.maximum(resampled, 0.0)
+        scores.append(
+            calculate_thresholds_batch(
+                resampled, np.broadcast_to(power, resampled.shape), method
+            )
+        )
+    scores = np.concatenate(scores)
+
+    tail = (1 - confidence) / 2 * 100
+    for column, values in enumerate(scores.T):
+        values = values[~np.isnan(values)]
+        if len(values) * 2 >= samples:
+            intervals[column] = np.percentile(values, [tail, 100 - tail])
+    return intervals
+
+
+def _values_per_stage(method):
+    # Values per stage of a test in the largest temporary array of a method:
+    # the exponential fit tries every rate at once, the polynomial fit
+    # builds a cubic Vandermonde matrix, and the log-log breakpoint holds
+    # two sets of six running sums with their fits (about two dozen arrays)
+    if method == "dmax_exp":
+        return len(EXPONENTIAL_RATES)
+    if method in ("dmax", "modified_dmax"):
+        return 4
+    if method == "log_log":
+        return 24
+    return 1
+
+
+def stack_tests(tests):
+    """
+    Stack (lactate, power) pairs of different lengths into two 2-D arrays.
+
+    Each test is one row; shorter tests are padded at the end with NaN.
+    """
+
+    tests = [
+        (np.asarray(lactate, dtype=np.float64), np.asarray(power, dtype=np.float64))
+        for lactate, power in tests
+    ]
+    width = max((len(lactate) for lactate, _ in tests), default=0)
+    lactate = np.full((len(tests), width), np.nan)
+    power = np.full((len(tests), width), np.nan)
+    for row, (test_lactate, test_power) in enumerate(tests):
+        lactate[row, : len(test_lactate)] = test_lactate
+        power[row, : len(test_power)] = test_power
+    return lactate, power
+
+
+def calculate_thresholds_batch(lactate, power, method=DEFAULT_METHOD):
+    """
+    Calculate the thresholds of many tests at once.
+
+    ``lactate`` and ``power`` hold one test per row, padded at the end with
+    NaN (see stack_tests()). Every method runs as array operations over all
+    rows together, so rescoring thousands of tests takes a handful
+    of NumPy calls rather than one Python call per test. Power between
+    stages is interpolated.
+
+    Returns:
+        An (n, 4) array of FTP, LT1, LT2, and FATmax per test, NaN where a
+        value could not be calculated.
+    """
+
+    if method not in METHODS:
+        raise ValueError(f"unknown threshold method: {method}")
+
+    lactate = np.atleast_2d(np.asarray(lactate, dtype=np.float64))
+    power = np.atleast_2d(np.asarray(power, dtype=np.float64))
+    valid = ~np.isnan(lactate) & ~np.isnan(power)
+    counts = valid.sum(axis=1)
+    results = np.full((len(lactate), 4), np.nan)
+    if lactate.shape[1] < 4:
+        return results
+
+    with np.errstate(all="ignore"):
+        if method == "bands":
+            results = _bands_batch(lactate, power, valid, counts)
+        elif method == "baseline":
+            results = _baseline_batch(lactate, power, valid, counts)
+        else:
+            results = _curve_fit_batch(lactate, power, valid, counts, method)
+
+    results[counts < 4] = np.nan
+    return results
+
+
+def _bands_batch(lactate, power, valid, counts):
+    # calculate_ftp_lt1_lt2_fatmax() on every row, including its fallbacks:
+    # without a stage in the LT1 band LT1 lands on stage 1, and without one
+    # in the LT2 band LT2 lands on the stage after LT1
+    rows = np.arange(len(lactate))
+    stages = np.arange(lactate.shape[1])
+    last_power = power[rows, np.maximum(counts - 1, 0)]
+
+    in_lt1_band = valid & (stages >= 1) & _in_band(lactate, LT1_BAND)
+    lt1_index = np.where(in_lt1_band.any(axis=1), in_lt1_band.argmax(axis=1), 1)
+    in_lt2_band = valid & (stages > lt1_index[:, None]) & _in_band(lactate, LT2_BAND)
+    lt2_index = np.where(
+        in_lt2_band.any(axis=1), in_lt2_band.argmax(axis=1), lt1_index + 1
+    )
+    lt2_index = np.where(lt1_index + 1 < counts, lt2_index, lt1_index)
+
+    lt1 = np.where(lt1_index > 0, power[rows, lt1_index], np.nan)
+    lt2 = np.where(
+        lt2_index > lt1_index, power[rows, np.minimum(lt2_index, counts - 1)], np.nan
+    )
+    results = np.empty((len(lactate), 4))
+    results[:, 0] = np.where(_truthy(lt2), lt2 * 1.075, last_power)
+    results[:, 1] = lt1
+    results[:, 2] = lt2
+    results[:, 3] = np.where(_truthy(lt1), lt1 * 0.95, np.nan)
+    return results
+
+
+def _baseline_batch(lactate, power, valid, counts):
+    # calculate_old_ftp_lt1_lt2_fatmax() on every row
+    rows = np.arange(len(lactate))
+    stages = np.arange(lactate.shape[1])
+    last_power = power[rows, np.maximum(counts - 1, 0)]
+
+    lt1_index = (valid & (lactate > lactate[:, :1] + 0.5)).argmax(axis=1)
+    lt2_index = (valid & (lactate >= 4)).argmax(axis=1)
+    lt1 = np.where(lt1_index > 0, power[rows, lt1_index], np.nan)
+    lt2 = np.where(lt2_index > 0, power[rows, lt2_index], np.nan)
+
+    results = np.empty((len(lactate), 4))
+    results[:, 0] = np.where(_truthy(lt2), lt2 * 0.95, last_power)
+    results[:, 1] = lt1
+    results[:, 2] = lt2
+    before_lt1 = np.where(stages < lt1_index[:, None], power, -np.inf).max(axis=1)
+    results[:, 3] = np.where(lt1_index > 0, before_lt1, np.nan)
+    return results
+
+
+def _truthy(values):
+    # Where the scalar rules' ``if value`` would pass
+    return ~np.isnan(values) & (values != 0)
+
+
+def _curve_fit_batch(lactate, power, valid, counts, method):
+    if method == "obla":
+        lt1 = _power_at_lactate(lactate, power, valid, OBLA_LEVELS[0])
+        lt2 = _power_at_lactate(lactate, power, valid, OBLA_LEVELS[1])
+    elif method == "log_log":
+        lt1 = _log_log_breakpoint(lactate, power, valid)
+        lt2 = _power_at_lactate(lactate, power, valid, OBLA_LEVELS[1])
+    else:
+        lt1 = _power_at_lactate(lactate, power, valid, lactate[:, 0] + BASELINE_RISE)
+        lt2 = _dmax(lactate, power, valid, counts, method)
+
+    last_power = power[np.arange(len(power)), np.maximum(counts - 1, 0)]
+    results = np.empty((len(lactate), 4))
+    # FTP: Typically 5-10% above LT2
+    results[:, 0] = np.where(_truthy(lt2), lt2 * 1.075, last_power)
+    results[:, 1] = lt1
+    results[:, 2] = lt2
+    # FATmax: Typically 90-100% of LT1
+    results[:, 3] = lt1 * 0.95
+    return results
+
+
+def _power_at_lactate(lactate, power, valid, level):
+    # Interpolated power where lactate first reaches ``level`` (a scalar or
+    # one level per test); NaN if it is never reached or already at stage 1
+    rows = np.arange(len(lactate))
+    level = np.broadcast_to(level, rows.shape)
+    above = valid & (lactate >= level[:, None])
+    first = above.argmax(axis=1)
+    found = above.any(axis=1) & (first > 0)
+    first = np.where(found, first, 1)
+
+    lactate_before, lactate_after = lactate[rows, first - 1], lactate[rows, first]
+    power_before, power_after = power[rows, first - 1], power[rows, first]
+    fraction = (level - lactate_before) / (lactate_after - lactate_before)
+    return np.where(
+        found, power_before + fraction * (power_after - power_before), np.nan
+    )
+
+
+def _dmax(lactate, power, valid, counts, method):
+    # LT2 as the point of the fitted curve farthest from the line joining
+    # its start and end. The line starts at the first stage, or for the
+    # modified Dmax at the stage before lactate first rises by more than
+    # MODIFIED_DMAX_RISE.
+    rows = np.arange(len(lactate))
+    low = np.where(valid, power, np.inf).min(axis=1)
+    high = np.where(valid, power, -np.inf).max(axis=1)
+    # Power scaled to 0-1 per test keeps the fits well conditioned
+    x = np.where(valid, (power - low[:, None]) / (high - low)[:, None], 0.0)
+    y = np.where(valid, lactate, 0.0)
+
+    start = np.zeros(len(lactate))
+    if method == "modified_dmax":
+        rises = (
+            valid[:, 1:]
+            & valid[:, :-1]
+            & (np.diff(lactate, axis=1) > MODIFIED_DMAX_RISE)
+        )
+        first = rises.argmax(axis=1)
+        start = np.where(rises.any(axis=1), x[rows, first], 0.0)
+
+    grid = start[:, None] + (1 - start)[:, None] * np.linspace(0, 1, GRID_POINTS)
+    if method == "dmax_exp":
+        curve = _exponential_fit(x, y, valid, grid)
+    else:
+        curve = _polynomial_fit(x, y, valid, grid)
+
+    line = curve[:, :1] + (curve[:, -1:] - curve[:, :1]) * (
+        (grid - grid[:, :1]) / (grid[:, -1:] - grid[:, :1])
+    )
+    best = np.argmax(line - curve, axis=1)
+    lt2 = low + grid[rows, best] * (high - low)
+    return np.where(np.isfinite(lt2) & (counts >= 4), lt2, np.nan)
+
+
+def _polynomial_fit(x, y, valid, grid, degree=3):
+    # Least-squares polynomials of all tests, solved as one stack of normal
+    # equations, evaluated at ``grid``
+    vander = x[:, :, None] ** np.arange(degree + 1) * valid[:, :, None]
+    normal = np.einsum("nmi,nmj->nij", vander, vander)
+    normal += np.eye(degree + 1) * 1e-12
+    rhs = np.einsum("nmi,nm->ni", vander, y)
+    coefficients = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+    return np.einsum(
+        "ngi,ni->ng", grid[:, :, None] ** np.arange(degree + 1), coefficients
+    )
+
+
+def _exponential_fit(x, y, valid, grid):
+    # Least-squares fits of a + b * exp(c * x): for every rate c in
+    # EXPONENTIAL_RATES a and b have a closed form, and the rate with the
+    # smallest residual wins
+    weight = valid[:, None, :]
+    basis = np.exp(EXPONENTIAL_RATES[None, :, None] * x[:, None, :]) * weight
+    n = weight.sum(axis=2)
+    sum_e = basis.sum(axis=2)
+    sum_ee = (basis * basis).sum(axis=2)
+    sum_y = y.sum(axis=1)[:, None]
+    sum_ey = (basis * y[:, None, :]).sum(axis=2)
+
+    b = (n * sum_ey - sum_e * sum_y) / (n * sum_ee - sum_e**2)
+    a = (sum_y - b * sum_e) / n
+    residuals = ((y[:, None, :] - a[:, :, None] - b[:, :, None] * basis) * weight) ** 2
+    best = np.nanargmin(np.where(np.isfinite(a), residuals.sum(axis=2), np.inf), axis=1)
+
+    rows = np.arange(len(x))
+    a, b, rate = a[rows, best], b[rows, best], EXPONENTIAL_RATES[best]
+    return a[:, None] + b[:, None] * np.exp(rate[:, None] * grid)
+
+
+def _log_log_breakpoint(lactate, power, valid):
+    # LT1 as the breakpoint of a two-segment linear regression of log
+    # lactate on log power. The residuals of every split point come from
+    # cumulative sums, so all splits of all tests are scored at once.
+    usable = valid & (lactate > 0) & (power > 0)
+    x = np.where(usable, np.log(np.where(usable, power, 1)), 0.0)
+    y = np.where(usable, np.log(np.where(usable, lactate, 1)), 0.0)
+
+    def prefix(values):
+        return np.concatenate(
+            [np.zeros((len(values), 1)), np.cumsum(values, axis=1)], axis=1
+        )
+
+    sums = [prefix(values) for values in (usable * 1.0, x, y, x * x, x * y, y * y)]
+    totals = [values[:, -1:] for values in sums]
+    first = _segment_fit(*sums)
+    second = _segment_fit(*[total - values for total, values in zip(totals, sums)])
+
+    # A split at k puts stages [0, k) in the first segment and the rest in
+    # the second; each needs at least two stages
+    residuals = first[0] + second[0]
+    residuals[:, :2] = np.inf
+    residuals[(first[3] < 2) | (second[3] < 2)] = np.inf
+    split = np.argmin(np.where(np.isfinite(residuals), residuals, np.inf), axis=1)
+    found = np.isfinite(residuals[np.arange(len(x)), split])
+
+    rows = np.arange(len(x))
+    split = np.clip(split, 1, x.shape[1] - 1)
+    slope1, intercept1 = first[1][rows, split], first[2][rows, split]
+    slope2, intercept2 = second[1][rows, split], second[2][rows, split]
+    low, high = x[rows, split - 1], x[rows, split]
+    crossing = (intercept2 - intercept1) / (slope1 - slope2)
+    crossing = np.where(np.isfinite(crossing), crossing, (low + high) / 2)
+    return np.where(found, np.exp(np.clip(crossing, low, high)), np.nan)
+
+
+def _segment_fit(n, sum_x, sum_y, sum_xx, sum_xy, sum_yy):
+    # Residual sum of squares, slope and intercept of a least-squares line
+    # from running sums
+    sxx = sum_xx - sum_x**2 / n
+    sxy = sum_xy - sum_x * sum_y / n
+    syy = sum_yy - sum_y**2 / n
+    slope = sxy / sxx
+    intercept = (sum_y - slope * sum_x) / n
+    residuals = syy - slope * sxy
+    return residuals, slope, intercept, n
@@ -0,0 +1,124 @@
+import re
+
+import numpy as np
+
+from store import COLUMNS
+
+THRESHOLDS = ("FTP", "LT1", "LT2", "FATmax")
+
+# Rows per sheet in .xlsx; longer tests continue on further sheets
+MAX_SHEET_ROWS = 1_048_576
+
+# Rows converted to Python values at a time
+ROW_BLOCK = 4096
+
+# Test columns written to the test sheets, in this order
+TEST_COLUMNS = ("stage", "lactate", "heart_rate", "power", "time")
+
+
+def write_workbook(
+    destination,
+    tests,
+    thresholds,
+    methods=None,
+    improvements=None,
+    intervals=None,
+    progress=None,
+):
+    """
+    Write tests, their thresholds and the progress between them to one .xlsx
+    workbook.
+
+    ``tests`` is a list of (name, TestStore) pairs, e.g. the current test,
+    the old test and tests from the history, each written to its own sheet.
+    ``thresholds`` holds the (FTP, LT1, LT2, FATmax) of every test, NaN or
+    None where missing, and ``methods`` the threshold method each test's
+    thresholds were calculated with. ``improvements`` maps threshold names to the change
+    of the current test over the old one, and ``intervals`` are the (low,
+    high) bootstrap intervals of the first test.
+
+    The workbook is written with openpyxl's write-only mode, which streams
+    rows to disk instead of keeping cells in memory, and rows are converted
+    ROW_BLOCK at a time, so memory stays flat for long recordings and full
+    seasons. ``progress`` is called with the fraction of rows written.
+    """
+
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    used_names = set()
+    total = max(sum(len(test) for _, test in tests), 1)
+    written = 0
+
+    for name, test in tests:
+        headers = [COLUMNS[column][1] for column in TEST_COLUMNS]
+        for part, start in enumerate(range(0, max(len(test), 1), MAX_SHEET_ROWS - 1)):
+            sheet_name = name if part == 0 else f"{name} ({part + 1})"
+            sheet = workbook.create_sheet(_sheet_name(sheet_name, used_names))
+            sheet.append(headers)
+            stop = min(start + MAX_SHEET_ROWS - 1, len(test))
+            for block in range(start, stop, ROW_BLOCK):
+                end = min(block + ROW_BLOCK, stop)
+                columns = [_cells(test[column][block:end]) for column in TEST_COLUMNS]
+                for row in zip(*columns):
+                    sheet.append(row)
+                written += end - block
+                if progress is not None:
+                    progress(written / total)
+
+    sheet = workbook.create_sheet(_sheet_name("Thresholds", used_names))
+    headers = ["Test", *(f"{name} (W)" for name in THRESHOLDS)]
+    if methods is not None:
+        headers.append("Method")
+    if intervals is not None:
+        headers.extend(
+            f"{name} {bound} (W)" for name in THRESHOLDS for bound in ("low", "high")
+        )
+    sheet.append(headers)
+    for index, ((name, _), values) in enumerate(zip(tests, thresholds)):
+        row = [name, *_cells(np.array(values, dtype=np.float64))]
+        if methods is not None:
+            row.append(methods[index])
+        if intervals is not None and index == 0:
+            row.extend(_cells(np.asarray(intervals, dtype=np.float64).ravel()))
+        sheet.append(row)
+
+    if improvements is not None:
+        sheet = workbook.create_sheet(_sheet_name("Improvements", used_names))
+        sheet.append(["Threshold", "New (W)", "Old (W)", "Change (W)"])
+        new, old = (np.array(values, dtype=np.float64) for values in thresholds[:2])
+        changes = np.array(
+            [improvements.get(name) for name in THRESHOLDS], dtype=np.float64
+        )
+        for row in zip(THRESHOLDS, _cells(new), _cells(old), _cells(changes)):
+            sheet.append(row)
+
+    workbook.save(destination)
+    if progress is not None:
+        progress(1.0)
+
+
+def _cells(values):
+    # Plain Python values of an array, NaN as empty cells
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        missing = np.isnan(values)
+        if missing.any():
+            cells = values.astype(object)
+            cells[missing] = None
+            return cells.tolist()
+    return values.tolist()
+
+
+def _sheet_name(name, used_names):
+    # Excel sheet names are at most 31 characters, unique regardless of case
+    # and cannot contain []:*?/\
+    name = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip("'")[:31] or "Sheet"
+    candidate = name
+    number = 2
+    while candidate.lower() in used_names:
+        suffix = f" ({number})"
+        candidate = name[: 31 - len(suffix)] + suffix
+        number += 1
+    used_names.add(candidate.lower())
+    return candidate